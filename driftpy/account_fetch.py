@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Concurrent getMultipleAccounts fetching with adaptive concurrency and retries
+
+Bulk exports fetch hundreds of thousands of accounts 100 keys at a time. Doing
+that one batch after another leaves the connection idle for most of the run.
+AccountFetcher keeps up to `max_concurrency` batches in flight and adapts to
+the RPC: a rate-limited (HTTP 429) batch halves the in-flight limit and backs
+off, and a run of successful batches raises the limit again one step at a time.
+A batch that fails is retried with exponential backoff. Batches that still fail
+after `max_retries` are recorded in `stats.failed_batches`, never silently
+dropped.
+
+Usage:
+    from account_fetch import AccountFetcher
+
+    fetcher = AccountFetcher(connection, max_concurrency=8)
+
+    # Whole list, in order
+    slot, accounts = await fetcher.fetch_all(pubkeys)
+
+    # Streaming: (batch index, batch pubkeys, slot, accounts) onto a queue as batches finish,
+    # followed by one None when everything is done
+    queue = asyncio.Queue(maxsize=32)
+    asyncio.create_task(fetcher.stream(pubkeys, queue))
+"""
+
+import random
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, List, Optional, Sequence, Tuple
+
+from solders.pubkey import Pubkey # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# getMultipleAccounts accepts at most 100 keys per request
+MAX_ACCOUNTS_PER_REQUEST = 100
+
+
+@dataclass
+class FetchStats:
+    """Counters for one fetcher; failed_batches holds the batch indexes given up on"""
+    batches: int = 0
+    accounts: int = 0
+    missing: int = 0
+    retries: int = 0
+    rate_limited: int = 0
+    failed_batches: List[int] = field(default_factory=list)
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    """True if an RPC error is an HTTP 429 (solana-py wraps the httpx error)"""
+    while error is not None:
+        response = getattr(error, "response", None)
+        if getattr(response, "status_code", None) == 429:
+            return True
+        if "429" in str(error) or "Too Many Requests" in str(error):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class AccountFetcher:
+    """Bounded, adaptive-concurrency getMultipleAccounts client"""
+
+    def __init__(self, connection, batch_size: int = MAX_ACCOUNTS_PER_REQUEST, max_concurrency: int = 8,
+                 min_concurrency: int = 1, max_retries: int = 5, base_backoff: float = 0.5,
+                 max_backoff: float = 30.0, encoding: str = "base64"):
+        """
+        Args:
+            connection: solana AsyncClient
+            batch_size: Keys per getMultipleAccounts request (at most 100)
+            max_concurrency: Upper bound on in-flight requests
+            min_concurrency: Lower bound the limit backs off to
+            max_retries: Attempts per batch after the first before it is reported as failed
+            base_backoff / max_backoff: Exponential backoff range in seconds
+            encoding: Account data encoding requested from the RPC
+        """
+        self.connection = connection
+        self.batch_size = min(batch_size, MAX_ACCOUNTS_PER_REQUEST)
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.encoding = encoding
+        self.stats = FetchStats()
+
+        self.limit = self.max_concurrency
+        self._in_flight = 0
+        self._successes = 0
+        self._slots: Optional[asyncio.Condition] = None
+
+    # ---- Adaptive in-flight limit ----
+
+    async def _acquire(self):
+        if self._slots is None:
+            self._slots = asyncio.Condition()
+        async with self._slots:
+            await self._slots.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+    async def _release(self, rate_limited: bool = False):
+        async with self._slots:
+            self._in_flight -= 1
+            if rate_limited:
+                # Multiplicative decrease
+                self.limit = max(self.min_concurrency, self.limit // 2)
+                self._successes = 0
+            else:
+                # Additive increase after a full window of successes
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self._successes = 0
+            self._slots.notify_all()
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.max_backoff, self.base_backoff * (2 ** attempt))
+        return delay * (0.5 + random.random() / 2)
+
+    # ---- Fetching ----
+
+    async def fetch_batch(self, pubkeys: Sequence[Pubkey], batch_index: int = 0) -> Tuple[int, List[Any]]:
+        """
+        Fetch one batch (at most batch_size keys) with retries.
+
+        Returns:
+            (slot, accounts) with None for accounts that do not exist
+
+        Raises:
+            The last error if the batch still fails after max_retries
+        """
+        attempt = 0
+        while True:
+            await self._acquire()
+            rate_limited = False
+            try:
+                resp = await self.connection.get_multiple_accounts(list(pubkeys), encoding=self.encoding)
+            except Exception as e:
+                rate_limited = is_rate_limited(e)
+                if rate_limited:
+                    self.stats.rate_limited += 1
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f"Batch {batch_index} failed ({'rate limited' if rate_limited else e}); "
+                               f"retry {attempt + 1}/{self.max_retries} in {delay:.1f}s, "
+                               f"concurrency limit {self.limit}")
+                self.stats.retries += 1
+                attempt += 1
+            else:
+                accounts = list(resp.value)
+                self.stats.batches += 1
+                self.stats.accounts += len(accounts)
+                self.stats.missing += sum(1 for account in accounts if account is None)
+                return resp.context.slot, accounts
+            finally:
+                await self._release(rate_limited)
+            await asyncio.sleep(delay)
+
+    def batches(self, pubkeys: Sequence[Pubkey]) -> List[Sequence[Pubkey]]:
+        return [pubkeys[i:i + self.batch_size] for i in range(0, len(pubkeys), self.batch_size)]
+
+    async def stream(self, pubkeys: Sequence[Pubkey], queue: asyncio.Queue, batch_indexes: Optional[Sequence[int]] = None):
+        """
+        Fetch every batch and put (batch index, batch pubkeys, slot, accounts) on `queue` as batches
+        finish (in completion order), then a single None. A bounded queue applies backpressure.
+
+        Args:
+            batch_indexes: Only fetch these batches (e.g. the ones a previous run did not finish)
+        """
+        batches = self.batches(pubkeys)
+        todo = list(range(len(batches))) if batch_indexes is None else list(batch_indexes)
+        pending = asyncio.Queue()
+        for index in todo:
+            pending.put_nowait(index)
+
+        async def worker():
+            while True:
+                try:
+                    index = pending.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    slot, accounts = await self.fetch_batch(batches[index], index)
+                except Exception as e:
+                    logger.error(f"Giving up on batch {index} after {self.max_retries} retries: {e}")
+                    self.stats.failed_batches.append(index)
+                    continue
+                await queue.put((index, batches[index], slot, accounts))
+
+        try:
+            # One task per allowed in-flight request; _acquire enforces the current limit
+            await asyncio.gather(*(worker() for _ in range(min(self.max_concurrency, len(todo)))))
+        finally:
+            await queue.put(None)
+
+    async def fetch_all(self, pubkeys: Sequence[Pubkey]) -> Tuple[int, List[Any]]:
+        """
+        Fetch every key concurrently; returns (newest slot, accounts in input order).
+
+        Raises:
+            RuntimeError if any batch failed after retries
+        """
+        batches = self.batches(pubkeys)
+        results = await asyncio.gather(
+            *(self.fetch_batch(batch, index) for index, batch in enumerate(batches)),
+            return_exceptions=True,
+        )
+        slot = 0
+        accounts: List[Any] = []
+        failed = []
+        for index, result in enumerate(results):
+            if isinstance(result, BaseException):
+                failed.append(index)
+                continue
+            slot = max(slot, result[0])
+            accounts.extend(result[1])
+        if failed:
+            self.stats.failed_batches.extend(failed)
+            raise RuntimeError(f"{len(failed)} of {len(batches)} getMultipleAccounts batches failed")
+        return slot, accounts
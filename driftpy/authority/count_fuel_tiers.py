@@ -1,126 +1,258 @@
 #!/usr/bin/env python3
+"""
+Count users per FUEL tier in UserStats / fuel exports (CSV or Parquet)
 
-import csv
+Each file is streamed in chunks of --chunk-rows rows: CSV through pandas' C
+parser, Parquet as Arrow record batches. Every chunk sums the six fuel columns
+into one total per user with NumPy and folds them into the tier counts and
+sums in the same pass. The per-user totals (8 bytes each) are kept so the
+quantiles are exact.
+
+Tier boundaries are configurable. With --tiers b0,b1,...,bn the tiers are
+FUEL < b0, b0 <= FUEL <= b1, b1 < FUEL <= b2, ..., FUEL > bn; the default
+(1,5000,10000,20000) gives the original tiers. Several files are analyzed in
+parallel, one process per file.
+
+Usage:
+    python count_fuel_tiers.py export.csv
+    python count_fuel_tiers.py a.csv b.parquet --tiers 1,1000,5000,10000,20000,100000 --quantiles 0.5,0.9,0.99
+    python count_fuel_tiers.py exports/*.csv --workers 4 --chunk-rows 2000000
+"""
+
+import os
+import sys
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 
-def analyze_fuel_tiers(csv_filepath):
-    """
-    Analyzes a CSV file to count users in different FUEL point tiers.
+import numpy as np
+import pandas as pd
 
-    Args:
-        csv_filepath (str): The path to the CSV file.
+# Shared helpers live one directory up, next to the other driftpy scripts
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from columnar_export import is_parquet_path, require_pyarrow
+
+FUEL_COLUMN_NAMES = [
+    "fuel_insurance",
+    "fuel_deposits",
+    "fuel_borrows",
+    "fuel_positions",
+    "fuel_taker",
+    "fuel_maker",
+]
+DEFAULT_TIERS = (1, 5000, 10000, 20000)
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+DEFAULT_CHUNK_ROWS = 1_000_000
+
+
+@dataclass
+class TierSummary:
+    """Tier counts and sums for one file; tier i is described by tier_label(boundaries, i)"""
+    filepath: str
+    boundaries: Tuple[float, ...]
+    counts: List[int]
+    sums: List[int]
+    total_accounts: int = 0
+    total_fuel: int = 0
+    non_numeric_rows: int = 0
+    quantiles: Dict[float, float] = field(default_factory=dict)
+
+
+def _fmt(value: float) -> str:
+    return f"{int(value):,}" if float(value).is_integer() else f"{value:,}"
+
+
+def tier_label(boundaries: Sequence[float], index: int) -> str:
+    if index == 0:
+        return f"FUEL < {_fmt(boundaries[0])}"
+    if index == len(boundaries):
+        return f"FUEL > {_fmt(boundaries[-1])}"
+    low = "<=" if index == 1 else "<"
+    return f"{_fmt(boundaries[index - 1])} {low} FUEL <= {_fmt(boundaries[index])}"
+
+
+def tier_indexes(totals: np.ndarray, boundaries: Sequence[float]) -> np.ndarray:
+    """Tier index of each total: 0 below boundaries[0], then upper-inclusive tiers"""
+    upper = np.searchsorted(np.asarray(boundaries[1:], dtype=np.float64), totals, side="left") + 1
+    return np.where(totals < boundaries[0], 0, upper)
+
+
+def iter_fuel_totals(filepath: str, fuel_column_names: Sequence[str],
+                     chunk_rows: int) -> Iterator[Tuple[np.ndarray, int]]:
     """
-    # Initialize counters for distinct tiers
-    total_users_gte_1_fuel = 0
-    users_lt_1_fuel = 0       # Tier: FUEL < 1
-    users_1_to_5k = 0         # Tier: 1 <= FUEL <= 5,000
-    users_5k_to_10k = 0       # Tier: 5,000 < FUEL <= 10,000
-    users_10k_to_20k = 0      # Tier: 10,000 < FUEL <= 20,000
-    users_gt_20k = 0          # Tier: FUEL > 20,000
-    total_accounts_analyzed = 0 # New counter for total rows processed
-
-    fuel_column_names = [
-        "fuel_insurance",
-        "fuel_deposits",
-        "fuel_borrows",
-        "fuel_positions",
-        "fuel_taker",
-        "fuel_maker",
-    ]
+    Yield (per-user total fuel, rows with non-numeric fuel values) chunk by chunk.
 
-    try:
-        with open(csv_filepath, 'r', newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            
-            # Check if all required fuel columns are present in the CSV header
-            if not all(col in reader.fieldnames for col in fuel_column_names):
-                missing_cols = [col for col in fuel_column_names if col not in reader.fieldnames]
-                print(f"Error: The CSV file '{csv_filepath}' is missing required fuel columns: {', '.join(missing_cols)}")
-                print(f"Available columns in the CSV: {', '.join(reader.fieldnames or [])}")
-                return
-
-            for row_num, row in enumerate(reader):
-                total_accounts_analyzed += 1 # Increment for each row processed
-                current_row_total_fuel = 0
-                try:
-                    for col_name in fuel_column_names:
-                        fuel_value_str = row.get(col_name, '0')
-                        if fuel_value_str is None or fuel_value_str.strip() == '':
-                            # Treat empty or None values as 0
-                            fuel_value = 0
-                        else:
-                            # Convert to float first (to handle "0.0") then to int
-                            fuel_value = int(float(fuel_value_str))
-                        current_row_total_fuel += fuel_value
-                except ValueError:
-                    # This handles error for a specific column in the current row
-                    print(f"Warning: Row {row_num + 2} (1-indexed data row) contains a non-numeric fuel value in one of the fuel columns. "
-                          f"Skipping this value for this user's total fuel calculation. Problematic row data snippet for fuel columns: "
-                          f"{{ {', '.join([f'{col}: {row.get(col)}' for col in fuel_column_names])} }}")
-                    # The loop continues, and current_row_total_fuel will have the sum of successfully parsed values for this user.
-
-                # Apply tiering logic based on the calculated total_fuel for the current user
-                if current_row_total_fuel < 1:
-                    users_lt_1_fuel += 1
-                else: # current_row_total_fuel >= 1
-                    total_users_gte_1_fuel += 1
-                    # Assign to a distinct tier for users with >=1 FUEL
-                    if current_row_total_fuel <= 5000: # Includes 1
-                        users_1_to_5k += 1
-                    elif current_row_total_fuel <= 10000:
-                        users_5k_to_10k += 1
-                    elif current_row_total_fuel <= 20000:
-                        users_10k_to_20k += 1
-                    else: # Implies > 20000
-                        users_gt_20k += 1
-                        
-    except FileNotFoundError:
-        print(f"Error: File not found at '{csv_filepath}'")
-        return
-    except Exception as e:
-        print(f"An unexpected error occurred while processing the CSV file: {e}")
-        import traceback
-        traceback.print_exc()
+    Each fuel value is truncated to an integer before summing, as int(float(value)) would;
+    empty and non-numeric values count as 0.
+
+    Raises:
+        ValueError: if the file lacks any of the fuel columns
+    """
+    if is_parquet_path(filepath):
+        _, pq = require_pyarrow()
+        parquet_file = pq.ParquetFile(filepath)
+        available = parquet_file.schema_arrow.names
+        missing_cols = [col for col in fuel_column_names if col not in available]
+        if missing_cols:
+            raise ValueError(f"The file '{filepath}' is missing required fuel columns: {', '.join(missing_cols)}. "
+                             f"Available columns: {', '.join(available)}")
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=list(fuel_column_names)):
+            totals = np.zeros(batch.num_rows, dtype=np.int64)
+            for column in batch.columns:
+                totals += column.fill_null(0).to_numpy(zero_copy_only=False).astype(np.int64)
+            yield totals, 0
         return
 
-    # Calculate sum of distinct tier counts
-    # This sum will now include all categorized users and should match total_accounts_analyzed
-    sum_of_all_tier_counts = users_lt_1_fuel + users_1_to_5k + users_5k_to_10k + users_10k_to_20k + users_gt_20k
+    available = list(pd.read_csv(filepath, nrows=0).columns)
+    missing_cols = [col for col in fuel_column_names if col not in available]
+    if missing_cols:
+        raise ValueError(f"The file '{filepath}' is missing required fuel columns: {', '.join(missing_cols)}. "
+                         f"Available columns: {', '.join(available)}")
+    for chunk in pd.read_csv(filepath, usecols=list(fuel_column_names), chunksize=chunk_rows):
+        totals = np.zeros(len(chunk), dtype=np.int64)
+        non_numeric = np.zeros(len(chunk), dtype=bool)
+        for col_name in fuel_column_names:
+            values = chunk[col_name]
+            if not pd.api.types.is_numeric_dtype(values):
+                # A stray non-numeric cell turns the whole column into strings for this chunk
+                parsed = pd.to_numeric(values, errors="coerce")
+                non_numeric |= (parsed.isna() & values.notna()).to_numpy()
+                values = parsed
+            totals += values.fillna(0).to_numpy().astype(np.int64)
+        yield totals, int(non_numeric.sum())
+
 
-    # Print results
+def summarize_fuel_tiers(filepath: str, boundaries: Sequence[float] = DEFAULT_TIERS,
+                         quantiles: Sequence[float] = DEFAULT_QUANTILES,
+                         chunk_rows: int = DEFAULT_CHUNK_ROWS) -> TierSummary:
+    """Tier counts, tier sums and quantiles of per-user total fuel, in one streaming pass over a file"""
+    boundaries = tuple(sorted(boundaries))
+    num_tiers = len(boundaries) + 1
+    summary = TierSummary(filepath, boundaries, [0] * num_tiers, [0] * num_tiers)
+    all_totals = []
+
+    for totals, non_numeric in iter_fuel_totals(filepath, FUEL_COLUMN_NAMES, chunk_rows):
+        tiers = tier_indexes(totals, boundaries)
+        counts = np.bincount(tiers, minlength=num_tiers)
+        for i in range(num_tiers):
+            summary.counts[i] += int(counts[i])
+            if counts[i]:
+                summary.sums[i] += int(totals[tiers == i].sum())
+        summary.total_accounts += len(totals)
+        summary.total_fuel += int(totals.sum())
+        summary.non_numeric_rows += non_numeric
+        all_totals.append(totals)
+
+    if summary.total_accounts and quantiles:
+        totals = np.concatenate(all_totals)
+        summary.quantiles = dict(zip(quantiles, np.quantile(totals, quantiles).tolist()))
+    return summary
+
+
+def print_tier_summary(summary: TierSummary):
     print("\n--- FUEL Tier Analysis (Distinct Tiers) ---")
-    print(f"Analyzed CSV File: {csv_filepath}")
-    print(f"Total accounts analyzed: {total_accounts_analyzed}") 
-    print("-------------------------------------------")
-    print(f"Users with < 1 FUEL point:                    {users_lt_1_fuel}")
+    print(f"Analyzed File: {summary.filepath}")
+    print(f"Total accounts analyzed: {summary.total_accounts}")
+    print(f"Total FUEL across all accounts: {summary.total_fuel:,}")
+    if summary.non_numeric_rows:
+        print(f"Warning: {summary.non_numeric_rows} rows contain a non-numeric fuel value; "
+              f"those values were counted as 0")
     print("-------------------------------------------")
-    print(f"Breakdown for users with =>1 FUEL point (Total: {total_users_gte_1_fuel}):")
-    print(f"  Users with 1 <= FUEL <= 5,000 points:       {users_1_to_5k}")
-    print(f"  Users with 5,000 < FUEL <= 10,000 points:   {users_5k_to_10k}")
-    print(f"  Users with 10,000 < FUEL <= 20,000 points:  {users_10k_to_20k}")
-    print(f"  Users with > 20,000 FUEL points:              {users_gt_20k}")
+    for i, (count, total) in enumerate(zip(summary.counts, summary.sums)):
+        share = 100 * count / summary.total_accounts if summary.total_accounts else 0
+        print(f"  {tier_label(summary.boundaries, i):<30} {count:>10}  ({share:5.1f}%)  FUEL sum: {total:,}")
     print("-------------------------------------------")
-    print(f"Sum of accounts across all tiers:             {sum_of_all_tier_counts}") 
+    print(f"Sum of accounts across all tiers:             {sum(summary.counts)}")
     print("  (This sum should equal 'Total accounts analyzed')")
+    if summary.quantiles:
+        print("Per-account FUEL quantiles: " + ", ".join(
+            f"p{100 * q:g}={value:,.0f}" for q, value in summary.quantiles.items()))
     print("-------------------------------------------\n")
 
 
+def _summarize_or_error(args) -> Tuple[Optional[TierSummary], Optional[str]]:
+    filepath = args[0]
+    try:
+        return summarize_fuel_tiers(*args), None
+    except FileNotFoundError:
+        return None, f"Error: File not found at '{filepath}'"
+    except ValueError as e:
+        return None, f"Error: {e}"
+
+
+def analyze_fuel_tiers(csv_filepath, boundaries=DEFAULT_TIERS, quantiles=DEFAULT_QUANTILES,
+                       chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Analyzes a CSV or Parquet export to count users in different FUEL point tiers.
+
+    Args:
+        csv_filepath (str): The path to the CSV or .parquet file.
+        boundaries: Tier boundaries (see the module docstring).
+        quantiles: Quantiles of per-account total FUEL to report.
+        chunk_rows: Rows parsed per chunk.
+    """
+    summary, error = _summarize_or_error((csv_filepath, boundaries, quantiles, chunk_rows))
+    if error:
+        print(error)
+        return None
+    print_tier_summary(summary)
+    return summary
+
+
+def _float_list(value: str) -> List[float]:
+    try:
+        return [float(part) for part in value.split(",") if part.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected comma-separated numbers, got '{value}'")
+
+
 def main():
     """
     Main function to parse arguments and call the analysis function.
     """
     parser = argparse.ArgumentParser(
-        description="Analyze FUEL point tiers from a UserStats CSV export.",
+        description="Analyze FUEL point tiers from UserStats CSV or Parquet exports.",
         formatter_class=argparse.RawTextHelpFormatter
     )
     parser.add_argument(
-        "csv_filepath", 
-        type=str, 
-        help="Path to the CSV file to analyze (e.g., user_stats_export.csv)."
+        "csv_filepaths",
+        type=str,
+        nargs="+",
+        help="CSV or Parquet files to analyze (e.g., user_stats_export.csv, user_stats_export.parquet)."
     )
+    parser.add_argument("--tiers", type=_float_list, default=list(DEFAULT_TIERS),
+                        help="Comma-separated tier boundaries b0,...,bn (default: 1,5000,10000,20000)")
+    parser.add_argument("--quantiles", type=_float_list, default=list(DEFAULT_QUANTILES),
+                        help="Comma-separated quantiles of per-account FUEL to report (default: 0.5,0.9,0.99)")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS,
+                        help=f"Rows parsed per chunk (default: {DEFAULT_CHUNK_ROWS})")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Files analyzed in parallel (default: CPU count, at most one per file)")
     args = parser.parse_args()
 
-    analyze_fuel_tiers(args.csv_filepath)
+    if not args.tiers:
+        parser.error("--tiers needs at least one boundary")
+    if any(not 0 <= q <= 1 for q in args.quantiles):
+        parser.error("--quantiles must be between 0 and 1")
+
+    def report(results):
+        # In argument order, each as soon as it (and the files before it) are done
+        for summary, error in results:
+            if error:
+                print(error)
+            else:
+                print_tier_summary(summary)
+
+    jobs = [(path, args.tiers, args.quantiles, args.chunk_rows) for path in args.csv_filepaths]
+    workers = min(args.workers or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        report(map(_summarize_or_error, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            report(executor.map(_summarize_or_error, jobs))
+
 
 if __name__ == "__main__":
     main()
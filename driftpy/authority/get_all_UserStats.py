@@ -3,30 +3,25 @@
 import argparse
 import asyncio
 import os
+import sys
 import csv
 from datetime import datetime
+from pathlib import Path
 
 from solders.keypair import Keypair # type: ignore
-from solders.pubkey import Pubkey # type: ignore
 from anchorpy import Wallet
 from driftpy.drift_client import DriftClient
 from driftpy.account_subscription_config import AccountSubscriptionConfig
 # Removed: from driftpy.user_map.userstats_map import UserStatsMap
 # Removed: from driftpy.user_map.user_map_config import UserStatsMapConfig
-# from driftpy.addresses import get_user_stats_account_public_key # We will define this locally
 from solana.rpc.async_api import AsyncClient
 from dotenv import load_dotenv
 
-# Added helper function from get_UserStats.py
-def get_user_stats_account_public_key(authority: Pubkey, program_id: Pubkey) -> Pubkey:
-    """
-    Derives the userStats account public key for a given authority.
-    """
-    user_stats_account_pk, _ = Pubkey.find_program_address(
-        [b'user_stats', bytes(authority)],
-        program_id
-    )
-    return user_stats_account_pk
+# Shared helpers live one directory up, next to the other driftpy scripts
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from pda_cache import PdaCache, DEFAULT_PDA_CACHE_PATH
+from account_fetch import AccountFetcher, MAX_ACCOUNTS_PER_REQUEST
+from user_stats_decoder import decode_user_stats
 
 def flatten_user_stats_to_row(authority_pk_str, user_stats_pk_str, user_stats_data) -> list: # Renamed authority_pk for clarity
     """
@@ -156,6 +151,9 @@ async def main():
     parser.add_argument("--rpc-url", type=str, default=rpc_url, help=f"The Solana RPC URL (default: {rpc_url} or RPC_URL from .env).")
     parser.add_argument("--output", type=str, default="user_stats_export.csv", help="Output CSV filename (default: user_stats_export.csv)")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose output")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum getMultipleAccounts requests in flight (default: 8)")
+    parser.add_argument("--pda-cache", type=str, default=str(DEFAULT_PDA_CACHE_PATH), help=f"SQLite cache of derived PDAs (default: {DEFAULT_PDA_CACHE_PATH})")
+    parser.add_argument("--max-retries", type=int, default=5, help="Retries per batch before it is reported as failed (default: 5)")
 
     args = parser.parse_args()
 
@@ -186,6 +184,25 @@ async def main():
         if args.verbose:
             print(f"Found {len(all_user_account_wrappers)} User accounts. Now processing UserStats for each.")
         
+        # One UserStats PDA per unique authority (an authority can own several User sub-accounts)
+        authorities = list(dict.fromkeys(w.account.authority for w in all_user_account_wrappers))
+        with PdaCache(args.pda_cache) as pda_cache:
+            user_stats_pks = pda_cache.user_stats_pdas(authorities, drift_client.program_id)
+        if args.verbose:
+            print(f"UserStats PDAs: {pda_cache.hits} from cache, {pda_cache.derived} derived")
+
+        if args.verbose:
+            print(f"Fetching {len(user_stats_pks)} UserStats accounts in batches of "
+                  f"{MAX_ACCOUNTS_PER_REQUEST} ({args.concurrency} requests in flight)...")
+
+        fetcher = AccountFetcher(connection, max_concurrency=args.concurrency, max_retries=args.max_retries)
+        queue = asyncio.Queue(maxsize=args.concurrency * 4)
+        producer = asyncio.create_task(fetcher.stream(user_stats_pks, queue))
+
+        count = 0
+        missing = 0
+        undecodable = 0
+
         # Open CSV file for writing
         with open(args.output, 'w', newline='') as csvfile:
             writer = csv.writer(csvfile)
@@ -193,63 +210,44 @@ async def main():
             # Write headers
             writer.writerow(get_csv_headers())
             
-            # Counter for progress
-            count = 0
-            processed_authorities = set() # To avoid processing duplicate authorities if User accounts share one
-            
-            for user_account_wrapper in all_user_account_wrappers:
-                user_data = user_account_wrapper.account
-                authority_pk = user_data.authority
-
-                if str(authority_pk) in processed_authorities:
-                    if args.verbose:
-                        print(f"Authority {authority_pk} already processed (from another User subaccount). Skipping UserStats derivation.")
-                    continue
-                
-                processed_authorities.add(str(authority_pk))
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                index, batch_pks, _, accounts = item
+                batch_authorities = authorities[index * fetcher.batch_size:(index + 1) * fetcher.batch_size]
 
-                try:
-                    # Derive UserStats account public key
-                    user_stats_account_pk = get_user_stats_account_public_key(authority_pk, drift_client.program_id)
-                    
-                    if args.verbose:
-                        print(f"Fetching UserStats for authority {authority_pk} (UserStats PK: {user_stats_account_pk})...")
-                        
-                    # Fetch the UserStats account data directly
-                    user_stats_data = await drift_client.program.account['UserStats'].fetch(user_stats_account_pk)
-                    
-                    if not user_stats_data:
+                rows = []
+                for authority_pk, user_stats_account_pk, account in zip(batch_authorities, batch_pks, accounts):
+                    if account is None:
+                        missing += 1
+                        continue
+                    try:
+                        user_stats_data = decode_user_stats(account.data)
+                    except ValueError as e:
+                        undecodable += 1
                         if args.verbose:
-                            print(f"No UserStats data found for UserStats account {user_stats_account_pk} (Authority: {authority_pk}). Skipping.")
+                            print(f"Skipping UserStats {user_stats_account_pk} (Authority: {authority_pk}): {e}")
                         continue
-
-                    # Create row data
                     # Pass the authority_pk from the User account as the primary authority identifier
-                    row = flatten_user_stats_to_row(
-                        str(authority_pk), 
-                        str(user_stats_account_pk),
-                        user_stats_data
-                    )
-                    
-                    # Write to CSV
-                    writer.writerow(row)
-                    
-                    count += 1
-                    if args.verbose and count % 100 == 0:
-                        print(f"Processed {count} UserStats accounts...")
-                        
-                except Exception as e: # Broad catch, specific errors like AccountDoesNotExistError could be handled
-                    if args.verbose:
-                        # Example of how to check for specific errors if needed:
-                        # from anchorpy.error import AccountDoesNotExistError
-                        # if isinstance(e, AccountDoesNotExistError):
-                        #    print(f"UserStats account {user_stats_account_pk} not found for authority {authority_pk}. Skipping.")
-                        # else:
-                        print(f"Error processing UserStats for authority {authority_pk} (UserStats PK: {user_stats_account_pk if 'user_stats_account_pk' in locals() else 'unknown'}): {e}")
-                    continue
-        
+                    rows.append(flatten_user_stats_to_row(str(authority_pk), str(user_stats_account_pk), user_stats_data))
+
+                writer.writerows(rows)
+                count += len(rows)
+                if args.verbose:
+                    print(f"Processed {count} UserStats accounts...")
+
+        await producer
+
         print(f"\nExport complete!")
         print(f"Total UserStats accounts exported: {count}")
+        print(f"Authorities without a UserStats account: {missing}")
+        if undecodable:
+            print(f"Accounts that failed to decode: {undecodable}")
+        if fetcher.stats.failed_batches:
+            failed_keys = len(fetcher.stats.failed_batches) * fetcher.batch_size
+            print(f"WARNING: {len(fetcher.stats.failed_batches)} batches (up to {failed_keys} authorities) "
+                  f"failed after {args.max_retries} retries and are not in the export")
         print(f"Output saved to: {args.output}")
         
         # No UserStatsMap to unsubscribe from
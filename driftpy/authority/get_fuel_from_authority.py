@@ -6,8 +6,9 @@ This script displays the fuel balance for a given Drift Protocol authority addre
 It leverages the drift-labs/driftpy SDK and uses VAT (vat of pickles) to cache
 on-chain data and reduce RPC calls.
 
-The script maintains only a single VAT directory for caching data. When a new VAT is created,
-all previous VAT directories are automatically deleted to save disk space.
+VAT snapshots are managed by the shared vat_cache.VatCache (../vat_cache.py). By default only
+the newest snapshot is kept; see --keep-snapshots and --snapshot-max-age. With --full-snapshot-every N
+only every Nth snapshot is written in full and the others hold just the changed users and user stats.
 
 Usage:
     python get_fuel.py --authority <AUTHORITY_ADDRESS> [--rpc-url <RPC_URL>] [--force-refresh] [--pickle-dir <DIRECTORY>]
@@ -28,10 +29,10 @@ Environment Variables:
 import argparse
 import asyncio
 import os
+import sys
 import time
 import datetime
-import shutil
-from typing import Optional, Dict, Tuple
+from typing import Optional
 from pathlib import Path
 
 from solders.pubkey import Pubkey
@@ -53,6 +54,11 @@ from driftpy.user_map.user_map_config import UserStatsMapConfig
 from solana.rpc.async_api import AsyncClient
 from dotenv import load_dotenv
 
+# Shared helpers live one directory up, next to the other driftpy scripts
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from pda_cache import get_user_stats_account_public_key
+from vat_cache import SnapshotManifest, VatCache
+
 # Load environment variables
 load_dotenv()
 
@@ -60,90 +66,11 @@ load_dotenv()
 DEFAULT_PICKLE_DIR = "../fuel_pickles"
 DEFAULT_MAX_PICKLE_AGE = 3600  # 1 hour
 
-def get_user_stats_account_public_key(authority: Pubkey, program_id: Pubkey) -> Pubkey:
-    """
-    Derives the userStats account public key for a given authority.
-    """
-    user_stats_account_pk, _ = Pubkey.find_program_address(
-        [b'user_stats', bytes(authority)],
-        program_id
-    )
-    return user_stats_account_pk
-
-def get_newest_pickle_set(directory: str) -> Tuple[Optional[Dict[str, str]], Optional[float]]:
-    """
-    Find the newest set of pickle files in the given directory.
-    Returns a tuple of (file_dict, timestamp_in_seconds) or (None, None) if no valid files found.
-    """
-    if not os.path.exists(directory):
-        return None, None
-    
-    # Look for pickle files that start with vat- prefix
-    subdirs = [d for d in os.listdir(directory) if d.startswith("vat-") and os.path.isdir(os.path.join(directory, d))]
-    if not subdirs:
-        return None, None
-    
-    # Since we now maintain only one VAT directory, just take the first one
-    # (but still sort by timestamp to be safe)
-    subdirs.sort(reverse=True)
-    subdir = subdirs[0]
-    path = os.path.join(directory, subdir)
-    
-    # Check if this is a complete pickle set with all required files
-    required_prefixes = ["perp_", "spot_", "usermap_", "userstats_", "perporacles_", "spotoracles_"]
-    files_present = []
-    
-    for f in os.listdir(path):
-        if f.endswith(".pkl") and any(f.startswith(prefix) for prefix in required_prefixes):
-            files_present.append(f)
-            
-    # Check if all required file types are present
-    if all(any(f.startswith(prefix) for f in files_present) for prefix in required_prefixes):
-        # Extract datetime from directory name
-        try:
-            # Format is vat-%Y-%m-%d-%H-%M-%S
-            date_part = subdir[4:]  # Remove 'vat-' prefix
-            dt = datetime.datetime.strptime(date_part, "%Y-%m-%d-%H-%M-%S")
-            timestamp = dt.timestamp()
-            
-            # Create a map of file types to full paths
-            file_map = {}
-            for prefix in required_prefixes:
-                prefix_base = prefix.rstrip("_")
-                matching_files = [f for f in files_present if f.startswith(prefix)]
-                if matching_files:
-                    # Sort by slot number to get the newest file - more robust parsing
-                    def get_slot_number(filename):
-                        try:
-                            # Remove .pkl extension first
-                            name_without_ext = filename.rsplit('.', 1)[0]
-                            # Split by underscore and get the last part
-                            parts = name_without_ext.split('_')
-                            if len(parts) > 1:
-                                return int(parts[-1])
-                            return 0
-                        except (ValueError, IndexError):
-                            return 0
-                    
-                    matching_files.sort(key=get_slot_number, reverse=True)
-                    file_map[prefix_base] = os.path.join(path, matching_files[0])
-            
-            return file_map, timestamp
-        except Exception as e:
-            print(f"Error parsing timestamp from directory {subdir}: {e}")
-    
-    return None, None
-
-def is_pickle_fresh(timestamp: float, max_age_seconds: int = 3600) -> bool:
-    """Check if a pickle is fresh enough (less than max_age_seconds old)"""
-    current_time = time.time()
-    age = current_time - timestamp
-    return age < max_age_seconds
-
 class FuelBalanceChecker:
     """Class for checking fuel balances using VAT caching"""
     
-    def __init__(self, connection, pickle_dir: str = DEFAULT_PICKLE_DIR, force_refresh: bool = False, max_pickle_age: int = DEFAULT_MAX_PICKLE_AGE):
+    def __init__(self, connection, pickle_dir: str = DEFAULT_PICKLE_DIR, force_refresh: bool = False, max_pickle_age: int = DEFAULT_MAX_PICKLE_AGE,
+                 keep_snapshots: int = 1, snapshot_max_age: Optional[int] = None, full_snapshot_every: int = 1):
         """Initialize with connection and pickle settings"""
         # Generate a random keypair - we're only reading data, not signing transactions
         kp = Keypair()
@@ -168,20 +95,20 @@ class FuelBalanceChecker:
         self.using_pickled_data = False
         self.pickle_timestamp = None
         
-        # Create pickle directory if it doesn't exist
-        if not os.path.exists(self.pickle_dir):
-            os.makedirs(self.pickle_dir)
+        # Snapshot cache (creates the pickle directory if it doesn't exist)
+        self.vat_cache = VatCache(pickle_dir, keep_last=keep_snapshots, max_age_seconds=snapshot_max_age,
+                                  full_every=full_snapshot_every)
 
     async def initialize(self):
         """Initialize the drift client and maps, using pickled data if available and fresh"""
         # First check if we have fresh pickle data available
         if not self.force_refresh:
-            pickle_files, timestamp = get_newest_pickle_set(self.pickle_dir)
-            if pickle_files and timestamp and is_pickle_fresh(timestamp, self.max_pickle_age):
-                print(f"Using pickled data from {datetime.datetime.fromtimestamp(timestamp)}")
-                self.pickle_timestamp = timestamp
+            manifest = self.vat_cache.newest()
+            if manifest and manifest.is_fresh(self.max_pickle_age):
+                print(f"Using pickled data from {datetime.datetime.fromtimestamp(manifest.data_time)}")
+                self.pickle_timestamp = manifest.data_time
                 self.using_pickled_data = True
-                success = await self.load_from_pickle(pickle_files)
+                success = await self.load_from_pickle(manifest)
                 if success:
                     return
                 else:
@@ -238,8 +165,8 @@ class FuelBalanceChecker:
             self.stats_map.subscribe(),
         )
 
-    async def load_from_pickle(self, pickle_files: Dict[str, str]) -> bool:
-        """Load data from pickle files, returns True if successful, False otherwise"""
+    async def load_from_pickle(self, manifest: SnapshotManifest) -> bool:
+        """Load data from a snapshot's pickle files, returns True if successful, False otherwise"""
         try:
             # Note: When using pickle data, we don't need to subscribe to the drift client or any maps
             # Create the maps but don't subscribe to them
@@ -281,17 +208,12 @@ class FuelBalanceChecker:
             
             # Debug: Print the pickle files being loaded
             print("Pickle files to load:")
-            for key, value in pickle_files.items():
+            for key, value in self.vat_cache.file_map(manifest).items():
                 print(f"  {key}: {value}")
+            if self.vat_cache.is_replayed(manifest, "usermap"):
+                print(f"  (delta usermap; replaying from {self.vat_cache.chain(manifest)[0].name})")
             
-            await self.vat.unpickle(
-                users_filename=pickle_files.get('usermap'),
-                user_stats_filename=pickle_files.get('userstats'),
-                spot_markets_filename=pickle_files.get('spot'),
-                perp_markets_filename=pickle_files.get('perp'),
-                spot_oracles_filename=pickle_files.get('spotoracles'),
-                perp_oracles_filename=pickle_files.get('perporacles'),
-            )
+            await self.vat_cache.load(self.vat, manifest)
             return True
         except Exception as e:
             print(f"Error loading from pickle: {str(e)}")
@@ -305,34 +227,10 @@ class FuelBalanceChecker:
         if not self.vat:
             return
         
-        # Create timestamped directory for the new pickle set
-        now = datetime.datetime.now()
-        folder_name = now.strftime("vat-%Y-%m-%d-%H-%M-%S")
-        path = os.path.join(self.pickle_dir, folder_name, "")
+        manifest = await self.vat_cache.save(self.vat)
+        self.pickle_timestamp = manifest.data_time
         
-        os.makedirs(path, exist_ok=True)
-        pickle_files = await self.vat.pickle(path)
-        self.pickle_timestamp = now.timestamp()
-        print(f"Saved fresh data to {path}")
-        
-        # Delete all previous VAT directories
-        self._delete_old_vat_dirs(except_dir=folder_name)
-        
-        return pickle_files
-
-    def _delete_old_vat_dirs(self, except_dir=None):
-        """Delete all VAT directories except the one specified"""
-        if not os.path.exists(self.pickle_dir):
-            return
-            
-        for item in os.listdir(self.pickle_dir):
-            item_path = os.path.join(self.pickle_dir, item)
-            if os.path.isdir(item_path) and item.startswith("vat-") and item != except_dir:
-                try:
-                    shutil.rmtree(item_path)
-                    print(f"Deleted old VAT directory: {item}")
-                except Exception as e:
-                    print(f"Warning: Failed to delete old VAT directory {item}: {e}")
+        return self.vat_cache.file_map(manifest)
 
     async def cleanup(self):
         """Clean up connections"""
@@ -416,6 +314,9 @@ async def main():
     parser.add_argument("--pickle-dir", type=str, default=DEFAULT_PICKLE_DIR, help=f"Directory for caching VAT data (default: {DEFAULT_PICKLE_DIR}).")
     parser.add_argument("--force-refresh", action="store_true", help="Ignore cache and fetch fresh data from the network.")
     parser.add_argument("--max-pickle-age", type=int, default=DEFAULT_MAX_PICKLE_AGE, help=f"Maximum age of a pickle file in seconds to be considered fresh (default: {DEFAULT_MAX_PICKLE_AGE}).")
+    parser.add_argument("--keep-snapshots", type=int, default=1, help="Number of VAT snapshots to keep (default: 1).")
+    parser.add_argument("--snapshot-max-age", type=int, default=None, help="Also delete VAT snapshots older than this many seconds.")
+    parser.add_argument("--full-snapshot-every", type=int, default=1, help="Write a full VAT snapshot every N snapshots and only changed users/user stats in between (default: 1, always full).")
 
     args = parser.parse_args()
 
@@ -427,7 +328,10 @@ async def main():
         connection,
         pickle_dir=args.pickle_dir,
         force_refresh=args.force_refresh,
-        max_pickle_age=args.max_pickle_age
+        max_pickle_age=args.max_pickle_age,
+        keep_snapshots=args.keep_snapshots,
+        snapshot_max_age=args.snapshot_max_age,
+        full_snapshot_every=args.full_snapshot_every
     )
 
     authority_to_use = None
@@ -3,6 +3,8 @@
 import argparse
 import asyncio
 import os
+import sys
+from pathlib import Path
 
 from solders.pubkey import Pubkey  # type: ignore
 from solders.keypair import Keypair # type: ignore
@@ -12,15 +14,9 @@ from driftpy.account_subscription_config import AccountSubscriptionConfig
 from solana.rpc.async_api import AsyncClient
 from dotenv import load_dotenv
 
-def get_user_stats_account_public_key(authority: Pubkey, program_id: Pubkey) -> Pubkey:
-    """
-    Derives the userStats account public key for a given authority.
-    """
-    user_stats_account_pk, _ = Pubkey.find_program_address(
-        [b'user_stats', bytes(authority)],
-        program_id
-    )
-    return user_stats_account_pk
+# Shared helpers live one directory up, next to the other driftpy scripts
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from pda_cache import get_user_stats_account_public_key
 
 async def main():
     parser = argparse.ArgumentParser(description="Get userStats account public key for a Drift authority or user account.")
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Authority -> sub-account index for a driftpy UserMap
+
+UserMap is keyed by user account pubkey, so finding an authority's sub-accounts
+means scanning every user and comparing authorities. AuthorityIndex keeps a
+secondary authority -> {user account pubkey} map next to a UserMap and keeps it
+current as the map changes:
+
+    - add_pubkey() (used by sync, load/unpickle and websocket updates for new
+      accounts) indexes the added user
+    - sync() drops accounts the refresh removed
+    - clear() empties the index
+
+An account's authority never changes, so websocket updates to existing users
+need no index work. Lookups are O(number of sub-accounts).
+
+Usage:
+    from authority_index import AuthorityIndex
+
+    user_map = UserMap(...)
+    index = AuthorityIndex(user_map)   # attach before subscribe/unpickle, or after: it indexes what is there
+    users = index.get_users(authority)
+"""
+
+from typing import Dict, List, Optional, Set, Union
+
+from solders.pubkey import Pubkey # type: ignore
+
+from driftpy.drift_user import DriftUser
+
+
+class AuthorityIndex:
+    """Secondary authority index maintained alongside a UserMap"""
+
+    def __init__(self, user_map, attach: bool = True):
+        """
+        Args:
+            user_map: driftpy UserMap to index
+            attach: Hook the UserMap so the index follows its updates
+        """
+        self.user_map = user_map
+        self._by_authority: Dict[Pubkey, Set[str]] = {}
+        self._authority_of: Dict[str, Pubkey] = {}
+        if attach:
+            self.attach()
+        self.rebuild()
+
+    def attach(self):
+        """Wrap the UserMap's add_pubkey, sync and clear so the index stays current"""
+        user_map = self.user_map
+        original_add_pubkey = user_map.add_pubkey
+        original_sync = user_map.sync
+        original_clear = user_map.clear
+
+        async def add_pubkey(user_account_public_key, data=None):
+            await original_add_pubkey(user_account_public_key, data)
+            key = str(user_account_public_key)
+            user = user_map.get(key)
+            if user is not None:
+                self._index_user(key, user)
+
+        async def sync():
+            await original_sync()
+            self.prune()
+
+        def clear():
+            original_clear()
+            self._by_authority.clear()
+            self._authority_of.clear()
+
+        user_map.add_pubkey = add_pubkey
+        user_map.sync = sync
+        user_map.clear = clear
+
+    def rebuild(self):
+        """Index every user currently in the map"""
+        self._by_authority.clear()
+        self._authority_of.clear()
+        for key, user in self.user_map.user_map.items():
+            self._index_user(key, user)
+
+    def prune(self):
+        """Drop index entries for accounts no longer in the map"""
+        for key in [k for k in self._authority_of if not self.user_map.has(k)]:
+            self.remove(key)
+
+    def remove(self, user_account_key: str):
+        authority = self._authority_of.pop(user_account_key, None)
+        if authority is None:
+            return
+        keys = self._by_authority.get(authority)
+        if keys is not None:
+            keys.discard(user_account_key)
+            if not keys:
+                del self._by_authority[authority]
+
+    def get_user_keys(self, authority: Union[Pubkey, str]) -> List[str]:
+        """User account pubkeys (as strings) belonging to an authority"""
+        if isinstance(authority, str):
+            authority = Pubkey.from_string(authority)
+        return list(self._by_authority.get(authority, ()))
+
+    def get_users(self, authority: Union[Pubkey, str]) -> List[DriftUser]:
+        """DriftUser objects for every sub-account of an authority, ordered by sub-account id"""
+        users = [self.user_map.get(key) for key in self.get_user_keys(authority)]
+        users = [user for user in users if user is not None]
+        users.sort(key=lambda user: user.get_user_account().sub_account_id)
+        return users
+
+    def __len__(self) -> int:
+        return len(self._by_authority)
+
+    def _index_user(self, key: str, user: DriftUser):
+        authority = self._authority_from_user(user)
+        if authority is None:
+            return
+        previous = self._authority_of.get(key)
+        if previous is not None and previous != authority:
+            self.remove(key)
+        self._authority_of[key] = authority
+        self._by_authority.setdefault(authority, set()).add(key)
+
+    @staticmethod
+    def _authority_from_user(user: DriftUser) -> Optional[Pubkey]:
+        try:
+            return user.get_user_account().authority
+        except Exception as e:
+            print(f"Error checking user authority: {e}")
+            return None
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Columnar (Parquet) output for the bulk exports
+
+The exporters write CSV with every integer stringified, and the analysis tools
+parse it all back. Written with --format parquet instead, the same rows go into
+a typed Parquet file: integer columns stay u64/i64, pubkey columns that repeat
+(authority, referrer) are dictionary-encoded, and pages are zstd-compressed.
+Rows are buffered and written one row group at a time, so an export never holds
+more than one row group of Arrow data.
+
+pyarrow is optional. It is imported when Parquet is actually written or read;
+CSV exports work without it.
+
+Column specs are (name, type) pairs, with type one of COLUMN_TYPES:
+
+    pubkey   base58 string, dictionary-encoded
+    str      plain string (e.g. a UserStats address, unique per row)
+    bool, u8, u16, u32, u64, i64, f64
+
+Usage:
+    from columnar_export import open_row_writer, read_frame, is_parquet_path
+
+    columns = [("authority", "pubkey"), ("fuel_taker", "u64"), ...]
+    with open_row_writer("export.parquet", columns, "parquet") as writer:
+        writer.writerows(rows)          # the same row lists csv.writer takes
+
+    df = read_frame("export.parquet", ["authority", "fuel_taker"])
+
+    for chunk in iter_frames("export.csv", ["authority", "fuel_taker"], chunk_rows=1_000_000):
+        ...                             # CSV or Parquet, one bounded DataFrame at a time
+"""
+
+import os
+import csv
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+COLUMN_TYPES = ("pubkey", "str", "bool", "u8", "u16", "u32", "u64", "i64", "f64")
+OUTPUT_FORMATS = ("csv", "parquet")
+PARQUET_SUFFIXES = (".parquet", ".pq")
+
+# Rows per Parquet row group
+DEFAULT_ROW_GROUP_ROWS = 128 * 1024
+
+
+def require_pyarrow():
+    """Import pyarrow and pyarrow.parquet, with an install hint if they are missing"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError(f"Parquet support needs pyarrow (pip install pyarrow): {e}") from e
+    return pa, pq
+
+
+def is_parquet_path(path) -> bool:
+    return str(path).lower().endswith(PARQUET_SUFFIXES)
+
+
+def output_suffix(fmt: str) -> str:
+    return ".parquet" if fmt == "parquet" else ".csv"
+
+
+def arrow_schema(columns: Sequence[Tuple[str, str]]):
+    """pyarrow schema for (name, type) column specs"""
+    pa, _ = require_pyarrow()
+    types = {
+        "pubkey": pa.dictionary(pa.int32(), pa.string()),
+        "str": pa.string(),
+        "bool": pa.bool_(),
+        "u8": pa.uint8(),
+        "u16": pa.uint16(),
+        "u32": pa.uint32(),
+        "u64": pa.uint64(),
+        "i64": pa.int64(),
+        "f64": pa.float64(),
+    }
+    return pa.schema([pa.field(name, types[kind]) for name, kind in columns])
+
+
+def rows_to_table(schema, rows: Sequence[Sequence]):
+    """Arrow table from row lists (one value per schema field, in order)"""
+    pa, _ = require_pyarrow()
+    values = list(zip(*rows)) if rows else [() for _ in schema]
+    arrays = []
+    for field, column in zip(schema, values):
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(column, field.type.value_type).dictionary_encode())
+        else:
+            arrays.append(pa.array(column, field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+class ParquetRowWriter:
+    """
+    csv.writer-style sink that streams rows into a Parquet file.
+
+    The file is written under a temporary name and renamed into place on close(), so a
+    crashed export never leaves a truncated Parquet file at `path`.
+    """
+
+    def __init__(self, path, columns: Sequence[Tuple[str, str]], row_group_rows: int = DEFAULT_ROW_GROUP_ROWS,
+                 compression: str = "zstd"):
+        pa, pq = require_pyarrow()
+        self._pa = pa
+        self.path = Path(path)
+        self.schema = arrow_schema(columns)
+        self.row_group_rows = row_group_rows
+        self.rows_written = 0
+        self._rows: List[Sequence] = []
+        self._tables: list = []
+        self._buffered = 0
+        self._tmp_path = self.path.with_name(f"{self.path.name}.tmp-{os.getpid()}")
+        self._writer = pq.ParquetWriter(str(self._tmp_path), self.schema, compression=compression)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self._writer.close()
+            self._tmp_path.unlink(missing_ok=True)
+
+    def writerow(self, row: Sequence):
+        self._rows.append(row)
+        self._buffered += 1
+        if self._buffered >= self.row_group_rows:
+            self.flush()
+
+    def writerows(self, rows: Iterable[Sequence]):
+        for row in rows:
+            self.writerow(row)
+
+    def write_table(self, table):
+        """Append an Arrow table that already has this writer's schema"""
+        self._tables.append(table)
+        self._buffered += table.num_rows
+        if self._buffered >= self.row_group_rows:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            self._tables.append(rows_to_table(self.schema, self._rows))
+            self._rows = []
+        if not self._tables:
+            return
+        table = self._pa.concat_tables(self._tables)
+        self._writer.write_table(table, row_group_size=self.row_group_rows)
+        self.rows_written += table.num_rows
+        self._tables = []
+        self._buffered = 0
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+        os.replace(self._tmp_path, self.path)
+
+
+class CsvRowWriter:
+    """csv.writer over a file opened for writing, with the header row already written"""
+
+    def __init__(self, path, columns: Sequence[Tuple[str, str]]):
+        self.path = Path(path)
+        self._file = open(self.path, "w", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow([name for name, _ in columns])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def writerow(self, row: Sequence):
+        self._writer.writerow(row)
+
+    def writerows(self, rows: Iterable[Sequence]):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+def open_row_writer(path, columns: Sequence[Tuple[str, str]], fmt: str = "csv"):
+    """A CsvRowWriter or ParquetRowWriter for `path`, depending on `fmt` ("csv" or "parquet")"""
+    if fmt == "parquet":
+        return ParquetRowWriter(path, columns)
+    return CsvRowWriter(path, columns)
+
+
+def csv_to_parquet(segments: Iterable, output, columns: Sequence[Tuple[str, str]]) -> int:
+    """
+    Convert headerless CSV files (e.g. checkpoint segments) with the given columns into one
+    Parquet file, parsing them with pyarrow's CSV reader. Empty files are skipped; with no
+    rows at all the output holds just the schema. Returns the number of rows written.
+    """
+    require_pyarrow()
+    from pyarrow import csv as pa_csv
+
+    with ParquetRowWriter(output, columns) as writer:
+        read_options = pa_csv.ReadOptions(column_names=[name for name, _ in columns])
+        convert_options = pa_csv.ConvertOptions(
+            column_types={field.name: field.type for field in writer.schema},
+            strings_can_be_null=False,
+        )
+        for segment in segments:
+            if os.path.getsize(segment) == 0:
+                # pyarrow rejects an empty CSV file
+                continue
+            table = pa_csv.read_csv(str(segment), read_options=read_options, convert_options=convert_options)
+            writer.write_table(table)
+    return writer.rows_written
+
+
+def read_table(path, columns: Optional[Sequence[str]] = None):
+    """Read a Parquet export as an Arrow table; dictionary-encoded columns are decoded to strings"""
+    pa, pq = require_pyarrow()
+    table = pq.read_table(str(path), columns=list(columns) if columns is not None else None)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(field.type.value_type))
+    return table
+
+
+def read_frame(path, columns: Optional[Sequence[str]] = None):
+    """Read a Parquet export into a pandas DataFrame (pubkey columns as plain strings)"""
+    return read_table(path, columns).to_pandas()
+
+
+def column_names(path) -> List[str]:
+    """Column names of a CSV (header row) or Parquet export"""
+    if is_parquet_path(path):
+        _, pq = require_pyarrow()
+        return list(pq.ParquetFile(str(path)).schema_arrow.names)
+    import pandas as pd
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def iter_frames(path, columns: Sequence[str], chunk_rows: int) -> Iterator:
+    """
+    Stream `columns` of a CSV or Parquet export as pandas DataFrames of at most `chunk_rows` rows.
+    Dictionary-encoded (pubkey) columns come back as plain strings.
+    """
+    import pandas as pd
+
+    if is_parquet_path(path):
+        pa, pq = require_pyarrow()
+        for batch in pq.ParquetFile(str(path)).iter_batches(batch_size=chunk_rows, columns=list(columns)):
+            arrays = [
+                array.cast(array.type.value_type) if pa.types.is_dictionary(array.type) else array
+                for array in batch.columns
+            ]
+            yield pa.Table.from_arrays(arrays, names=batch.schema.names).to_pandas()
+        return
+
+    yield from pd.read_csv(path, usecols=list(columns), chunksize=chunk_rows)
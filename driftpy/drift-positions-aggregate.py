@@ -6,11 +6,25 @@ This script displays aggregated positions across all users in the Drift Protocol
 It leverages the drift-labs/driftpy SDK to fetch and display total notional value
 of all positions in the system, grouped by market.
 
-The script maintains only a single VAT directory for caching data. When a new VAT is created,
-all previous VAT directories are automatically deleted to save disk space.
+VAT snapshots are managed by vat_cache.VatCache. Each snapshot directory carries a manifest and
+the pickle directory keeps a small index of the newest complete snapshot. By default only the
+newest snapshot is kept; see --keep-snapshots and --snapshot-max-age. With --full-snapshot-every N
+only every Nth snapshot is written in full and the others hold just the changed users and user stats.
+
+By default aggregation uses the original per-user SDK path (exact SDK math including LP
+settlement and spot open-order worst cases). --engine process runs that same per-user math
+sharded across a process pool (--workers). --engine numpy opts into the vectorized NumPy engine
+in position_engine.py, which works on raw User account bytes and never builds DriftUser objects;
+it is much faster but approximate, since it skips LP settlement and the spot open-order worst case.
+
+--watch keeps running instead: per-market aggregates are held in memory and each websocket
+account update replaces only that account's contribution. Totals are printed every
+--watch-interval seconds and fully recomputed at current prices every --rebuild-interval.
 
 Usage:
     python drift-positions-aggregate.py [--rpc <RPC_URL>] [--force-refresh] [--pickle-dir <DIRECTORY>]
+                                        [--engine {python,process,numpy}] [--workers N]
+                                        [--watch [--watch-interval SECONDS] [--rebuild-interval SECONDS]]
 
 Requirements:
     - Python 3.7+
@@ -19,6 +33,7 @@ Requirements:
     - solders
     - solana
     - dotenv
+    - numpy
 
 Environment Variables:
     RPC_URL: Solana RPC endpoint URL
@@ -32,7 +47,8 @@ import time
 import datetime
 from pathlib import Path
 from typing import Dict, List, Optional, Any, Tuple
-from collections import defaultdict
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 from anchorpy import Wallet
 from dotenv import load_dotenv
@@ -44,7 +60,6 @@ from driftpy.drift_user import DriftUser
 from driftpy.user_map.user_map import UserMap
 from driftpy.user_map.user_map_config import UserMapConfig, PollingConfig
 from driftpy.user_map.user_map_config import WebsocketConfig as UserMapWebsocketConfig
-from driftpy.constants.numeric_constants import QUOTE_SPOT_MARKET_INDEX
 from driftpy.types import SpotPosition, PerpPosition, MarketType
 from driftpy.market_map.market_map import MarketMap
 from driftpy.market_map.market_map_config import MarketMapConfig
@@ -53,6 +68,13 @@ from driftpy.pickle.vat import Vat
 from driftpy.user_map.userstats_map import UserStatsMap
 from driftpy.user_map.user_map_config import UserStatsMapConfig
 from driftpy.account_subscription_config import AccountSubscriptionConfig
+from driftpy.accounts.types import DataAndSlot
+from driftpy.decode.user import decode_user
+
+from vat_cache import SnapshotManifest, VatCache
+from position_engine import PositionArrays, MarketArrays, aggregate_positions
+from market_metadata import MarketMetadata
+from oracle_snapshot import OracleSnapshot
 
 # Load environment variables
 load_dotenv()
@@ -70,68 +92,302 @@ def format_number(number: float, decimals: int = 4, use_commas: bool = True) ->
     else:
         return f"{number:.{decimals}f}"
 
-def get_newest_pickle_set(directory: str) -> Tuple[Optional[Dict[str, str]], Optional[float]]:
+def new_partial_aggregate() -> Dict[str, Any]:
+    """Empty partial aggregate; unique users are kept as authority sets until finalized"""
+    return {
+        "perp_markets": {},
+        "spot_markets": {},
+        "authorities": set(),
+        "total_sub_accounts": 0,
+        "total_net_value": 0.0,
+    }
+
+def _new_perp_aggregate() -> Dict[str, Any]:
+    return {
+        "market_name": "",
+        "total_long_usd": 0.0,
+        "total_short_usd": 0.0,
+        "total_lp_shares": 0,
+        "current_price": 0.0,
+        "unique_users": set()
+    }
+
+def _new_spot_aggregate() -> Dict[str, Any]:
+    return {
+        "market_name": "",
+        "total_deposits_native": 0.0,
+        "total_borrows_native": 0.0,
+        "total_deposits_usd": 0.0,
+        "total_borrows_usd": 0.0,
+        "token_price": 0.0,
+        "decimals": 0,
+        "unique_users": set()
+    }
+
+def accumulate_user(metadata: MarketMetadata, user: DriftUser, partial: Dict[str, Any]):
+    """Add one sub-account's positions to a partial aggregate (call metadata.refresh() once per pass first)"""
+    perp_aggregates = partial["perp_markets"]
+    spot_aggregates = partial["spot_markets"]
+    try:
+        user_account = user.get_user_account()
+        authority = str(user_account.authority)
+        partial["authorities"].add(authority)
+        partial["total_sub_accounts"] += 1
+        partial["total_net_value"] += user.get_net_usd_value() / 1e6
+        
+        # Process perpetual positions
+        perp_positions = user.get_active_perp_positions()
+        for position in perp_positions:
+            market_info = metadata.perp(position.market_index)
+            oracle_price_data = user.get_oracle_data_for_perp_market(position.market_index)
+            
+            agg = perp_aggregates.setdefault(position.market_index, _new_perp_aggregate())
+            agg["market_name"] = market_info.name
+            agg["current_price"] = oracle_price_data.price / 1e6
+            
+            position_value = abs(user.get_perp_position_value(
+                position.market_index,
+                oracle_price_data,
+                include_open_orders=True
+            ) / 1e6)
+            
+            base_asset_amount = position.base_asset_amount / market_info.precision
+            if base_asset_amount > 0:
+                agg["total_long_usd"] += position_value
+            else:
+                agg["total_short_usd"] += position_value
+            
+            agg["total_lp_shares"] += position.lp_shares / 1e9
+            agg["unique_users"].add(authority)
+        
+        # Process spot positions
+        spot_positions = user.get_active_spot_positions()
+        for position in spot_positions:
+            market_info = metadata.spot(position.market_index)
+            
+            agg = spot_aggregates.setdefault(position.market_index, _new_spot_aggregate())
+            agg["market_name"] = market_info.name
+            agg["decimals"] = market_info.decimals
+            
+            token_amount = user.get_token_amount(position.market_index)
+            formatted_amount = token_amount / market_info.precision
+            
+            if market_info.is_quote:
+                token_price = 1.0
+                token_value = abs(formatted_amount)
+            else:
+                oracle_price_data = user.get_oracle_data_for_spot_market(position.market_index)
+                token_price = oracle_price_data.price / 1e6
+                if token_amount < 0:
+                    token_value = abs(user.get_spot_market_liability_value(
+                        market_index=position.market_index,
+                        include_open_orders=True
+                    ) / 1e6)
+                else:
+                    token_value = abs(user.get_spot_market_asset_value(
+                        market_index=position.market_index,
+                        include_open_orders=True
+                    ) / 1e6)
+            
+            agg["token_price"] = token_price
+            
+            if token_amount > 0:
+                agg["total_deposits_native"] += formatted_amount
+                agg["total_deposits_usd"] += token_value
+            else:
+                agg["total_borrows_native"] += abs(formatted_amount)
+                agg["total_borrows_usd"] += token_value
+            
+            agg["unique_users"].add(authority)
+            
+    except Exception as e:
+        print(f"Error processing user: {e}")
+
+def merge_partial_aggregate(into: Dict[str, Any], partial: Dict[str, Any]):
+    """Merge one partial aggregate into another (sums add, authority sets union)"""
+    into["authorities"] |= partial["authorities"]
+    into["total_sub_accounts"] += partial["total_sub_accounts"]
+    into["total_net_value"] += partial["total_net_value"]
+    for key, new_aggregate in (("perp_markets", _new_perp_aggregate), ("spot_markets", _new_spot_aggregate)):
+        for market_index, agg in partial[key].items():
+            target = into[key].setdefault(market_index, new_aggregate())
+            for field, value in agg.items():
+                if field == "unique_users":
+                    target[field] |= value
+                elif field.startswith("total_"):
+                    target[field] += value
+                else:
+                    # Names, prices and decimals are the same in every shard
+                    target[field] = value
+
+def finalize_partial_aggregate(partial: Dict[str, Any]) -> Dict[str, Any]:
+    """Turn a partial aggregate into get_all_user_positions() output"""
+    # Convert sets to counts for JSON serialization
+    for agg in partial["perp_markets"].values():
+        agg["unique_users"] = len(agg["unique_users"])
+    for agg in partial["spot_markets"].values():
+        agg["unique_users"] = len(agg["unique_users"])
+    
+    return {
+        "total_unique_authorities": len(partial["authorities"]),
+        "total_sub_accounts": partial["total_sub_accounts"],
+        "total_net_value": partial["total_net_value"],
+        "perp_markets": partial["perp_markets"],
+        "spot_markets": partial["spot_markets"],
+    }
+
+class IncrementalAggregates:
     """
-    Find the newest set of pickle files in the given directory.
-    Returns a tuple of (file_dict, timestamp_in_seconds) or (None, None) if no valid files found.
+    Protocol totals kept current one account at a time.
+
+    Each account's contribution (a single-user partial aggregate) is kept so an update can
+    subtract the old contribution and add the new one. Unique users are reference counts of
+    contributing sub-accounts per authority, so they can be decremented.
     """
-    if not os.path.exists(directory):
-        return None, None
-    
-    # Look for pickle files that start with vat- prefix
-    subdirs = [d for d in os.listdir(directory) if d.startswith("vat-") and os.path.isdir(os.path.join(directory, d))]
-    if not subdirs:
-        return None, None
+
+    def __init__(self, metadata: MarketMetadata):
+        self.metadata = metadata
+        self.contributions: Dict[str, Dict[str, Any]] = {}
+        self.ready = False
+        self._reset_totals()
+
+    def _reset_totals(self):
+        self.perp_markets: Dict[int, Dict[str, Any]] = {}
+        self.spot_markets: Dict[int, Dict[str, Any]] = {}
+        self.authorities: Counter = Counter()
+        self.total_sub_accounts = 0
+        self.total_net_value = 0.0
+
+    def rebuild(self, users: Dict[str, DriftUser]):
+        """Recompute every contribution (call with markets, metadata and oracles refreshed)"""
+        self.contributions = {}
+        self._reset_totals()
+        for key, user in users.items():
+            self._set(key, user)
+        self.ready = True
+
+    def update_account(self, key: str, user: Optional[DriftUser]):
+        """Replace one account's contribution after it changed (None removes it)"""
+        if not self.ready:
+            # The first rebuild picks up everything delivered before it
+            return
+        if user is None:
+            self.remove_account(key)
+        else:
+            self._set(key, user)
+
+    def remove_account(self, key: str):
+        old = self.contributions.pop(key, None)
+        if old is not None:
+            self._apply(old, -1)
+
+    def _set(self, key: str, user: DriftUser):
+        new = new_partial_aggregate()
+        accumulate_user(self.metadata, user, new)
+        self.remove_account(key)
+        self.contributions[key] = new
+        self._apply(new, 1)
+
+    def _apply(self, partial: Dict[str, Any], sign: int):
+        for authority in partial["authorities"]:
+            self._count(self.authorities, authority, sign)
+        self.total_sub_accounts += sign * partial["total_sub_accounts"]
+        self.total_net_value += sign * partial["total_net_value"]
+        for totals, key, new_aggregate in ((self.perp_markets, "perp_markets", _new_perp_aggregate),
+                                           (self.spot_markets, "spot_markets", _new_spot_aggregate)):
+            for market_index, agg in partial[key].items():
+                target = totals.get(market_index)
+                if target is None:
+                    target = totals[market_index] = new_aggregate()
+                    target["unique_users"] = Counter()
+                for field, value in agg.items():
+                    if field == "unique_users":
+                        for authority in value:
+                            self._count(target[field], authority, sign)
+                    elif field.startswith("total_"):
+                        target[field] += sign * value
+                    elif sign > 0:
+                        target[field] = value
+                if not target["unique_users"]:
+                    # No account holds this market any more
+                    del totals[market_index]
+
+    @staticmethod
+    def _count(counter: Counter, key: str, sign: int):
+        counter[key] += sign
+        if counter[key] <= 0:
+            del counter[key]
+
+    def result(self) -> Dict[str, Any]:
+        """Current totals in get_all_user_positions() form"""
+        def finalize(totals):
+            return {
+                market_index: {**agg, "unique_users": len(agg["unique_users"])}
+                for market_index, agg in totals.items()
+            }
+        return {
+            "total_unique_authorities": len(self.authorities),
+            "total_sub_accounts": self.total_sub_accounts,
+            "total_net_value": self.total_net_value,
+            "perp_markets": finalize(self.perp_markets),
+            "spot_markets": finalize(self.spot_markets),
+        }
+
+# Per-process state for --engine process workers
+_worker_drift_client: Optional[DriftClient] = None
+_worker_metadata: Optional[MarketMetadata] = None
+
+def _init_aggregation_worker(pickle_files: Dict[str, str]):
+    """Process pool initializer: load markets and oracles from the snapshot into a local DriftClient"""
+    global _worker_drift_client, _worker_metadata
+    from solders.keypair import Keypair # type: ignore
     
-    # Since we now maintain only one VAT directory, just take the first one
-    # (but still sort by timestamp to be safe)
-    subdirs.sort(reverse=True)
-    subdir = subdirs[0]
-    path = os.path.join(directory, subdir)
+    # Never contacted: the cached subscriber is filled from the snapshot files
+    drift_client = DriftClient(
+        AsyncClient("http://localhost"),
+        Wallet(Keypair()),
+        account_subscription=AccountSubscriptionConfig("cached")
+    )
+    spot_map = MarketMap(
+        MarketMapConfig(drift_client.program, MarketType.Spot(), MarketMapWebsocketConfig(), drift_client.connection)
+    )
+    perp_map = MarketMap(
+        MarketMapConfig(drift_client.program, MarketType.Perp(), MarketMapWebsocketConfig(), drift_client.connection)
+    )
     
-    # Check if this is a complete pickle set with all required files
-    required_prefixes = ["perp_", "spot_", "usermap_", "userstats_", "perporacles_", "spotoracles_"]
-    files_present = []
+    async def load_markets():
+        await spot_map.load(pickle_files.get('spot'))
+        await perp_map.load(pickle_files.get('perp'))
+    asyncio.run(load_markets())
     
-    for f in os.listdir(path):
-        if f.endswith(".pkl") and any(f.startswith(prefix) for prefix in required_prefixes):
-            files_present.append(f)
-            
-    # Check if all required file types are present
-    if all(any(f.startswith(prefix) for f in files_present) for prefix in required_prefixes):
-        # Extract datetime from directory name
-        try:
-            # Format is vat-%Y-%m-%d-%H-%M-%S
-            date_part = subdir[4:]  # Remove 'vat-' prefix
-            dt = datetime.datetime.strptime(date_part, "%Y-%m-%d-%H-%M-%S")
-            timestamp = dt.timestamp()
-            
-            # Create a map of file types to full paths
-            file_map = {}
-            for prefix in required_prefixes:
-                prefix_base = prefix.rstrip("_")
-                matching_files = [f for f in files_present if f.startswith(prefix)]
-                if matching_files:
-                    # Sort by slot number to get the newest file
-                    matching_files.sort(key=lambda x: int(x.split("_")[-1].split(".")[0]), reverse=True)
-                    file_map[prefix_base] = os.path.join(path, matching_files[0])
-            
-            return file_map, timestamp
-        except Exception as e:
-            print(f"Error parsing timestamp from directory {subdir}: {e}")
-    
-    return None, None
+    vat = Vat(drift_client, None, None, spot_map, perp_map)
+    vat.load_oracles(pickle_files.get('spotoracles'), pickle_files.get('perporacles'))
+    drift_client.resurrect(spot_map, perp_map, vat.spot_oracles, vat.perp_oracles)
+    _worker_drift_client = drift_client
+    _worker_metadata = MarketMetadata(drift_client)
+    _worker_metadata.refresh()
+    # Workers only ever price from the snapshot's oracle files
+    OracleSnapshot.from_vat(vat).pin(drift_client)
 
-def is_pickle_fresh(timestamp: float, max_age_seconds: int = 3600) -> bool:
-    """Check if a pickle is fresh enough (less than max_age_seconds old)"""
-    current_time = time.time()
-    age = current_time - timestamp
-    return age < max_age_seconds
+def _aggregate_shard(accounts: List[Tuple[str, bytes]]) -> Dict[str, Any]:
+    """Process pool task: decode a shard of raw User accounts and aggregate them"""
+    partial = new_partial_aggregate()
+    for pubkey, raw in accounts:
+        user = DriftUser(
+            _worker_drift_client,
+            user_public_key=Pubkey.from_string(str(pubkey)),
+            account_subscription=AccountSubscriptionConfig("cached"),
+        )
+        user.account_subscriber.update_data(DataAndSlot(0, decode_user(raw)))
+        accumulate_user(_worker_metadata, user, partial)
+    return partial
 
 class DriftPositionAggregator:
     """Class for fetching and aggregating all Drift positions"""
     
-    def __init__(self, connection, pickle_dir: str = DEFAULT_PICKLE_DIR, force_refresh: bool = False):
+    def __init__(self, connection, pickle_dir: str = DEFAULT_PICKLE_DIR, force_refresh: bool = False,
+                 keep_snapshots: int = 1, snapshot_max_age: Optional[int] = None, engine: str = "python",
+                 full_snapshot_every: int = 1):
         """Initialize with connection and pickle settings"""
         # Generate a random keypair - we're only reading data, not signing transactions
         from solders.keypair import Keypair # type: ignore
@@ -145,6 +401,8 @@ class DriftPositionAggregator:
             self.wallet, 
             account_subscription=AccountSubscriptionConfig("cached")
         )
+        # Decoded market names/decimals, rebuilt only when the market snapshot changes
+        self.market_metadata = MarketMetadata(self.drift_client)
         
         self.user_map = None
         self.stats_map = None
@@ -155,21 +413,27 @@ class DriftPositionAggregator:
         self.force_refresh = force_refresh
         self.using_pickled_data = False
         self.pickle_timestamp = None
+        self.manifest: Optional[SnapshotManifest] = None
+        self.pickle_files = None
+        self.engine = engine
+        # Set by watch(); fed by UserMap websocket updates
+        self.incremental: Optional[IncrementalAggregates] = None
+        self._oracles: Optional[OracleSnapshot] = None
         
-        # Create pickle directory if it doesn't exist
-        if not os.path.exists(self.pickle_dir):
-            os.makedirs(self.pickle_dir)
+        # Snapshot cache (creates the pickle directory if it doesn't exist)
+        self.vat_cache = VatCache(pickle_dir, keep_last=keep_snapshots, max_age_seconds=snapshot_max_age,
+                                  full_every=full_snapshot_every)
 
     async def initialize(self):
         """Initialize the drift client and maps, using pickled data if available and fresh"""
         # First check if we have fresh pickle data available
         if not self.force_refresh:
-            pickle_files, timestamp = get_newest_pickle_set(self.pickle_dir)
-            if pickle_files and timestamp and is_pickle_fresh(timestamp):
-                print(f"Using pickled data from {datetime.datetime.fromtimestamp(timestamp)}")
-                self.pickle_timestamp = timestamp
+            manifest = self.vat_cache.newest()
+            if manifest and manifest.is_fresh():
+                print(f"Using pickled data from {datetime.datetime.fromtimestamp(manifest.data_time)}")
+                self.pickle_timestamp = manifest.data_time
                 self.using_pickled_data = True
-                success = await self.load_from_pickle(pickle_files)
+                success = await self.load_from_pickle(manifest)
                 if success:
                     return
                 else:
@@ -207,6 +471,8 @@ class DriftPositionAggregator:
                 UserMapWebsocketConfig(),
             )
         )
+        if self.incremental is not None:
+            self._attach_incremental()
         self.stats_map = UserStatsMap(UserStatsMapConfig(self.drift_client))
         
         # Initialize VAT
@@ -226,8 +492,8 @@ class DriftPositionAggregator:
             self.stats_map.subscribe(),
         )
 
-    async def load_from_pickle(self, pickle_files: Dict[str, str]) -> bool:
-        """Load data from pickle files, returns True if successful, False otherwise"""
+    async def load_from_pickle(self, manifest: SnapshotManifest) -> bool:
+        """Load data from a snapshot's pickle files, returns True if successful, False otherwise"""
         try:
             # Note: When using pickle data, we don't need to subscribe to the drift client or any maps
             # Create the maps but don't subscribe to them
@@ -266,14 +532,11 @@ class DriftPositionAggregator:
             
             # Load from pickle - this deserializes the data without requiring RPC calls
             print("Loading data from pickle without contacting RPC...")
-            await self.vat.unpickle(
-                users_filename=pickle_files.get('usermap'),
-                user_stats_filename=pickle_files.get('userstats'),
-                spot_markets_filename=pickle_files.get('spot'),
-                perp_markets_filename=pickle_files.get('perp'),
-                spot_oracles_filename=pickle_files.get('spotoracles'),
-                perp_oracles_filename=pickle_files.get('perporacles'),
-            )
+            self.manifest = manifest
+            self.pickle_files = self.vat_cache.file_map(manifest)
+            # The numpy and process engines read raw account bytes from the snapshot themselves,
+            # so skip building a DriftUser per account and load everything else
+            await self.vat_cache.load(self.vat, manifest, users=self.engine not in ("numpy", "process"))
             return True
         except Exception as e:
             print(f"Error loading from pickle: {str(e)}")
@@ -284,35 +547,12 @@ class DriftPositionAggregator:
         if not self.vat:
             return
         
-        # Create timestamped directory for the new pickle set
-        now = datetime.datetime.now()
-        folder_name = now.strftime("vat-%Y-%m-%d-%H-%M-%S")
-        path = os.path.join(self.pickle_dir, folder_name, "")
-        
-        os.makedirs(path, exist_ok=True)
-        pickle_files = await self.vat.pickle(path)
-        self.pickle_timestamp = now.timestamp()
-        print(f"Saved fresh data to {path}")
+        manifest = await self.vat_cache.save(self.vat)
+        self.pickle_timestamp = manifest.data_time
+        self.manifest = manifest
+        self.pickle_files = self.vat_cache.file_map(manifest)
         
-        # Delete all previous VAT directories
-        self._delete_old_vat_dirs(except_dir=folder_name)
-        
-        return pickle_files
-
-    def _delete_old_vat_dirs(self, except_dir=None):
-        """Delete all VAT directories except the one specified"""
-        if not os.path.exists(self.pickle_dir):
-            return
-            
-        for item in os.listdir(self.pickle_dir):
-            item_path = os.path.join(self.pickle_dir, item)
-            if os.path.isdir(item_path) and item.startswith("vat-") and item != except_dir:
-                try:
-                    import shutil
-                    shutil.rmtree(item_path)
-                    print(f"Deleted old VAT directory: {item}")
-                except Exception as e:
-                    print(f"Warning: Failed to delete old VAT directory {item}: {e}")
+        return self.pickle_files
 
     async def cleanup(self):
         """Clean up connections"""
@@ -350,137 +590,150 @@ class DriftPositionAggregator:
         except Exception as e:
             print(f"Warning: Error during cleanup: {e}")
 
+    def _attach_incremental(self):
+        """Feed websocket account updates into the incremental aggregates (before subscribe)"""
+        subscription = self.user_map.subscription
+        original_on_update = subscription.on_update
+        
+        async def on_update(key: str, data):
+            await original_on_update(key, data)
+            self.incremental.update_account(key, self.user_map.get(key))
+        
+        # The websocket subscriber captures the callback when it subscribes
+        subscription.on_update = on_update
+    
+    async def rebuild_incremental(self, refresh: bool = True):
+        """Full recompute: refetch markets, oracles and users, then re-price every account"""
+        if refresh:
+            await self.drift_client.account_subscriber.update_cache()
+            await self.user_map.sync()
+        self.market_metadata.refresh()
+        if self._oracles is not None:
+            self._oracles.unpin(self.drift_client)
+        # Incremental updates are priced from the same snapshot as the rebuild, so the
+        # totals stay consistent between rebuilds
+        self._oracles = OracleSnapshot.from_drift_client(self.drift_client)
+        self._oracles.pin(self.drift_client)
+        start = time.time()
+        self.incremental.rebuild(dict(self.user_map.user_map))
+        print(f"Rebuilt aggregates for {len(self.incremental.contributions)} sub-accounts "
+              f"in {time.time() - start:.2f}s")
+    
+    async def watch(self, interval: float = 60, rebuild_interval: float = 3600, on_totals=None):
+        """
+        Keep aggregates in memory, updated from UserMap websocket account updates, and report
+        them every `interval` seconds. Every `rebuild_interval` seconds (0 = never) everything
+        is recomputed at current oracle prices and missed closures are dropped.
+        """
+        self.incremental = IncrementalAggregates(self.market_metadata)
+        self.force_refresh = True
+        await self.initialize()
+        await self.rebuild_incremental(refresh=False)
+        
+        last_rebuild = time.time()
+        while True:
+            await asyncio.sleep(interval)
+            if rebuild_interval and time.time() - last_rebuild >= rebuild_interval:
+                await self.rebuild_incremental()
+                last_rebuild = time.time()
+            result = self.incremental.result()
+            result["using_cached_data"] = False
+            result["data_timestamp"] = time.time()
+            (on_totals or print_aggregated_positions)(result)
+    
+    def oracle_snapshot(self) -> OracleSnapshot:
+        """Oracle prices for one aggregation pass: the VAT oracle files when loaded from a snapshot"""
+        if self.using_pickled_data and self.vat and self.vat.perp_oracles:
+            return OracleSnapshot.from_vat(self.vat)
+        return OracleSnapshot.from_drift_client(self.drift_client)
+    
     async def get_all_user_positions(self) -> Dict[str, Any]:
         """Get aggregated positions for all users in the system"""
         if not self.user_map:
             raise ValueError("UserMap not initialized")
         
-        # Initialize aggregation containers
-        perp_aggregates = defaultdict(lambda: {
-            "market_name": "",
-            "total_long_usd": 0.0,
-            "total_short_usd": 0.0,
-            "total_lp_shares": 0,
-            "current_price": 0.0,
-            "unique_users": set()
-        })
+        partial = new_partial_aggregate()
         
-        spot_aggregates = defaultdict(lambda: {
-            "market_name": "",
-            "total_deposits_native": 0.0,
-            "total_borrows_native": 0.0,
-            "total_deposits_usd": 0.0,
-            "total_borrows_usd": 0.0,
-            "token_price": 0.0,
-            "decimals": 0,
-            "unique_users": set()
-        })
+        # If we're using fresh data, sync first
+        if not self.using_pickled_data:
+            await self.user_map.sync()
         
-        total_users = 0
-        total_sub_accounts = 0
-        total_net_value = 0.0
+        # Process all users, every one priced from the same oracle snapshot
+        self.market_metadata.refresh()
+        with self.oracle_snapshot().pinned(self.drift_client):
+            for user in self.user_map.values():
+                accumulate_user(self.market_metadata, user, partial)
         
-        # Track unique authorities
-        unique_authorities = set()
+        result = finalize_partial_aggregate(partial)
+        result["using_cached_data"] = self.using_pickled_data
+        result["data_timestamp"] = self.pickle_timestamp if self.using_pickled_data else time.time()
+        return result
+
+    async def get_all_user_positions_parallel(self, workers: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Same per-user SDK math as get_all_user_positions, sharded across a process pool.
+
+        Workers rebuild markets and oracles from the snapshot files once, then receive shards of
+        raw (pubkey, account bytes) pairs instead of pickled DriftUser objects. Each shard returns
+        partial sums plus authority sets, which are merged here.
+        """
+        if not self.pickle_files:
+            raise ValueError("Parallel aggregation needs a VAT snapshot; run initialize() first")
         
-        # If we're using fresh data, sync first
-        if not self.using_pickled_data:
+        if self.using_pickled_data and self.manifest:
+            accounts = list(self.vat_cache.iter_raw(self.manifest, "usermap"))
+        else:
             await self.user_map.sync()
+            accounts = list(self.user_map.raw.items())
         
-        # Process all users
-        for user in self.user_map.values():
-            try:
-                user_account = user.get_user_account()
-                authority = str(user_account.authority)
-                unique_authorities.add(authority)
-                total_sub_accounts += 1
-                total_net_value += user.get_net_usd_value() / 1e6
-                
-                # Process perpetual positions
-                perp_positions = user.get_active_perp_positions()
-                for position in perp_positions:
-                    market = self.drift_client.get_perp_market_account(position.market_index)
-                    market_name = bytes(market.name).decode('utf-8').strip('\x00')
-                    oracle_price_data = user.get_oracle_data_for_perp_market(position.market_index)
-                    
-                    agg = perp_aggregates[position.market_index]
-                    agg["market_name"] = market_name
-                    agg["current_price"] = oracle_price_data.price / 1e6
-                    
-                    position_value = abs(user.get_perp_position_value(
-                        position.market_index,
-                        oracle_price_data,
-                        include_open_orders=True
-                    ) / 1e6)
-                    
-                    base_asset_amount = position.base_asset_amount / 1e9
-                    if base_asset_amount > 0:
-                        agg["total_long_usd"] += position_value
-                    else:
-                        agg["total_short_usd"] += position_value
-                    
-                    agg["total_lp_shares"] += position.lp_shares / 1e9
-                    agg["unique_users"].add(authority)
-                
-                # Process spot positions
-                spot_positions = user.get_active_spot_positions()
-                for position in spot_positions:
-                    market = self.drift_client.get_spot_market_account(position.market_index)
-                    market_name = bytes(market.name).decode('utf-8').strip('\x00')
-                    
-                    agg = spot_aggregates[position.market_index]
-                    agg["market_name"] = market_name
-                    agg["decimals"] = market.decimals
-                    
-                    token_amount = user.get_token_amount(position.market_index)
-                    formatted_amount = token_amount / (10 ** market.decimals)
-                    
-                    if position.market_index == QUOTE_SPOT_MARKET_INDEX:
-                        token_price = 1.0
-                        token_value = abs(formatted_amount)
-                    else:
-                        oracle_price_data = user.get_oracle_data_for_spot_market(position.market_index)
-                        token_price = oracle_price_data.price / 1e6
-                        if token_amount < 0:
-                            token_value = abs(user.get_spot_market_liability_value(
-                                market_index=position.market_index,
-                                include_open_orders=True
-                            ) / 1e6)
-                        else:
-                            token_value = abs(user.get_spot_market_asset_value(
-                                market_index=position.market_index,
-                                include_open_orders=True
-                            ) / 1e6)
-                    
-                    agg["token_price"] = token_price
-                    
-                    if token_amount > 0:
-                        agg["total_deposits_native"] += formatted_amount
-                        agg["total_deposits_usd"] += token_value
-                    else:
-                        agg["total_borrows_native"] += abs(formatted_amount)
-                        agg["total_borrows_usd"] += token_value
-                    
-                    agg["unique_users"].add(authority)
-                    
-            except Exception as e:
-                print(f"Error processing user: {e}")
+        workers = workers or os.cpu_count() or 1
+        # A few shards per worker keeps every core busy when shards finish unevenly
+        shard_size = max(1, -(-len(accounts) // (workers * 4)))
+        shards = [accounts[i:i + shard_size] for i in range(0, len(accounts), shard_size)]
+        print(f"Aggregating {len(accounts)} sub-accounts in {len(shards)} shards across {workers} processes...")
         
-        # Convert sets to counts for JSON serialization
-        for agg in perp_aggregates.values():
-            agg["unique_users"] = len(agg["unique_users"])
-        for agg in spot_aggregates.values():
-            agg["unique_users"] = len(agg["unique_users"])
+        start = time.time()
+        partial = new_partial_aggregate()
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_aggregation_worker,
+            initargs=(self.pickle_files,),
+        ) as executor:
+            futures = [loop.run_in_executor(executor, _aggregate_shard, shard) for shard in shards]
+            for future in asyncio.as_completed(futures):
+                merge_partial_aggregate(partial, await future)
+        print(f"Aggregated {len(accounts)} sub-accounts in {time.time() - start:.2f}s")
         
-        return {
-            "total_unique_authorities": len(unique_authorities),
-            "total_sub_accounts": total_sub_accounts,
-            "total_net_value": total_net_value,
-            "perp_markets": dict(perp_aggregates),
-            "spot_markets": dict(spot_aggregates),
-            "using_cached_data": self.using_pickled_data,
-            "data_timestamp": self.pickle_timestamp if self.using_pickled_data else time.time()
-        }
+        result = finalize_partial_aggregate(partial)
+        result["using_cached_data"] = self.using_pickled_data
+        result["data_timestamp"] = self.pickle_timestamp if self.using_pickled_data else time.time()
+        return result
+
+    async def get_all_user_positions_vectorized(self) -> Dict[str, Any]:
+        """Same aggregation as get_all_user_positions, computed by position_engine over raw account bytes"""
+        if not self.user_map:
+            raise ValueError("UserMap not initialized")
+        
+        # Raw User bytes: straight from the usermap pickle (skipping DriftUser decoding)
+        # or from the last UserMap sync when using fresh data
+        if self.using_pickled_data and self.manifest:
+            raw_accounts = (raw for _, raw in self.vat_cache.iter_raw(self.manifest, "usermap"))
+        else:
+            await self.user_map.sync()
+            raw_accounts = self.user_map.raw.values()
+        
+        start = time.time()
+        positions = PositionArrays.from_raw(raw_accounts)
+        self.market_metadata.refresh()
+        with self.oracle_snapshot().pinned(self.drift_client):
+            markets = MarketArrays.from_drift_client(self.drift_client, self.market_metadata)
+        result = aggregate_positions(positions, markets)
+        print(f"Aggregated {positions.num_users} sub-accounts in {time.time() - start:.2f}s")
+        
+        result["using_cached_data"] = self.using_pickled_data
+        result["data_timestamp"] = self.pickle_timestamp if self.using_pickled_data else time.time()
+        return result
 
 def print_aggregated_positions(data: Dict[str, Any]):
     """
@@ -536,6 +789,19 @@ async def main():
     parser.add_argument("--rpc", help="RPC URL (will use RPC_URL env var if not provided)")
     parser.add_argument("--force-refresh", action="store_true", help="Force fetch fresh data from RPC")
     parser.add_argument("--pickle-dir", default=DEFAULT_PICKLE_DIR, help=f"Directory for pickle files (default: {DEFAULT_PICKLE_DIR})")
+    parser.add_argument("--keep-snapshots", type=int, default=1, help="Number of VAT snapshots to keep (default: 1)")
+    parser.add_argument("--snapshot-max-age", type=int, default=None, help="Also delete VAT snapshots older than this many seconds")
+    parser.add_argument("--full-snapshot-every", type=int, default=1,
+                        help="Write a full VAT snapshot every N snapshots and only changed users/user stats in between (default: 1, always full)")
+    parser.add_argument("--engine", choices=["python", "process", "numpy"], default="python",
+                        help="Aggregation engine: exact per-user SDK math, the same sharded across processes, "
+                             "or an approximate vectorized pass over raw accounts (default: python)")
+    parser.add_argument("--workers", type=int, default=None, help="Processes for --engine process (default: CPU count)")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running: maintain aggregates from websocket account updates and print them periodically")
+    parser.add_argument("--watch-interval", type=float, default=60, help="Seconds between printed totals in --watch mode (default: 60)")
+    parser.add_argument("--rebuild-interval", type=float, default=3600,
+                        help="Seconds between full recomputes in --watch mode, 0 to disable (default: 3600)")
     
     # Parse arguments
     args = parser.parse_args()
@@ -553,16 +819,30 @@ async def main():
     aggregator = DriftPositionAggregator(
         connection, 
         pickle_dir=args.pickle_dir,
-        force_refresh=args.force_refresh
+        force_refresh=args.force_refresh,
+        keep_snapshots=args.keep_snapshots,
+        snapshot_max_age=args.snapshot_max_age,
+        engine=args.engine,
+        full_snapshot_every=args.full_snapshot_every
     )
     
     try:
+        if args.watch:
+            print("Watching aggregates (Ctrl+C to stop)...")
+            await aggregator.watch(args.watch_interval, args.rebuild_interval)
+            return 0
+        
         # Initialize (will use pickles if available and fresh)
         print("Initializing...")
         await aggregator.initialize()
         
         # Get and display aggregated positions
-        positions_data = await aggregator.get_all_user_positions()
+        if aggregator.engine == "numpy":
+            positions_data = await aggregator.get_all_user_positions_vectorized()
+        elif aggregator.engine == "process":
+            positions_data = await aggregator.get_all_user_positions_parallel(args.workers)
+        else:
+            positions_data = await aggregator.get_all_user_positions()
         print_aggregated_positions(positions_data)
             
     except Exception as e:
@@ -6,11 +6,44 @@ This script displays all positions for a given Drift Protocol authority address.
 It leverages the drift-labs/driftpy SDK to fetch and display positions with minimal RPC calls.
 Uses VAT (vat of pickles) to cache on-chain data and reduce RPC calls.
 
-The script maintains only a single VAT directory for caching data. When a new VAT is created,
-all previous VAT directories are automatically deleted to save disk space.
+VAT snapshots are managed by vat_cache.VatCache. Each snapshot directory carries a manifest and
+the pickle directory keeps a small index of the newest complete snapshot. By default only the
+newest snapshot is kept; see --keep-snapshots and --snapshot-max-age. With --full-snapshot-every N
+only every Nth snapshot is written in full and the others hold just the changed users and user stats.
+
+With --stale-while-revalidate, a snapshot older than --max-age (the soft limit) is still served
+immediately, flagged with its age, while a detached worker (this script with --refresh-snapshot)
+fetches a new one and publishes it atomically for the next run. Only a snapshot older than
+--hard-max-age, or no snapshot at all, makes the query wait for a refresh. Foreground refreshes
+take the worker's lock too, so they wait for a running worker and use its snapshot if it will do.
+
+With --component-ttls, each snapshot component has its own TTL (by default oracles 10s, markets
+60s, users and user stats 1h; override as e.g. "oracles=5,markets=30,users=7200"). Ages are
+measured in slots from the current slot. Only the expired components are re-fetched, into a new
+snapshot that reuses the others in place; with --stale-while-revalidate that happens in the
+background worker instead of before the query.
+
+With --snapshot-format mmap, users are read from a memory-mapped snapshot of raw User
+accounts (mmap_snapshot.py) instead of the usermap pickle, and only the queried
+authority's sub-accounts are decoded. Older snapshots are converted on first use.
+
+With --direct, no maps or snapshots are loaded at all: the authority's UserStats account gives
+number_of_sub_accounts_created, the sub-account PDAs are derived offline and fetched with
+getMultipleAccounts together with only the markets and oracles those sub-accounts use.
+
+Batch mode (--authorities-file, "-" for stdin) runs many authorities through one loaded
+viewer: the snapshot is loaded once and each authority's result is written as soon as it
+completes (--output-format ndjson/csv). Snapshot lookups are CPU-bound and run one after
+another on the event loop. With --direct, --concurrency lookups run at once so their RPC
+requests overlap; it does not parallelize CPU work.
+Progress messages go to stderr in ndjson/csv mode so stdout stays machine readable.
 
 Usage:
     python drift-positions.py <AUTHORITY_ADDRESS> [--rpc <RPC_URL>] [--force-refresh] [--pickle-dir <DIRECTORY>]
+                              [--snapshot-format {pickle,mmap}] [--direct]
+    python drift-positions.py --authorities-file <FILE|-> [--output-format {text,ndjson,csv}] [--direct --concurrency N] [...]
+    python drift-positions.py <AUTHORITY_ADDRESS> --stale-while-revalidate [--max-age 3600] [--hard-max-age 86400]
+    python drift-positions.py <AUTHORITY_ADDRESS> --component-ttls [oracles=10,markets=60,users=3600]
 
 Requirements:
     - Python 3.7+
@@ -26,8 +59,11 @@ Environment Variables:
 
 import os
 import sys
+import csv
+import json
 import asyncio
 import argparse
+import contextlib
 import time
 import datetime
 from pathlib import Path
@@ -52,12 +88,32 @@ from driftpy.pickle.vat import Vat
 from driftpy.user_map.userstats_map import UserStatsMap
 from driftpy.user_map.user_map_config import UserStatsMapConfig
 from driftpy.account_subscription_config import AccountSubscriptionConfig
+from driftpy.accounts.types import DataAndSlot
+from driftpy.decode.user import decode_user
+from driftpy.decode.user_stat import decode_user_stat
+from driftpy.addresses import (
+    get_user_account_public_key,
+    get_user_stats_account_public_key,
+    get_perp_market_public_key,
+    get_spot_market_public_key,
+    get_state_public_key,
+)
+
+from vat_cache import DEFAULT_COMPONENT_TTLS, SnapshotManifest, VatCache, parse_component_ttls
+from mmap_snapshot import MmapUserSnapshot
+from authority_index import AuthorityIndex
+from market_metadata import MarketMetadata
+from account_fetch import AccountFetcher
+from oracle_snapshot import fetch_oracle_prices
 
 # Load environment variables
 load_dotenv()
 
 # Default pickle directory
 DEFAULT_PICKLE_DIR = "../pickles"
+# Soft and hard snapshot age limits (seconds)
+DEFAULT_MAX_AGE = 3600
+DEFAULT_HARD_MAX_AGE = 86400
 
 def format_number(number: float, decimals: int = 4, use_commas: bool = True) -> str:
     """Format a number with proper decimal places and optional comma separators"""
@@ -69,69 +125,25 @@ def format_number(number: float, decimals: int = 4, use_commas: bool = True) ->
     else:
         return f"{number:.{decimals}f}"
 
-def get_newest_pickle_set(directory: str) -> Tuple[Optional[Dict[str, str]], Optional[float]]:
-    """
-    Find the newest set of pickle files in the given directory.
-    Returns a tuple of (file_dict, timestamp_in_seconds) or (None, None) if no valid files found.
-    """
-    if not os.path.exists(directory):
-        return None, None
-    
-    # Look for pickle files that start with vat- prefix
-    subdirs = [d for d in os.listdir(directory) if d.startswith("vat-") and os.path.isdir(os.path.join(directory, d))]
-    if not subdirs:
-        return None, None
-    
-    # Since we now maintain only one VAT directory, just take the first one
-    # (but still sort by timestamp to be safe)
-    subdirs.sort(reverse=True)
-    subdir = subdirs[0]
-    path = os.path.join(directory, subdir)
-    
-    # Check if this is a complete pickle set with all required files
-    required_prefixes = ["perp_", "spot_", "usermap_", "userstats_", "perporacles_", "spotoracles_"]
-    files_present = []
-    
-    for f in os.listdir(path):
-        if f.endswith(".pkl") and any(f.startswith(prefix) for prefix in required_prefixes):
-            files_present.append(f)
-            
-    # Check if all required file types are present
-    if all(any(f.startswith(prefix) for f in files_present) for prefix in required_prefixes):
-        # Extract datetime from directory name
-        try:
-            # Format is vat-%Y-%m-%d-%H-%M-%S
-            date_part = subdir[4:]  # Remove 'vat-' prefix
-            dt = datetime.datetime.strptime(date_part, "%Y-%m-%d-%H-%M-%S")
-            timestamp = dt.timestamp()
-            
-            # Create a map of file types to full paths
-            file_map = {}
-            for prefix in required_prefixes:
-                prefix_base = prefix.rstrip("_")
-                matching_files = [f for f in files_present if f.startswith(prefix)]
-                if matching_files:
-                    # Sort by slot number to get the newest file
-                    matching_files.sort(key=lambda x: int(x.split("_")[-1].split(".")[0]), reverse=True)
-                    file_map[prefix_base] = os.path.join(path, matching_files[0])
-            
-            return file_map, timestamp
-        except Exception as e:
-            print(f"Error parsing timestamp from directory {subdir}: {e}")
-    
-    return None, None
-
-def is_pickle_fresh(timestamp: float, max_age_seconds: int = 3600) -> bool:
-    """Check if a pickle is fresh enough (less than max_age_seconds old)"""
-    current_time = time.time()
-    age = current_time - timestamp
-    return age < max_age_seconds
-
 class DriftPositionViewer:
     """Class for fetching and displaying Drift positions"""
     
-    def __init__(self, connection, pickle_dir: str = DEFAULT_PICKLE_DIR, force_refresh: bool = False):
-        """Initialize with connection and pickle settings"""
+    def __init__(self, connection, pickle_dir: str = DEFAULT_PICKLE_DIR, force_refresh: bool = False,
+                 keep_snapshots: int = 1, snapshot_max_age: Optional[int] = None,
+                 snapshot_format: str = "pickle", full_snapshot_every: int = 1,
+                 max_age: int = DEFAULT_MAX_AGE, hard_max_age: Optional[int] = None,
+                 refresh_command: Optional[List[str]] = None,
+                 component_ttls: Optional[Dict[str, float]] = None):
+        """
+        Initialize with connection and pickle settings
+
+        max_age is the age up to which a snapshot counts as fresh. With a refresh_command
+        (stale-while-revalidate), older snapshots up to hard_max_age (None: any age) are still
+        served while refresh_command runs detached to replace them.
+
+        With component_ttls (component -> seconds), freshness is decided per component
+        instead of by max_age, and only the expired components are re-fetched.
+        """
         # Generate a random keypair - we're only reading data, not signing transactions
         from solders.keypair import Keypair # type: ignore
         kp = Keypair()
@@ -145,6 +157,8 @@ class DriftPositionViewer:
             self.wallet, 
             account_subscription=AccountSubscriptionConfig("cached")
         )
+        # Decoded market names/decimals, rebuilt only when the market snapshot changes
+        self.market_metadata = MarketMetadata(self.drift_client)
         
         self.user_map = None
         self.stats_map = None
@@ -155,33 +169,347 @@ class DriftPositionViewer:
         self.force_refresh = force_refresh
         self.using_pickled_data = False
         self.pickle_timestamp = None
+        self.max_age = max_age
+        self.hard_max_age = hard_max_age
+        self.refresh_command = refresh_command
+        self.component_ttls = component_ttls
+        # Set when a stale snapshot is served while a background worker replaces it
+        self.stale = False
+        self.refresh_pid: Optional[int] = None
+        # Whether this process holds the cache's refresh lock (see refresh_lock())
+        self.holds_refresh_lock = False
+        # Stale snapshot whose background refresh waits for this process to release the lock
+        self.pending_refresh: Optional[SnapshotManifest] = None
+        self.snapshot_format = snapshot_format
+        self.user_snapshot: Optional[MmapUserSnapshot] = None
+        self.authority_index: Optional[AuthorityIndex] = None
+        self.direct_mode = False
+        # Re-sync the UserMap before each lookup when using fresh data (batch mode turns this off)
+        self.sync_before_lookup = True
         
-        # Create pickle directory if it doesn't exist
-        if not os.path.exists(self.pickle_dir):
-            os.makedirs(self.pickle_dir)
+        # Snapshot cache (creates the pickle directory if it doesn't exist)
+        self.vat_cache = VatCache(pickle_dir, keep_last=keep_snapshots, max_age_seconds=snapshot_max_age,
+                                  full_every=full_snapshot_every)
     
     async def initialize(self):
         """Initialize the drift client and maps, using pickled data if available and fresh"""
         # First check if we have fresh pickle data available
+        manifest = None
         if not self.force_refresh:
-            pickle_files, timestamp = get_newest_pickle_set(self.pickle_dir)
-            if pickle_files and timestamp and is_pickle_fresh(timestamp):
-                print(f"Using pickled data from {datetime.datetime.fromtimestamp(timestamp)}")
-                self.pickle_timestamp = timestamp
-                self.using_pickled_data = True
-                success = await self.load_from_pickle(pickle_files)
-                if success:
-                    return
-                else:
-                    print("Failed to load from pickle, fetching fresh data instead")
-        
-        # Only connect to RPC if we couldn't use pickled data
-        print("Fetching fresh data from RPC...")
-        # Subscribe to the drift client
-        await self.drift_client.subscribe()
-        await self.initialize_fresh()
-        await self.save_to_pickle()
+            manifest = self.vat_cache.newest()
+            if await self.initialize_from_snapshot(manifest):
+                return
+
+        # Fetch under the refresh lock so this never races a worker publishing into the same cache
+        async with self.refresh_lock():
+            if not self.force_refresh:
+                current = self.vat_cache.newest()
+                if current and (manifest is None or current.name != manifest.name):
+                    # A background worker published a new snapshot while we waited
+                    if await self.initialize_from_snapshot(current):
+                        return
+
+            # Only connect to RPC if we couldn't use pickled data
+            print("Fetching fresh data from RPC...")
+            # Subscribe to the drift client
+            await self.drift_client.subscribe()
+            await self.initialize_fresh()
+            await self.save_to_pickle()
+
+    async def initialize_from_snapshot(self, manifest: Optional[SnapshotManifest]) -> bool:
+        """Load `manifest` if it may be served; returns False if the caller has to fetch fresh data"""
+        if manifest is None:
+            return False
+        if self.component_ttls is not None:
+            if await self.initialize_components(manifest):
+                return True
+            print("Failed to load from pickle, fetching fresh data instead")
+            return False
+        if not self.is_servable(manifest):
+            return False
+
+        print(f"Using pickled data from {datetime.datetime.fromtimestamp(manifest.data_time)}")
+        self.pickle_timestamp = manifest.data_time
+        self.using_pickled_data = True
+        if self.snapshot_format == "mmap":
+            success = await self.load_from_mmap(manifest)
+        else:
+            success = await self.load_from_pickle(manifest)
+        if not success:
+            print("Failed to load from pickle, fetching fresh data instead")
+            return False
+        # Only once the snapshot is loaded, so the worker's publish cannot expire it mid-load
+        if not manifest.is_fresh(self.max_age):
+            self.stale = True
+            self.start_background_refresh(manifest)
+        return True
+
+    async def initialize_components(self, manifest: SnapshotManifest) -> bool:
+        """
+        Load a snapshot and bring its expired components up to date: re-fetched before the
+        query, or (stale-while-revalidate, within hard_max_age) by the background worker
+        while the snapshot is served as is. Returns False if the snapshot could not be loaded.
+        """
+        expired = manifest.expired(self.component_ttls, await self._current_slot())
+        if expired and self.refresh_command is not None and (
+                self.hard_max_age is None or manifest.is_fresh(self.hard_max_age)):
+            # Serve as is; the worker starts only once the snapshot is loaded, so its
+            # publish cannot expire it mid-load
+            if not await self.load_components(manifest, []):
+                return False
+            self.stale = True
+            self.start_background_refresh(manifest)
+            return True
+        if not expired:
+            return await self.load_components(manifest, expired)
+
+        # Refresh in the foreground under the refresh lock, then start from whatever is newest
+        # by then: a worker may have published while we waited
+        async with self.refresh_lock():
+            current = self.vat_cache.newest()
+            if current is None:
+                return False
+            if current.name != manifest.name:
+                manifest = current
+                expired = manifest.expired(self.component_ttls, await self._current_slot())
+            return await self.load_components(manifest, expired)
+
+    async def load_components(self, manifest: SnapshotManifest, expired: List[str]) -> bool:
+        """Load a snapshot, then re-fetch its `expired` components"""
+        print(f"Using pickled data from {datetime.datetime.fromtimestamp(manifest.data_time)}")
+        self.pickle_timestamp = manifest.data_time
+        self.using_pickled_data = True
+        if self.snapshot_format == "mmap":
+            success = await self.load_from_mmap(manifest)
+        else:
+            success = await self.load_from_pickle(manifest)
+        if not success:
+            self.using_pickled_data = False
+            return False
+        if expired:
+            await self.refresh_components(manifest, expired)
+        return True
+
+    @contextlib.asynccontextmanager
+    async def refresh_lock(self):
+        """Hold the cache's refresh lock, waiting for a running worker, unless this process already holds it"""
+        if self.holds_refresh_lock:
+            yield
+            return
+        await self.vat_cache.wait_for_refresh_lock()
+        self.holds_refresh_lock = True
+        try:
+            yield
+        finally:
+            self.holds_refresh_lock = False
+            self.vat_cache.release_refresh_lock()
+            if self.pending_refresh is not None:
+                # Deferred by start_background_refresh(): the worker needs the lock we just released
+                manifest, self.pending_refresh = self.pending_refresh, None
+                self.start_background_refresh(manifest)
+
+    async def refresh_components(self, manifest: SnapshotManifest, expired: List[str]) -> SnapshotManifest:
+        """Re-fetch the expired components of the loaded snapshot and publish the result"""
+        print(f"Refreshing {', '.join(expired)} of {manifest.name}...")
+        manifest = await self.vat_cache.save(self.vat, user_mmap=self.snapshot_format == "mmap", components=expired)
+        self.pickle_timestamp = manifest.data_time
+        if self.user_snapshot and "usermap" in expired:
+            self.user_snapshot.close()
+            self.user_snapshot = MmapUserSnapshot(self.vat_cache.ensure_user_mmap(manifest))
+        return manifest
+
+    async def _current_slot(self) -> Optional[int]:
+        """Current slot for slot-based component ages, or None (wall time is used instead)"""
+        try:
+            return (await self.connection.get_slot()).value
+        except Exception as e:
+            print(f"Could not get the current slot, using wall time for snapshot ages: {e}")
+            return None
+
+    def is_servable(self, manifest: SnapshotManifest) -> bool:
+        """Fresh, or (stale-while-revalidate) stale but within the hard age limit"""
+        if manifest.is_fresh(self.max_age):
+            return True
+        if self.refresh_command is None:
+            return False
+        return self.hard_max_age is None or manifest.is_fresh(self.hard_max_age)
+
+    def start_background_refresh(self, manifest: SnapshotManifest):
+        """
+        Spawn the detached refresh worker for a stale snapshot (unless one is already running).
+        While this process holds the refresh lock, the spawn waits until refresh_lock() releases it.
+        """
+        if self.holds_refresh_lock:
+            self.pending_refresh = manifest
+            return
+        self.refresh_pid, started = self.vat_cache.spawn_refresh(self.refresh_command)
+        age = datetime.timedelta(seconds=int(manifest.age))
+        if started:
+            print(f"Snapshot is stale ({age} old); refreshing in the background (pid {self.refresh_pid})")
+        else:
+            print(f"Snapshot is stale ({age} old); a background refresh is already running (pid {self.refresh_pid})")
+
+    async def refresh_snapshot(self) -> bool:
+        """
+        Background worker: fetch fresh data and publish a new snapshot while holding the
+        refresh lock. Returns False without doing anything if another worker holds it.
+        """
+        if not self.vat_cache.acquire_refresh_lock():
+            print("Another refresh is already running")
+            return False
+        self.holds_refresh_lock = True
+        try:
+            started = time.time()
+            # Re-check under the lock: a worker that just finished may already have refreshed it
+            manifest = self.vat_cache.newest()
+            if manifest and self.component_ttls is None and manifest.is_fresh(self.max_age):
+                print(f"{datetime.datetime.now()}: {manifest.name} is already fresh")
+                return True
+            if manifest and self.component_ttls is not None:
+                expired = manifest.expired(self.component_ttls, await self._current_slot())
+                if not expired:
+                    print(f"{datetime.datetime.now()}: every component of {manifest.name} is fresh")
+                    return True
+                # Only markets and oracles are needed: users and user stats are re-fetched in full
+                # by sync() when expired, and reused from the snapshot files otherwise
+                if await self.load_from_pickle(manifest, users=False, user_stats=False):
+                    await self.refresh_components(manifest, expired)
+                    print(f"{datetime.datetime.now()}: refresh done in {time.time() - started:.0f}s")
+                    return True
+                print("Failed to load the snapshot, refreshing every component")
+            print(f"{datetime.datetime.now()}: refreshing VAT snapshot in {self.pickle_dir}")
+            await self.drift_client.subscribe()
+            await self.initialize_fresh()
+            await self.save_to_pickle()
+            print(f"{datetime.datetime.now()}: refresh done in {time.time() - started:.0f}s")
+            return True
+        finally:
+            self.holds_refresh_lock = False
+            self.vat_cache.release_refresh_lock()
     
+    async def initialize_direct(self, authority_pubkey: Pubkey):
+        """
+        Fetch only one authority's sub-accounts plus the markets and oracles they use.
+
+        The authority's UserStats account gives number_of_sub_accounts_created, the
+        sub-account addresses are derived from it offline, and everything is fetched
+        with getMultipleAccounts. The results are written straight into the cached
+        DriftClient subscriber, so the usual DriftUser calculations work unchanged.
+
+        Can be called once per authority on the same viewer (batch mode); markets and
+        oracles already fetched for an earlier authority are reused.
+        """
+        self.direct_mode = True
+        program_id = self.drift_client.program_id
+        cache = self.drift_client.account_subscriber.cache
+
+        if self.user_map is None:
+            self.user_map = UserMap(
+                UserMapConfig(
+                    self.drift_client,
+                    UserMapWebsocketConfig(),
+                )
+            )
+            self.authority_index = AuthorityIndex(self.user_map)
+
+        # UserStats (and State on first use) in one request
+        stats_pubkey = get_user_stats_account_public_key(program_id, authority_pubkey)
+        if cache["state"] is None:
+            slot, (stats_account, state_account) = await self._get_multiple_accounts(
+                [stats_pubkey, get_state_public_key(program_id)]
+            )
+            cache["state"] = DataAndSlot(slot, self.drift_client.program.coder.accounts.decode(state_account.data))
+        else:
+            _, (stats_account,) = await self._get_multiple_accounts([stats_pubkey])
+        if stats_account is None:
+            return
+
+        # Sub-accounts that were deleted come back as None and are skipped
+        sub_account_count = decode_user_stat(stats_account.data).number_of_sub_accounts_created
+        user_pubkeys = [
+            get_user_account_public_key(program_id, authority_pubkey, sub_account_id)
+            for sub_account_id in range(sub_account_count)
+        ]
+        slot, user_accounts = await self._get_multiple_accounts(user_pubkeys)
+
+        perp_indexes = set()
+        spot_indexes = {QUOTE_SPOT_MARKET_INDEX}
+        for user_pubkey, account in zip(user_pubkeys, user_accounts):
+            if account is None:
+                continue
+            user_account = decode_user(account.data)
+            await self.user_map.add_pubkey(user_pubkey, DataAndSlot(slot, user_account))
+            for position in user_account.perp_positions:
+                if (position.base_asset_amount != 0 or position.quote_asset_amount != 0
+                        or position.open_orders != 0 or position.lp_shares != 0):
+                    perp_indexes.add(position.market_index)
+            for position in user_account.spot_positions:
+                if position.scaled_balance != 0 or position.open_orders != 0:
+                    spot_indexes.add(position.market_index)
+
+        await self._load_direct_markets(sorted(perp_indexes), sorted(spot_indexes))
+
+    async def _load_direct_markets(self, perp_indexes: List[int], spot_indexes: List[int]):
+        """Fetch the given markets and their oracles into the cached DriftClient subscriber"""
+        program = self.drift_client.program
+        program_id = self.drift_client.program_id
+        cache = self.drift_client.account_subscriber.cache
+
+        # Skip markets an earlier lookup already fetched
+        perp_indexes = [i for i in perp_indexes if self.drift_client.get_perp_market_account(i) is None]
+        spot_indexes = [i for i in spot_indexes if self.drift_client.get_spot_market_account(i) is None]
+        if not perp_indexes and not spot_indexes:
+            return
+
+        market_pubkeys = [get_perp_market_public_key(program_id, i) for i in perp_indexes]
+        market_pubkeys += [get_spot_market_public_key(program_id, i) for i in spot_indexes]
+        slot, market_accounts = await self._get_multiple_accounts(market_pubkeys)
+
+        perp_markets = [
+            DataAndSlot(slot, program.coder.accounts.decode(account.data))
+            for account in market_accounts[:len(perp_indexes)] if account is not None
+        ]
+        spot_markets = [
+            DataAndSlot(slot, program.coder.accounts.decode(account.data))
+            for account in market_accounts[len(perp_indexes):] if account is not None
+        ]
+
+        # Perp PnL settles in the perp market's quote spot market
+        missing_quote = {
+            m.data.quote_spot_market_index for m in perp_markets
+            if m.data.quote_spot_market_index not in spot_indexes
+            and self.drift_client.get_spot_market_account(m.data.quote_spot_market_index) is None
+        }
+        if missing_quote:
+            slot_q, quote_accounts = await self._get_multiple_accounts(
+                [get_spot_market_public_key(program_id, i) for i in sorted(missing_quote)]
+            )
+            for account in quote_accounts:
+                if account is not None:
+                    spot_markets.append(DataAndSlot(slot_q, program.coder.accounts.decode(account.data)))
+
+        cache["perp_markets"] = self._merge_markets(cache["perp_markets"], perp_markets)
+        cache["spot_markets"] = self._merge_markets(cache["spot_markets"], spot_markets)
+
+        # One request for every distinct oracle the new markets reference
+        await fetch_oracle_prices(
+            self.drift_client,
+            [m.data for m in perp_markets],
+            [m.data for m in spot_markets],
+            refetch=False,
+        )
+
+    @staticmethod
+    def _merge_markets(existing: List[DataAndSlot], new: List[DataAndSlot]) -> List[DataAndSlot]:
+        """Merge fetched markets into a cache list, one entry per market index, sorted"""
+        markets = {m.data.market_index: m for m in existing}
+        markets.update({m.data.market_index: m for m in new})
+        return [markets[i] for i in sorted(markets)]
+
+    async def _get_multiple_accounts(self, pubkeys: List[Pubkey]) -> Tuple[int, List[Any]]:
+        """getMultipleAccounts in concurrent, retried chunks; returns (slot, accounts)"""
+        return await AccountFetcher(self.connection).fetch_all(pubkeys)
+
     async def initialize_fresh(self):
         """Initialize with fresh data from RPC"""
         # Initialize all the maps we need
@@ -208,6 +536,7 @@ class DriftPositionViewer:
             )
         )
         self.stats_map = UserStatsMap(UserStatsMapConfig(self.drift_client))
+        self.authority_index = AuthorityIndex(self.user_map)
         
         # Initialize VAT
         self.vat = Vat(
@@ -226,8 +555,8 @@ class DriftPositionViewer:
             self.stats_map.subscribe(),
         )
     
-    async def load_from_pickle(self, pickle_files: Dict[str, str]) -> bool:
-        """Load data from pickle files, returns True if successful, False otherwise"""
+    async def load_from_pickle(self, manifest: SnapshotManifest, users: bool = True, user_stats: bool = True) -> bool:
+        """Load data from a snapshot's pickle files, returns True if successful, False otherwise"""
         try:
             # Note: When using pickle data, we don't need to subscribe to the drift client or any maps
             # Create the maps but don't subscribe to them
@@ -254,6 +583,8 @@ class DriftPositionViewer:
                 )
             )
             self.stats_map = UserStatsMap(UserStatsMapConfig(self.drift_client))
+            # Indexes users by authority as unpickle adds them
+            self.authority_index = AuthorityIndex(self.user_map)
             
             # Initialize VAT
             self.vat = Vat(
@@ -266,60 +597,88 @@ class DriftPositionViewer:
             
             # Load from pickle - this deserializes the data without requiring RPC calls
             print("Loading data from pickle without contacting RPC...")
-            await self.vat.unpickle(
-                users_filename=pickle_files.get('usermap'),
-                user_stats_filename=pickle_files.get('userstats'),
-                spot_markets_filename=pickle_files.get('spot'),
-                perp_markets_filename=pickle_files.get('perp'),
-                spot_oracles_filename=pickle_files.get('spotoracles'),
-                perp_oracles_filename=pickle_files.get('perporacles'),
-            )
+            await self.vat_cache.load(self.vat, manifest, users=users, user_stats=user_stats)
             return True
         except Exception as e:
             print(f"Error loading from pickle: {str(e)}")
             return False
     
+    async def load_from_mmap(self, manifest) -> bool:
+        """
+        Load markets, oracles and user stats from the snapshot pickles, but open users
+        as a memory-mapped snapshot instead of unpickling the whole usermap
+        """
+        try:
+            pickle_files = self.vat_cache.file_map(manifest)
+            user_snapshot_path = self.vat_cache.ensure_user_mmap(manifest)
+
+            self.spot_map = MarketMap(
+                MarketMapConfig(
+                    self.drift_client.program,
+                    MarketType.Spot(),
+                    MarketMapWebsocketConfig(),
+                    self.drift_client.connection,
+                )
+            )
+            self.perp_map = MarketMap(
+                MarketMapConfig(
+                    self.drift_client.program,
+                    MarketType.Perp(),
+                    MarketMapWebsocketConfig(),
+                    self.drift_client.connection,
+                )
+            )
+            # Stays empty; users are added as lookups decode them from the snapshot
+            self.user_map = UserMap(
+                UserMapConfig(
+                    self.drift_client,
+                    UserMapWebsocketConfig(),
+                )
+            )
+            self.stats_map = UserStatsMap(UserStatsMapConfig(self.drift_client))
+            self.vat = Vat(
+                self.drift_client,
+                self.user_map,
+                self.stats_map,
+                self.spot_map,
+                self.perp_map,
+            )
+
+            # Same steps as Vat.unpickle(), minus the usermap
+            print("Loading data from memory-mapped snapshot without contacting RPC...")
+            await self.vat_cache.load_user_stats(self.stats_map, manifest)
+            await self.spot_map.load(pickle_files.get('spot'))
+            await self.perp_map.load(pickle_files.get('perp'))
+            self.vat.load_oracles(pickle_files.get('spotoracles'), pickle_files.get('perporacles'))
+            self.drift_client.resurrect(
+                self.spot_map, self.perp_map, self.vat.spot_oracles, self.vat.perp_oracles
+            )
+
+            self.user_snapshot = MmapUserSnapshot(user_snapshot_path)
+            return True
+        except Exception as e:
+            print(f"Error loading from memory-mapped snapshot: {str(e)}")
+            return False
+
     async def save_to_pickle(self):
         """Save current state to pickle files"""
         if not self.vat:
             return
         
-        # Create timestamped directory for the new pickle set
-        now = datetime.datetime.now()
-        folder_name = now.strftime("vat-%Y-%m-%d-%H-%M-%S")
-        path = os.path.join(self.pickle_dir, folder_name, "")
-        
-        os.makedirs(path, exist_ok=True)
-        pickle_files = await self.vat.pickle(path)
-        self.pickle_timestamp = now.timestamp()
-        print(f"Saved fresh data to {path}")
+        manifest = await self.vat_cache.save(self.vat, user_mmap=self.snapshot_format == "mmap")
+        self.pickle_timestamp = manifest.data_time
         
-        # Delete all previous VAT directories
-        self._delete_old_vat_dirs(except_dir=folder_name)
-        
-        return pickle_files
-    
-    def _delete_old_vat_dirs(self, except_dir=None):
-        """Delete all VAT directories except the one specified"""
-        if not os.path.exists(self.pickle_dir):
-            return
-            
-        for item in os.listdir(self.pickle_dir):
-            item_path = os.path.join(self.pickle_dir, item)
-            if os.path.isdir(item_path) and item.startswith("vat-") and item != except_dir:
-                try:
-                    import shutil
-                    shutil.rmtree(item_path)
-                    print(f"Deleted old VAT directory: {item}")
-                except Exception as e:
-                    print(f"Warning: Failed to delete old VAT directory {item}: {e}")
-    
+        return self.vat_cache.file_map(manifest)
+
     async def cleanup(self):
         """Clean up connections"""
+        if self.user_snapshot:
+            self.user_snapshot.close()
+            self.user_snapshot = None
         try:
             # Only cleanup subscriptions if we weren't using pickled data
             # (if using pickled data, we never subscribed)
-            if not self.using_pickled_data:
+            if not self.using_pickled_data and not self.direct_mode:
                 if hasattr(self, 'spot_map') and self.spot_map:
                     try:
                         await self.spot_map.unsubscribe()
@@ -355,34 +714,30 @@ class DriftPositionViewer:
         if not self.user_map:
             raise ValueError("UserMap not initialized")
         
-        users = []
+        # Memory-mapped snapshot: decode only this authority's accounts
+        if self.user_snapshot:
+            users = []
+            for user_pubkey, user_account in self.user_snapshot.decode_by_authority(authority_pubkey):
+                await self.user_map.add_pubkey(user_pubkey, DataAndSlot(self.user_snapshot.slot, user_account))
+                users.append(self.user_map.get(str(user_pubkey)))
+            return users
         
-        # If we're using fresh data, sync first
-        if not self.using_pickled_data:
+        # If we're using fresh data, sync first (direct mode fetched exactly these accounts)
+        if not self.using_pickled_data and not self.direct_mode and self.sync_before_lookup:
             await self.user_map.sync()
         
-        # Find all accounts with matching authority
-        for user in self.user_map.values():
-            try:
-                user_authority = user.get_user_account().authority
-                if str(user_authority) == str(authority_pubkey):
-                    users.append(user)
-            except Exception as e:
-                print(f"Error checking user authority: {e}")
-        
-        return users
+        # Authority index lookup instead of scanning every user
+        return self.authority_index.get_users(authority_pubkey)
     
     def get_perp_position_details(self, user: DriftUser, position: PerpPosition) -> Dict[str, Any]:
         """Get detailed information about a perpetual position"""
         # Get market information
-        market = self.drift_client.get_perp_market_account(position.market_index)
+        market_info = self.market_metadata.perp(position.market_index)
         oracle_price_data = user.get_oracle_data_for_perp_market(position.market_index)
-        
-        # Decode market name from bytes
-        market_name = bytes(market.name).decode('utf-8').strip('\x00')
+        market_name = market_info.name
         
         # Calculate base asset amount (position size) with precision adjustment
-        base_asset_amount = position.base_asset_amount / 1e9  # BASE_PRECISION
+        base_asset_amount = position.base_asset_amount / market_info.precision  # BASE_PRECISION
         
         # Get position value in USD
         position_value = user.get_perp_position_value(
@@ -429,25 +784,23 @@ class DriftPositionViewer:
     def get_spot_position_details(self, user: DriftUser, position: SpotPosition) -> Dict[str, Any]:
         """Get detailed information about a spot market position"""
         # Get market information
-        market = self.drift_client.get_spot_market_account(position.market_index)
+        market_info = self.market_metadata.spot(position.market_index)
         oracle_price_data = user.get_oracle_data_for_spot_market(position.market_index)
-        
-        # Decode market name from bytes
-        market_name = bytes(market.name).decode('utf-8').strip('\x00')
+        market_name = market_info.name
         
         # Get token amount with proper sign (positive for deposits, negative for borrows)
         token_amount = user.get_token_amount(position.market_index)
         
         # Convert to human readable format based on decimals
-        decimals = market.decimals
-        formatted_token_amount = token_amount / (10 ** decimals)
+        decimals = market_info.decimals
+        formatted_token_amount = token_amount / market_info.precision
         
         # Get position type (deposit or borrow)
         position_type = "Deposit" if token_amount > 0 else "Borrow"
         
         # Calculate token value in USD
         token_value = 0
-        if position.market_index == QUOTE_SPOT_MARKET_INDEX:
+        if market_info.is_quote:
             # For USDC, the value is just the token amount
             token_value = abs(formatted_token_amount)
             token_price = 1.0  # USDC price is 1:1 with USD
@@ -486,6 +839,9 @@ class DriftPositionViewer:
         if not users:
             return {"error": f"No accounts found for authority: {authority_pubkey}"}
         
+        # Once per lookup, not per position; a no-op unless the markets changed
+        self.market_metadata.refresh()
+        
         result = []
         
         for user in users:
@@ -519,7 +875,9 @@ class DriftPositionViewer:
             "authority": authority_pubkey, 
             "sub_accounts": result, 
             "using_cached_data": self.using_pickled_data,
-            "data_timestamp": self.pickle_timestamp if self.using_pickled_data else time.time()
+            "data_timestamp": self.pickle_timestamp if self.using_pickled_data else time.time(),
+            "stale": self.stale,
+            "refresh_pid": self.refresh_pid,
         }
 
 def print_positions(positions_data: Dict[str, Any]):
@@ -536,7 +894,11 @@ def print_positions(positions_data: Dict[str, Any]):
     print(f"\n=== Positions for Authority: {positions_data['authority']} ===")
     if positions_data.get("using_cached_data", False):
         data_time = datetime.datetime.fromtimestamp(positions_data.get("data_timestamp", 0))
-        print(f"(Using cached data from {data_time})")
+        if positions_data.get("stale"):
+            age = datetime.timedelta(seconds=int(time.time() - positions_data.get("data_timestamp", 0)))
+            print(f"(Using STALE cached data from {data_time}, {age} old; a newer snapshot is being fetched)")
+        else:
+            print(f"(Using cached data from {data_time})")
     print(f"Number of Sub-Accounts: {len(positions_data['sub_accounts'])}")
     
     for i, sub_account in enumerate(positions_data['sub_accounts']):
@@ -580,6 +942,122 @@ def print_positions(positions_data: Dict[str, Any]):
         else:
             print("\nNo spot positions")
 
+# One CSV row per position; sub-accounts without positions and errors get a single row
+CSV_FIELDS = [
+    "authority", "error", "sub_account_id", "account_health", "total_collateral", "free_collateral",
+    "leverage", "net_value", "position_kind", "market_index", "market_name", "position_type",
+    "size", "value", "price", "entry_price", "unrealized_pnl", "funding_pnl", "lp_shares",
+]
+
+def position_rows(positions_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Flatten get_user_positions() output into CSV rows"""
+    if "error" in positions_data:
+        return [{"authority": positions_data.get("authority"), "error": positions_data["error"]}]
+
+    rows = []
+    for sub_account in positions_data["sub_accounts"]:
+        base = {
+            "authority": positions_data["authority"],
+            "sub_account_id": sub_account["sub_account_id"],
+            "account_health": sub_account["account_health"],
+            "total_collateral": sub_account["total_collateral"],
+            "free_collateral": sub_account["free_collateral"],
+            "leverage": sub_account["leverage"],
+            "net_value": sub_account["net_value"],
+        }
+        for pos in sub_account["perp_positions"]:
+            rows.append({
+                **base, "position_kind": "perp", "market_index": pos["market_index"],
+                "market_name": pos["market_name"], "position_type": pos["position_type"],
+                "size": pos["position_size"], "value": pos["position_value"], "price": pos["current_price"],
+                "entry_price": pos["entry_price"], "unrealized_pnl": pos["unrealized_pnl"],
+                "funding_pnl": pos["funding_pnl"], "lp_shares": pos["lp_shares"],
+            })
+        for pos in sub_account["spot_positions"]:
+            rows.append({
+                **base, "position_kind": "spot", "market_index": pos["market_index"],
+                "market_name": pos["market_name"], "position_type": pos["position_type"],
+                "size": pos["token_amount"], "value": pos["token_value"], "price": pos["token_price"],
+            })
+        if not sub_account["perp_positions"] and not sub_account["spot_positions"]:
+            rows.append(base)
+    return rows
+
+async def read_authorities(path: str):
+    """Yield authority addresses from a file or stdin ("-"), one per line; blank lines and # comments are skipped"""
+    loop = asyncio.get_running_loop()
+    stream = sys.stdin if path == "-" else open(path, "r")
+    try:
+        while True:
+            # readline in a thread so a slow stdin producer doesn't block running lookups
+            line = await loop.run_in_executor(None, stream.readline)
+            if not line:
+                break
+            line = line.split("#", 1)[0].strip()
+            if line:
+                yield line
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+async def run_batch(viewer: DriftPositionViewer, authorities_path: str, output_format: str,
+                    concurrency: int, direct: bool, out) -> int:
+    """
+    Look up every authority from authorities_path on one viewer and stream results to out.
+    With `direct`, up to `concurrency` lookups overlap their RPC requests; snapshot lookups
+    are synchronous CPU work and run one at a time, in input order.
+
+    Returns the number of authorities that failed.
+    """
+    # The map was synced when it loaded; one full resync per authority would dominate the run
+    viewer.sync_before_lookup = False
+    concurrency = max(1, concurrency) if direct else 1
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 4)
+    write_lock = asyncio.Lock()
+    failures = 0
+
+    csv_writer = None
+    if output_format == "csv":
+        csv_writer = csv.DictWriter(out, fieldnames=CSV_FIELDS, extrasaction="ignore")
+        csv_writer.writeheader()
+
+    async def write_result(positions_data: Dict[str, Any]):
+        async with write_lock:
+            if output_format == "ndjson":
+                out.write(json.dumps(positions_data, default=str) + "\n")
+            elif output_format == "csv":
+                csv_writer.writerows(position_rows(positions_data))
+            else:
+                print_positions(positions_data)
+            out.flush()
+
+    async def worker():
+        nonlocal failures
+        while True:
+            authority = await queue.get()
+            if authority is None:
+                queue.task_done()
+                return
+            try:
+                if direct:
+                    await viewer.initialize_direct(Pubkey.from_string(authority))
+                positions_data = await viewer.get_user_positions(authority)
+            except Exception as e:
+                failures += 1
+                positions_data = {"error": f"Error: {str(e)}"}
+            if "authority" not in positions_data:
+                positions_data = {"authority": authority, **positions_data}
+            await write_result(positions_data)
+            queue.task_done()
+
+    tasks = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    async for authority in read_authorities(authorities_path):
+        await queue.put(authority)
+    for _ in tasks:
+        await queue.put(None)
+    await asyncio.gather(*tasks)
+    return failures
+
 async def main():
     """
     Main function to process command line arguments and display user positions.
@@ -590,14 +1068,73 @@ async def main():
     )
     
     # Define arguments
-    parser.add_argument("authority", help="Authority public key to query")
+    parser.add_argument("authority", nargs="?", help="Authority public key to query")
     parser.add_argument("--rpc", help="RPC URL (will use RPC_URL env var if not provided)")
     parser.add_argument("--force-refresh", action="store_true", help="Force fetch fresh data from RPC")
     parser.add_argument("--pickle-dir", default=DEFAULT_PICKLE_DIR, help=f"Directory for pickle files (default: {DEFAULT_PICKLE_DIR})")
+    parser.add_argument("--keep-snapshots", type=int, default=1, help="Number of VAT snapshots to keep (default: 1)")
+    parser.add_argument("--snapshot-max-age", type=int, default=None, help="Also delete VAT snapshots older than this many seconds")
+    parser.add_argument("--full-snapshot-every", type=int, default=1,
+                        help="Write a full VAT snapshot every N snapshots and only changed users/user stats in between (default: 1, always full)")
+    parser.add_argument("--snapshot-format", choices=["pickle", "mmap"], default="pickle",
+                        help="How to load users from a snapshot: unpickle the full usermap, or a memory-mapped file decoded per lookup (default: pickle)")
+    parser.add_argument("--direct", action="store_true",
+                        help="Skip maps and snapshots: fetch only this authority's sub-accounts and the markets/oracles they use")
+    parser.add_argument("--authorities-file", help="Batch mode: file with one authority per line, or - for stdin")
+    parser.add_argument("--output-format", choices=["text", "ndjson", "csv"], default="text",
+                        help="Batch output format (default: text)")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Batch mode with --direct: lookups whose RPC requests overlap (default: 8). "
+                             "Snapshot lookups are CPU-bound and always run one at a time")
+    parser.add_argument("--max-age", type=int, default=DEFAULT_MAX_AGE,
+                        help=f"Seconds a VAT snapshot counts as fresh (default: {DEFAULT_MAX_AGE})")
+    parser.add_argument("--stale-while-revalidate", action="store_true",
+                        help="Serve a stale snapshot immediately and refresh it in a detached background worker")
+    parser.add_argument("--hard-max-age", type=int, default=DEFAULT_HARD_MAX_AGE,
+                        help=f"With --stale-while-revalidate, refresh in the foreground beyond this age (default: {DEFAULT_HARD_MAX_AGE}, 0 for no limit)")
+    parser.add_argument("--component-ttls", nargs="?", const="", default=None, type=component_ttls,
+                        help="Refresh each snapshot component on its own TTL instead of --max-age; optionally override "
+                             "the defaults (" + ",".join(f"{c}={t:g}" for c, t in DEFAULT_COMPONENT_TTLS.items()) + ")")
+    parser.add_argument("--refresh-snapshot", action="store_true",
+                        help="Only fetch and publish a new VAT snapshot, then exit (what the background worker runs)")
     
     # Parse arguments
     args = parser.parse_args()
+    if not args.authority and not args.authorities_file and not args.refresh_snapshot:
+        parser.error("an authority or --authorities-file is required")
     
+    # Keep stdout for results when writing machine-readable output
+    out = sys.stdout
+    if args.output_format != "text":
+        with contextlib.redirect_stdout(sys.stderr):
+            return await run(args, out)
+    return await run(args, out)
+
+def component_ttls(spec: str) -> Dict[str, float]:
+    try:
+        return parse_component_ttls(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def refresh_command(args) -> List[str]:
+    """Command line of the detached --refresh-snapshot worker"""
+    command = [
+        sys.executable, os.path.abspath(__file__), "--refresh-snapshot",
+        "--pickle-dir", os.path.abspath(args.pickle_dir),
+        "--keep-snapshots", str(args.keep_snapshots),
+        "--full-snapshot-every", str(args.full_snapshot_every),
+        "--snapshot-format", args.snapshot_format,
+        # The worker skips the refresh if the snapshot is fresh by the same limit
+        "--max-age", str(args.max_age),
+    ]
+    if args.snapshot_max_age is not None:
+        command += ["--snapshot-max-age", str(args.snapshot_max_age)]
+    if args.component_ttls is not None:
+        command += ["--component-ttls", ",".join(f"{c}={t:g}" for c, t in args.component_ttls.items())]
+    return command
+
+async def run(args, out) -> int:
+    """Run a single lookup or a batch with parsed command line arguments"""
     # Get RPC URL
     rpc_url = args.rpc or os.environ.get("RPC_URL")
     if not rpc_url:
@@ -606,22 +1143,57 @@ async def main():
     
     # Setup connection
     connection = AsyncClient(rpc_url)
+    if args.stale_while_revalidate:
+        # The background worker gets the RPC URL from its environment, not its (visible) command line
+        os.environ["RPC_URL"] = rpc_url
     
     # Create position viewer with pickle settings
     viewer = DriftPositionViewer(
         connection, 
         pickle_dir=args.pickle_dir,
-        force_refresh=args.force_refresh
+        force_refresh=args.force_refresh,
+        keep_snapshots=args.keep_snapshots,
+        snapshot_max_age=args.snapshot_max_age,
+        snapshot_format=args.snapshot_format,
+        full_snapshot_every=args.full_snapshot_every,
+        max_age=args.max_age,
+        hard_max_age=args.hard_max_age or None,
+        refresh_command=refresh_command(args) if args.stale_while_revalidate else None,
+        component_ttls=args.component_ttls
     )
     
     try:
+        if args.refresh_snapshot:
+            await viewer.refresh_snapshot()
+            return 0
+        
+        # Batch mode: one snapshot load, many authorities
+        if args.authorities_file:
+            if not args.direct:
+                print("Initializing...")
+                await viewer.initialize()
+            failures = await run_batch(
+                viewer, args.authorities_file, args.output_format, args.concurrency, args.direct, out
+            )
+            return 1 if failures else 0
+        
         # Initialize (will use pickles if available and fresh)
         print("Initializing...")
-        await viewer.initialize()
+        if args.direct:
+            await viewer.initialize_direct(Pubkey.from_string(args.authority))
+        else:
+            await viewer.initialize()
         
         # Get and display positions
         positions_data = await viewer.get_user_positions(args.authority)
-        print_positions(positions_data)
+        if args.output_format == "ndjson":
+            out.write(json.dumps(positions_data, default=str) + "\n")
+        elif args.output_format == "csv":
+            csv_writer = csv.DictWriter(out, fieldnames=CSV_FIELDS, extrasaction="ignore")
+            csv_writer.writeheader()
+            csv_writer.writerows(position_rows(positions_data))
+        else:
+            print_positions(positions_data)
             
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -637,6 +1209,7 @@ async def main():
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("Usage: python drift-positions.py <AUTHORITY_ADDRESS> [--rpc <RPC_URL>] [--force-refresh] [--pickle-dir <DIRECTORY>]")
+        print("       python drift-positions.py --authorities-file <FILE|-> [--output-format {text,ndjson,csv}] [--direct --concurrency N]")
         sys.exit(1)
     
     exit_code = asyncio.run(main())
@@ -46,12 +46,14 @@ from driftpy.drift_user import DriftUser
 from driftpy.accounts import DataAndSlot, UserAccount
 from driftpy.user_map.user_map import UserMap
 from driftpy.user_map.user_map_config import UserMapConfig, PollingConfig
-from driftpy.constants.numeric_constants import QUOTE_SPOT_MARKET_INDEX
 from driftpy.types import SpotPosition, PerpPosition, MarketType
 from driftpy.keypair import load_keypair
 from driftpy.market_map.market_map import MarketMap
 from driftpy.market_map.market_map_config import MarketMapConfig, WebsocketConfig
 
+from authority_index import AuthorityIndex
+from market_metadata import MarketMetadata
+
 # Load environment variables
 load_dotenv()
 
@@ -87,7 +89,9 @@ class EnhancedUserMap:
         self.connection = connection
         self.wallet = wallet
         self.drift_client = DriftClient(connection, wallet)
+        self.market_metadata = MarketMetadata(self.drift_client)
         self.user_map = None
+        self.authority_index = None
     
     async def initialize(self):
         """Initialize the drift client and market map"""
@@ -100,6 +104,8 @@ class EnhancedUserMap:
                 include_idle=True,  # Include idle accounts
             )
         )
+        # Kept current by every polling sync
+        self.authority_index = AuthorityIndex(self.user_map)
         await self.user_map.subscribe()
         
     async def cleanup(self):
@@ -113,21 +119,11 @@ class EnhancedUserMap:
         if not self.user_map:
             raise ValueError("UserMap not initialized")
         
-        users = []
-        
         # Sync the user map to fetch all accounts
         await self.user_map.sync()
         
-        # Find all accounts with matching authority
-        for user in self.user_map.values():
-            try:
-                user_authority = user.get_user_account().authority
-                if str(user_authority) == str(authority_pubkey):
-                    users.append(user)
-            except Exception as e:
-                print(f"Error checking user authority: {e}")
-        
-        return users
+        # Authority index lookup instead of scanning every user
+        return self.authority_index.get_users(authority_pubkey)
     
     async def get_user_by_account(self, user_account_pubkey: Pubkey) -> Optional[DriftUser]:
         """Get a specific user account by its address"""
@@ -142,11 +138,9 @@ class EnhancedUserMap:
     
     def format_perp_position(self, user: DriftUser, position: PerpPosition) -> FormattedPosition:
         """Format a perpetual position for display"""
-        market = self.drift_client.get_perp_market_account(position.market_index)
+        market_info = self.market_metadata.perp(position.market_index)
         oracle_price_data = user.get_oracle_data_for_perp_market(position.market_index)
-        
-        # Decode market name from bytes
-        market_name = bytes(market.name).decode('utf-8').strip('\x00')
+        market_name = market_info.name
         
         # Get position value in USD
         position_value = user.get_perp_position_value(
@@ -156,7 +150,7 @@ class EnhancedUserMap:
         )
         
         # Calculate base asset amount with precision adjustment
-        base_asset_amount = position.base_asset_amount / 1e9  # BASE_PRECISION
+        base_asset_amount = position.base_asset_amount / market_info.precision  # BASE_PRECISION
         
         # Calculate entry price if possible
         entry_price = None
@@ -193,22 +187,19 @@ class EnhancedUserMap:
     
     def format_spot_position(self, user: DriftUser, position: SpotPosition) -> FormattedPosition:
         """Format a spot market position for display"""
-        market = self.drift_client.get_spot_market_account(position.market_index)
+        market_info = self.market_metadata.spot(position.market_index)
         oracle_price_data = user.get_oracle_data_for_spot_market(position.market_index)
-        
-        # Decode market name from bytes
-        market_name = bytes(market.name).decode('utf-8').strip('\x00')
+        market_name = market_info.name
         
         # Get token amount with proper sign (positive for deposits, negative for borrows)
         token_amount = user.get_token_amount(position.market_index)
         
         # Convert to human readable format based on decimals
-        decimals = market.decimals
-        formatted_token_amount = token_amount / (10 ** decimals)
+        formatted_token_amount = token_amount / market_info.precision
         
         # Calculate token value in USD
         token_value = 0
-        if position.market_index == QUOTE_SPOT_MARKET_INDEX:
+        if market_info.is_quote:
             # For USDC, the value is just the token amount
             token_value = abs(formatted_token_amount)
         else:
@@ -241,6 +232,9 @@ class EnhancedUserMap:
             "spot_positions": []
         }
         
+        # Rebuilt only if a market update arrived since the last call
+        self.market_metadata.refresh()
+        
         # Get active perpetual positions
         perp_positions = user.get_active_perp_positions()
         for position in perp_positions:
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Resumable, batch-checkpointed CSV exports
+
+The bulk exports scan the account pubkeys once, then fetch them in numbered
+getMultipleAccounts batches. ExportCheckpoint makes that restartable. It keeps
+a `<output>.parts/` directory next to the output file containing:
+
+    pubkeys.bin       the scanned pubkey list (32 bytes each), in batch order
+    checkpoint.json   sha256 of pubkeys.bin, batch size, completed and empty batch ranges
+    NNNNNNNN.csv      one segment of CSV rows per completed batch that produced rows
+
+Each segment is written to a temp file, fsynced and renamed into place before
+its batch is recorded in checkpoint.json (itself replaced atomically), so a
+batch is either fully committed or redone. A run that dies, or finishes with
+batches that failed after retries, leaves the directory behind. Rerunning with
+the same --output reuses the stored pubkey list, fetches only the batches that
+are not committed yet, and finally appends every segment, in batch order, to
+the output file. Segments are always CSV; a Parquet export converts them when
+it finalizes (see columnar_export.csv_to_parquet).
+
+Accounts created after the original scan are not picked up by a resumed run;
+use restart=True (the scripts' --restart) to discard the checkpoint and rescan.
+
+The scripts' default output names are timestamped, so a rerun without --output
+would never find the previous run's directory. find_unfinished() returns the
+newest unfinished export whose name ends the same way, for the scripts to
+adopt as their output.
+
+Usage:
+    from export_checkpoint import ExportCheckpoint, find_unfinished
+
+    output = args.output or find_unfinished("_user_stats_fuel_export.csv") or default_output
+    checkpoint = ExportCheckpoint(output, batch_size=100)
+    pubkeys = checkpoint.resume_pubkeys() or checkpoint.start(await scan_pubkeys())
+    for index in checkpoint.pending(num_batches):
+        ...
+        checkpoint.commit_batch(index, rows)
+    if checkpoint.is_complete(num_batches):
+        checkpoint.finalize(headers)
+"""
+
+import csv
+import json
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from solders.pubkey import Pubkey # type: ignore
+
+from columnar_export import csv_to_parquet
+from file_io import atomic_open, write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 1
+
+
+def _to_ranges(indexes: Iterable[int]) -> List[List[int]]:
+    """Compress batch indexes to inclusive [start, end] ranges"""
+    ranges: List[List[int]] = []
+    for index in sorted(indexes):
+        if ranges and index == ranges[-1][1] + 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ranges
+
+
+def _from_ranges(ranges: Iterable[Sequence[int]]) -> set:
+    return {index for start, end in ranges for index in range(start, end + 1)}
+
+
+def find_unfinished(suffix: str, directory: str = ".") -> Optional[str]:
+    """
+    Output path of the most recently checkpointed unfinished export in `directory` whose
+    filename ends in `suffix` (e.g. "_user_stats_fuel_export.csv"), or None if there is none
+    """
+    parts_dirs = [path for path in Path(directory).glob(f"*{suffix}.parts") if (path / "checkpoint.json").is_file()]
+    if not parts_dirs:
+        return None
+    newest = max(parts_dirs, key=lambda path: (path / "checkpoint.json").stat().st_mtime)
+    return str(newest)[:-len(".parts")]
+
+
+class ExportCheckpoint:
+    """Checkpoint directory for one export output file"""
+
+    def __init__(self, output: str, batch_size: int, restart: bool = False):
+        self.output = Path(output)
+        self.batch_size = batch_size
+        self.parts_dir = Path(f"{output}.parts")
+        self.state_path = self.parts_dir / "checkpoint.json"
+        self.pubkeys_path = self.parts_dir / "pubkeys.bin"
+        self.completed: set = set()
+        # Completed batches that produced no rows (and have no segment file)
+        self.empty: set = set()
+        self._state: dict = {}
+
+        if restart and self.parts_dir.exists():
+            logger.info(f"Discarding checkpoint {self.parts_dir}")
+            shutil.rmtree(self.parts_dir)
+
+    def segment_path(self, index: int) -> Path:
+        return self.parts_dir / f"{index:08d}.csv"
+
+    def resume_pubkeys(self) -> Optional[List[Pubkey]]:
+        """
+        The pubkey list of a previous run if its checkpoint is intact and was written with the
+        same batch size; otherwise None (the caller scans and calls start()).
+        """
+        try:
+            state = json.loads(self.state_path.read_text())
+            raw = self.pubkeys_path.read_bytes()
+        except (OSError, ValueError):
+            return None
+
+        if (state.get("version") != CHECKPOINT_VERSION or state.get("batch_size") != self.batch_size
+                or hashlib.sha256(raw).hexdigest() != state.get("pubkeys_sha256")
+                or len(raw) != 32 * state.get("num_pubkeys", -1)):
+            logger.warning(f"Checkpoint {self.parts_dir} does not match this export; starting over")
+            return None
+
+        self._state = state
+        self.empty = _from_ranges(state.get("empty", []))
+        self.completed = {
+            index for index in _from_ranges(state.get("completed", []))
+            if index in self.empty or self.segment_path(index).exists()
+        }
+        logger.info(f"Resuming from {self.parts_dir}: {len(self.completed)} batches already committed")
+        return [Pubkey(raw[i:i + 32]) for i in range(0, len(raw), 32)]
+
+    def start(self, pubkeys: Sequence[Pubkey]) -> List[Pubkey]:
+        """Begin a fresh checkpoint for `pubkeys` (clears any previous one); returns the list"""
+        pubkeys = list(pubkeys)
+        if self.parts_dir.exists():
+            shutil.rmtree(self.parts_dir)
+        self.parts_dir.mkdir(parents=True)
+
+        raw = b"".join(bytes(pubkey) for pubkey in pubkeys)
+        with atomic_open(self.pubkeys_path) as f:
+            f.write(raw)
+        self._state = {
+            "version": CHECKPOINT_VERSION,
+            "pubkeys_sha256": hashlib.sha256(raw).hexdigest(),
+            "num_pubkeys": len(pubkeys),
+            "batch_size": self.batch_size,
+            "completed": [],
+            "empty": [],
+        }
+        self.completed = set()
+        self.empty = set()
+        self._save_state()
+        logger.info(f"Checkpointing to {self.parts_dir}; rerun with --output {self.output} to resume")
+        return pubkeys
+
+    def _save_state(self):
+        self._state["completed"] = _to_ranges(self.completed)
+        self._state["empty"] = _to_ranges(self.empty)
+        write_json_atomic(self.state_path, self._state)
+
+    def pending(self, num_batches: int) -> List[int]:
+        """Batch indexes not committed yet"""
+        return [index for index in range(num_batches) if index not in self.completed]
+
+    def is_complete(self, num_batches: int) -> bool:
+        return len(self.completed) >= num_batches
+
+    def commit_batch(self, index: int, rows: Iterable[Sequence]):
+        """
+        Write one batch's rows as a segment, then record the batch as completed. A batch
+        without rows is recorded as completed and empty, without a segment.
+        """
+        rows = list(rows)
+        if not rows:
+            self.empty.add(index)
+            self.completed.add(index)
+            self._save_state()
+            return
+        with atomic_open(self.segment_path(index), "w", newline="") as f:
+            csv.writer(f).writerows(rows)
+        self.completed.add(index)
+        self._save_state()
+
+    def finalize(self, headers: Sequence[str], columns: Optional[Sequence[Tuple[str, str]]] = None):
+        """
+        Append every segment, in batch order, to the output file and remove the checkpoint.
+
+        Args:
+            headers: CSV header row
+            columns: Typed (name, type) column specs; when given, the output is written as Parquet
+        """
+        segments = [self.segment_path(index) for index in sorted(self.completed - self.empty)]
+        if columns is not None:
+            csv_to_parquet(segments, self.output, columns)
+            shutil.rmtree(self.parts_dir)
+            return
+
+        with atomic_open(self.output, "w", newline="") as out:
+            csv.writer(out).writerow(headers)
+            for path in segments:
+                with open(path, newline="") as segment:
+                    shutil.copyfileobj(segment, out)
+        shutil.rmtree(self.parts_dir)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Small file helpers shared by the on-disk stores (VAT snapshots, fuel time series)
+
+Writes go to a temporary file next to the target, are fsynced, and are renamed
+into place, so a reader sees either the old file or the complete new one.
+
+Usage:
+    from file_io import atomic_open, file_checksum, write_json_atomic
+
+    with atomic_open("snap-000001.npy") as f:
+        np.save(f, array)
+    write_json_atomic("catalog.json", {"version": 1})
+    checksum = file_checksum("export.csv")
+"""
+
+import os
+import json
+import hashlib
+from contextlib import contextmanager
+from typing import Optional
+
+
+@contextmanager
+def atomic_open(path, mode: str = "wb", newline: Optional[str] = None):
+    """Open a temp file for writing; on success it is fsynced and renamed over `path`, on error removed"""
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    try:
+        with open(tmp_path, mode, newline=newline) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def write_json_atomic(path, data: dict):
+    """Write JSON to a temp file and rename it into place so readers never see a partial file"""
+    with atomic_open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def file_checksum(path, chunk_size: int = 1 << 20) -> str:
+    """SHA-256 of a file, read in chunks so large files don't load into memory"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
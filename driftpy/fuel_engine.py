@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+Vectorized fuel engine
+
+DriftUser.get_fuel_bonus() computes one sub-account's fuel: the settled fuel
+stored in the authority's UserStats plus the unsettled fuel its positions (and
+the authority's gov-token insurance stake) have earned since the last update.
+Calling it per authority needs a DriftUser, a UserStats subscription and a walk
+over every position in Python. This module computes the same quantities for a
+whole snapshot at once from:
+
+    - raw User accounts, viewed through position_engine.USER_DTYPE
+    - decoded UserStats records (user_stats_decoder.decode_user_stats_batch)
+    - per-market prices and fuel boosts (FuelMarketArrays)
+
+Results are totalled per authority: settled fuel from UserStats, unsettled
+position fuel summed over all of the authority's sub-accounts, and unsettled
+insurance fuel once per authority. compute_fuel(..., per_sub_account=True)
+instead returns one row per sub-account, as get_fuel_bonus() would.
+
+evaluate_fuel_bonus() is the detached single-account form: get_fuel_bonus() for
+one already-fetched User (and its UserStats) with no DriftUser, subscription or
+patched DriftClient, so it is safe to run concurrently.
+
+Amounts are computed with exact integer arithmetic in the SDK's order of
+operations (wide products use Python-int object arrays), so each term matches
+the SDK's math.fuel helpers. Differences from get_fuel_bonus():
+    - settled fuel_insurance is included (the Python SDK leaves it out of the
+      settled total; the program and the TypeScript SDK include it)
+    - LP shares are not settled into the base amount (same as position_engine)
+
+Usage:
+    from fuel_engine import FuelMarketArrays, compute_fuel
+    from position_engine import user_records_from_raw
+    from user_stats_decoder import decode_user_stats_batch
+
+    markets = FuelMarketArrays.from_drift_client(drift_client)
+    fuel = compute_fuel(user_records_from_raw(raw_users), decode_user_stats_batch(raw_stats), markets, now)
+    for i in range(len(fuel)):
+        print(fuel.authority(i), fuel.bonus(i))
+
+    bonus = evaluate_fuel_bonus(user_account, user_stats_account, markets, now)
+"""
+
+from dataclasses import dataclass
+from typing import Dict
+
+import numpy as np
+from solders.pubkey import Pubkey # type: ignore
+
+from driftpy.constants.numeric_constants import (
+    AMM_RESERVE_PRECISION,
+    FIVE_MINUTE,
+    FUEL_START_TS,
+    FUEL_WINDOW,
+    GOV_SPOT_MARKET_INDEX,
+    QUOTE_PRECISION,
+)
+from driftpy.types import is_variant
+
+from position_engine import SPOT_BALANCE_TYPE_BORROW, user_records_from_accounts, user_records_from_raw
+from user_stats_decoder import USER_STATS_DTYPE, decode_user_stats_batch, user_stats_records_from_accounts
+
+# Same keys as DriftUser.get_fuel_bonus()
+FUEL_CATEGORIES = ("insurance_fuel", "taker_fuel", "maker_fuel", "deposit_fuel", "borrow_fuel", "position_fuel")
+
+# UserStats field holding the settled amount of each category
+SETTLED_FIELDS = {
+    "insurance_fuel": "fuel_insurance",
+    "taker_fuel": "fuel_taker",
+    "maker_fuel": "fuel_maker",
+    "deposit_fuel": "fuel_deposits",
+    "borrow_fuel": "fuel_borrows",
+    "position_fuel": "fuel_positions",
+}
+
+# int() over an object array, elementwise
+_to_int = np.frompyfunc(int, 1, 1)
+
+# Positions worth this much or less (QUOTE_PRECISION) earn no fuel
+FUEL_DUST = QUOTE_PRECISION
+FUEL_SCALE = QUOTE_PRECISION // 10
+
+
+@dataclass
+class FuelMarketArrays:
+    """Per-market prices, interest and fuel boosts, indexed by market index (object arrays of ints)"""
+    perp_price: np.ndarray            # oracle price, or expiry price for settled markets
+    perp_fuel_boost_position: np.ndarray
+    spot_decimals: np.ndarray
+    spot_price: np.ndarray            # oracle price
+    spot_twap_5min: np.ndarray        # historical_oracle_data.last_oracle_price_twap5min
+    spot_twap_ts: np.ndarray          # historical_oracle_data.last_oracle_price_twap_ts
+    spot_deposit_interest: np.ndarray
+    spot_borrow_interest: np.ndarray
+    spot_fuel_boost_deposits: np.ndarray
+    spot_fuel_boost_borrows: np.ndarray
+    gov_fuel_boost_insurance: int
+
+    @classmethod
+    def from_drift_client(cls, drift_client) -> "FuelMarketArrays":
+        """Build from a DriftClient whose markets and oracles are loaded (subscribed or resurrected)"""
+        perp_markets = drift_client.get_perp_market_accounts()
+        spot_markets = drift_client.get_spot_market_accounts()
+        num_perp = max((m.market_index for m in perp_markets), default=-1) + 1
+        num_spot = max((m.market_index for m in spot_markets), default=-1) + 1
+
+        def zeros(n):
+            return np.zeros(n, dtype=np.int64).astype(object)
+
+        arrays = cls(
+            perp_price=zeros(num_perp),
+            perp_fuel_boost_position=zeros(num_perp),
+            spot_decimals=zeros(num_spot),
+            spot_price=zeros(num_spot),
+            spot_twap_5min=zeros(num_spot),
+            spot_twap_ts=zeros(num_spot),
+            spot_deposit_interest=zeros(num_spot),
+            spot_borrow_interest=zeros(num_spot),
+            spot_fuel_boost_deposits=zeros(num_spot),
+            spot_fuel_boost_borrows=zeros(num_spot),
+            gov_fuel_boost_insurance=0,
+        )
+
+        for market in perp_markets:
+            i = market.market_index
+            if is_variant(market.status, "Settlement"):
+                arrays.perp_price[i] = market.expiry_price
+            else:
+                oracle_price_data = drift_client.get_oracle_price_data_for_perp_market(i)
+                arrays.perp_price[i] = oracle_price_data.price if oracle_price_data else 0
+            arrays.perp_fuel_boost_position[i] = market.fuel_boost_position or 0
+
+        for market in spot_markets:
+            i = market.market_index
+            oracle_price_data = drift_client.get_oracle_price_data_for_spot_market(i)
+            arrays.spot_decimals[i] = market.decimals
+            arrays.spot_price[i] = oracle_price_data.price if oracle_price_data else 0
+            arrays.spot_twap_5min[i] = market.historical_oracle_data.last_oracle_price_twap5min
+            arrays.spot_twap_ts[i] = market.historical_oracle_data.last_oracle_price_twap_ts
+            arrays.spot_deposit_interest[i] = market.cumulative_deposit_interest
+            arrays.spot_borrow_interest[i] = market.cumulative_borrow_interest
+            arrays.spot_fuel_boost_deposits[i] = market.fuel_boost_deposits or 0
+            arrays.spot_fuel_boost_borrows[i] = market.fuel_boost_borrows or 0
+            if i == GOV_SPOT_MARKET_INDEX:
+                arrays.gov_fuel_boost_insurance = market.fuel_boost_insurance or 0
+
+        return arrays
+
+    def strict_spot_prices(self, now: int):
+        """(min, max) strict oracle price per spot market: oracle price vs the live 5 minute TWAP"""
+        # calculate_live_oracle_twap(..., FIVE_MINUTE) per market
+        twap = self.spot_twap_5min
+        since_last_update = np.maximum(1, now - self.spot_twap_ts)
+        since_start = np.maximum(0, FIVE_MINUTE - since_last_update)
+        clamp_range = twap // 3
+        clamped = np.minimum(twap + clamp_range, np.maximum(self.spot_price, twap - clamp_range))
+        live_twap = (twap * since_start + clamped * since_last_update) // (since_start + since_last_update)
+
+        # StrictOraclePrice falls back to the oracle price when the TWAP is zero
+        has_twap = live_twap != 0
+        price_min = np.where(has_twap, np.minimum(live_twap, self.spot_price), self.spot_price)
+        price_max = np.where(has_twap, np.maximum(live_twap, self.spot_price), self.spot_price)
+        return price_min, price_max
+
+
+@dataclass
+class FuelTotals:
+    """Fuel per authority; each category is an object array of ints (same units as get_fuel_bonus)"""
+    authorities: np.ndarray           # 32-byte authority keys
+    fuel: Dict[str, np.ndarray]
+    last_fuel_bonus_update_ts: np.ndarray   # newest across the authority's sub-accounts (0 if none)
+    num_sub_accounts: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.authorities)
+
+    def authority(self, i: int) -> Pubkey:
+        return Pubkey(self.authorities[i].tobytes())
+
+    def bonus(self, i: int) -> Dict[str, int]:
+        """One authority's fuel as a get_fuel_bonus()-style dict"""
+        return {category: int(self.fuel[category][i]) for category in FUEL_CATEGORIES}
+
+    def total(self) -> np.ndarray:
+        return sum(self.fuel[category] for category in FUEL_CATEGORIES)
+
+
+def _fuel(value: np.ndarray, numerator: np.ndarray, boost: np.ndarray) -> np.ndarray:
+    """math.fuel: dust check, then |value| * numerator * boost // FUEL_WINDOW // (QUOTE_PRECISION // 10)"""
+    magnitude = np.abs(value)
+    fuel = magnitude * numerator * boost // FUEL_WINDOW // FUEL_SCALE
+    return np.where(magnitude <= FUEL_DUST, 0, fuel)
+
+
+def _grouped_sum(index: np.ndarray, values: np.ndarray, size: int) -> np.ndarray:
+    totals = np.zeros(size, dtype=np.int64).astype(object)
+    np.add.at(totals, index, values)
+    return totals
+
+
+def compute_fuel(users: np.ndarray, user_stats: np.ndarray, markets: FuelMarketArrays, now: int,
+                 include_settled: bool = True, include_unsettled: bool = True,
+                 per_sub_account: bool = False) -> FuelTotals:
+    """
+    Settled + unsettled fuel for every authority in a snapshot.
+
+    Args:
+        users: position_engine.USER_DTYPE records (all sub-accounts of the authorities of interest)
+        user_stats: user_stats_decoder.USER_STATS_DTYPE records
+        markets: Prices and boosts for the snapshot
+        now: Unix timestamp to accrue unsettled fuel up to
+        per_sub_account: One result row per User record instead of per authority, each with that
+            sub-account's unsettled fuel plus its authority's UserStats fuel (what get_fuel_bonus()
+            returns for that sub-account)
+    """
+    # Authority ids over the union of both account sets
+    authorities, inverse = np.unique(
+        np.concatenate([users["authority"], user_stats["authority"]]), return_inverse=True
+    )
+    inverse = inverse.reshape(-1)
+    num_authorities = len(authorities)
+    user_authority = inverse[:len(users)]
+    stats_authority = inverse[len(users):]
+
+    # Position fuel accrues per result row: the authority, or the sub-account itself
+    group = np.arange(len(users)) if per_sub_account else user_authority
+    num_groups = len(users) if per_sub_account else num_authorities
+
+    def zeros(n):
+        return np.zeros(n, dtype=np.int64).astype(object)
+
+    # UserStats fuel (settled, gov-token insurance) is per authority
+    authority_fuel = {category: zeros(num_authorities) for category in FUEL_CATEGORIES}
+    position_fuel = {category: zeros(num_groups) for category in FUEL_CATEGORIES}
+
+    if include_settled:
+        for category, field in SETTLED_FIELDS.items():
+            authority_fuel[category] += _grouped_sum(stats_authority, user_stats[field].astype(object), num_authorities)
+
+    if include_unsettled:
+        # Time since each sub-account's last fuel update, counted from the start of the fuel program
+        last_update = np.maximum(users["last_fuel_bonus_update_ts"].astype(np.int64), FUEL_START_TS)
+        numerator = np.maximum(now - last_update, 0).astype(object)
+
+        # ---- Spot (same "active" rule as DriftUser.get_active_spot_positions) ----
+        spot = users["spot_positions"]
+        rows, slots = np.nonzero((spot["scaled_balance"] != 0) | (spot["open_orders"] != 0))
+        spot = spot[rows, slots]
+        market = spot["market_index"].astype(np.int64)
+        is_borrow = spot["balance_type"] == SPOT_BALANCE_TYPE_BORROW
+
+        decimals = markets.spot_decimals[market]
+        precision_decrease = 10 ** (19 - decimals)
+        interest = np.where(is_borrow, markets.spot_borrow_interest[market], markets.spot_deposit_interest[market])
+        scaled = spot["scaled_balance"].astype(object) * interest
+        # math.spot_market.get_token_amount: deposits int(true division), borrows div_ceil; borrows are negative
+        token_amount = np.where(is_borrow, (scaled + precision_decrease - 1) // precision_decrease * -1,
+                                _to_int(scaled / precision_decrease))
+
+        price_min, price_max = markets.strict_spot_prices(now)
+        price = np.where(token_amount > 0, price_min[market], price_max[market])
+        token_value = token_amount * price // 10 ** decimals
+
+        is_deposit = token_value > 0
+        boost = np.where(is_deposit, markets.spot_fuel_boost_deposits[market],
+                         markets.spot_fuel_boost_borrows[market])
+        spot_fuel = _fuel(token_value, numerator[rows], boost)
+        owner = group[rows]
+        position_fuel["deposit_fuel"] += _grouped_sum(owner, np.where(is_deposit, spot_fuel, 0), num_groups)
+        position_fuel["borrow_fuel"] += _grouped_sum(owner, np.where(is_deposit, 0, spot_fuel), num_groups)
+
+        # ---- Perp (same "active" rule as DriftUser.get_active_perp_positions) ----
+        perp = users["perp_positions"]
+        rows, slots = np.nonzero(
+            (perp["base_asset_amount"] != 0) | (perp["quote_asset_amount"] != 0)
+            | (perp["open_orders"] != 0) | (perp["lp_shares"] != 0)
+        )
+        perp = perp[rows, slots]
+        market = perp["market_index"].astype(np.int64)
+        base_asset_value = np.abs(perp["base_asset_amount"].astype(object)) * markets.perp_price[market] \
+            // AMM_RESERVE_PRECISION
+        perp_fuel = _fuel(base_asset_value, numerator[rows], markets.perp_fuel_boost_position[market])
+        position_fuel["position_fuel"] += _grouped_sum(group[rows], perp_fuel, num_groups)
+
+        # ---- Insurance: gov-token IF stake, once per authority ----
+        staked = user_stats["if_staked_gov_token_amount"].astype(object)
+        elapsed = now - user_stats["last_fuel_if_bonus_update_ts"].astype(np.int64).astype(object)
+        insurance = np.abs(staked) * elapsed * markets.gov_fuel_boost_insurance // FUEL_WINDOW // FUEL_SCALE
+        authority_fuel["insurance_fuel"] += _grouped_sum(
+            stats_authority, np.where(staked > 0, insurance, 0), num_authorities
+        )
+
+    last_update_ts = users["last_fuel_bonus_update_ts"].astype(np.int64)
+    if per_sub_account:
+        return FuelTotals(
+            authorities=users["authority"],
+            fuel={category: authority_fuel[category][user_authority] + position_fuel[category]
+                  for category in FUEL_CATEGORIES},
+            last_fuel_bonus_update_ts=last_update_ts,
+            num_sub_accounts=np.ones(len(users), dtype=np.int64),
+        )
+
+    last_fuel_bonus_update_ts = np.zeros(num_authorities, dtype=np.int64)
+    np.maximum.at(last_fuel_bonus_update_ts, user_authority, last_update_ts)
+
+    return FuelTotals(
+        authorities=authorities,
+        fuel={category: authority_fuel[category] + position_fuel[category] for category in FUEL_CATEGORIES},
+        last_fuel_bonus_update_ts=last_fuel_bonus_update_ts,
+        num_sub_accounts=np.bincount(user_authority, minlength=num_authorities)[:num_authorities],
+    )
+
+
+def evaluate_fuel_bonus(user_account, user_stats_account, markets: FuelMarketArrays, now: int,
+                        include_settled: bool = True, include_unsettled: bool = True) -> Dict[str, int]:
+    """
+    DriftUser.get_fuel_bonus() for one sub-account, from already-fetched account data.
+
+    Nothing is subscribed and no client state is touched, so any number of these can run
+    concurrently against the same FuelMarketArrays.
+
+    Args:
+        user_account: Decoded UserAccount (or raw User account bytes)
+        user_stats_account: Decoded UserStats of the same authority (UserStatsAccount or
+            UserStatsRecord), raw bytes, or None if the authority has none
+    """
+    if isinstance(user_account, (bytes, bytearray, memoryview)):
+        users = user_records_from_raw([user_account])
+    else:
+        users = user_records_from_accounts([user_account])
+    if user_stats_account is None:
+        user_stats = np.zeros(0, dtype=USER_STATS_DTYPE)
+    elif isinstance(user_stats_account, (bytes, bytearray, memoryview)):
+        user_stats = decode_user_stats_batch([bytes(user_stats_account)])
+    else:
+        user_stats = user_stats_records_from_accounts([user_stats_account])
+
+    fuel = compute_fuel(users, user_stats, markets, now, include_settled=include_settled,
+                        include_unsettled=include_unsettled, per_sub_account=True)
+    return fuel.bonus(0)
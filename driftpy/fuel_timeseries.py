@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Append-only, columnar fuel time-series store
+
+Every fuel / UserStats export (CSV or Parquet) is ingested once into a local
+directory. Later questions are answered from that store instead of re-parsing
+the raw exports:
+
+    authorities.txt     append-only authority dictionary, one base58 pubkey per
+                        line; an authority's id is its line number
+    snap-NNNNNN.npy     one NumPy structured array per snapshot (SNAPSHOT_DTYPE):
+                        authority id, the six fuel categories and their total,
+                        sorted by authority id
+    catalog.json        the snapshots (export time, slot, source file, its
+                        sha256, row count) and the authority count they use
+
+Snapshots are never rewritten. An ingest writes its array under a temporary
+name and renames it into place, appends any new authorities, and only then
+replaces catalog.json atomically. A crash mid-ingest leaves the previous
+catalog, and the authority lines it does not account for are ignored (and
+overwritten) on the next open. Ingesting a file whose sha256 is already in the
+catalog is a no-op.
+
+Snapshot arrays are memory-mapped and sorted by authority id, so comparing two
+snapshots is a merge on integer keys, and one authority's history is a binary
+search per snapshot.
+
+Usage:
+    from fuel_timeseries import FuelTimeSeriesStore
+
+    store = FuelTimeSeriesStore("fuel-store")
+    store.ingest("06122025140049_user_stats_fuel_export.csv")
+    older, newer = store.snapshots[-2], store.snapshots[-1]
+    accrual = store.accrual(older, newer)           # per-authority delta and FUEL/day
+    movers = store.top_movers(older, newer, n=20)
+    history = store.history("9xQeWvG816bUx9EPjHmaT23yvVM2ZWbrrpZb9PusVFin")
+"""
+
+import os
+import re
+import json
+import datetime
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+from columnar_export import column_names, iter_frames
+from file_io import atomic_open, file_checksum, write_json_atomic
+
+FUEL_CATEGORIES = ["fuel_insurance", "fuel_deposits", "fuel_borrows", "fuel_positions", "fuel_taker", "fuel_maker"]
+
+SNAPSHOT_DTYPE = np.dtype(
+    [("authority_id", "<u4")] + [(name, "<f8") for name in FUEL_CATEGORIES] + [("total", "<f8")]
+)
+
+CATALOG_FILENAME = "catalog.json"
+AUTHORITIES_FILENAME = "authorities.txt"
+CATALOG_VERSION = 1
+
+# Exporters prefix their default filenames with the export time, e.g. 06122025140049_user_stats_fuel_export.csv
+EXPORT_TIME_PATTERN = re.compile(r"^(\d{14})_")
+EXPORT_TIME_FORMAT = "%m%d%Y%H%M%S"
+
+DEFAULT_CHUNK_ROWS = 1_000_000
+
+
+def export_time_from_filename(path) -> Optional[float]:
+    """Export time encoded in an exporter's default filename, or None"""
+    match = EXPORT_TIME_PATTERN.match(os.path.basename(str(path)))
+    if not match:
+        return None
+    try:
+        return datetime.datetime.strptime(match.group(1), EXPORT_TIME_FORMAT).timestamp()
+    except ValueError:
+        return None
+
+
+@dataclass
+class FuelSnapshot:
+    """One ingested export"""
+    id: int
+    filename: str
+    timestamp: float
+    slot: Optional[int]
+    source: str
+    checksum: str
+    rows: int
+
+    @property
+    def time(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.timestamp)
+
+
+class FuelTimeSeriesStore:
+    """Ingests fuel exports and answers per-authority accrual, top-mover and history queries"""
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.catalog_path = self.directory / CATALOG_FILENAME
+        self.authorities_path = self.directory / AUTHORITIES_FILENAME
+
+        catalog = {}
+        if self.catalog_path.exists():
+            catalog = json.loads(self.catalog_path.read_text())
+        self.snapshots: List[FuelSnapshot] = sorted(
+            (FuelSnapshot(**entry) for entry in catalog.get("snapshots", [])),
+            key=lambda snapshot: (snapshot.timestamp, snapshot.id),
+        )
+        num_authorities = int(catalog.get("authorities", 0))
+
+        # Only the authorities a published catalog accounts for are valid
+        self.authorities: List[str] = []
+        if self.authorities_path.exists():
+            with open(self.authorities_path) as f:
+                self.authorities = [line.rstrip("\n") for _, line in zip(range(num_authorities), f)]
+        self._authority_ids: Dict[str, int] = {authority: i for i, authority in enumerate(self.authorities)}
+        self._arrays: Dict[int, np.ndarray] = {}
+
+    # ---- Ingest ----
+
+    def ingest(self, path, timestamp: Optional[float] = None, slot: Optional[int] = None,
+               chunk_rows: int = DEFAULT_CHUNK_ROWS) -> FuelSnapshot:
+        """
+        Add one export to the store (no-op if the same file content was ingested before).
+
+        Args:
+            path: CSV or Parquet export with an authority (or authority_address) column and either the
+                  six fuel_* columns or a totalFuel column
+            timestamp: Export time (default: from an exporter's default filename, else the file mtime)
+            slot: Slot the export was taken at, if known
+
+        Raises:
+            ValueError: if the export lacks the authority or fuel columns
+        """
+        checksum = file_checksum(str(path))
+        for snapshot in self.snapshots:
+            if snapshot.checksum == checksum:
+                return snapshot
+
+        columns = {name.strip(): name for name in column_names(path)}
+        authority_column = "authority" if "authority" in columns else "authority_address"
+        if authority_column not in columns:
+            raise ValueError(f"'{path}' has no 'authority' or 'authority_address' column")
+        categories = [name for name in FUEL_CATEGORIES if name in columns]
+        if len(categories) != len(FUEL_CATEGORIES) and "totalFuel" not in columns:
+            raise ValueError(f"'{path}' has neither all of {', '.join(FUEL_CATEGORIES)} nor a totalFuel column")
+        value_columns = categories if len(categories) == len(FUEL_CATEGORIES) else ["totalFuel"]
+
+        # Ids for authorities this export adds; merged into _authority_ids once they are on disk
+        new_ids: Dict[str, int] = {}
+        parts = []
+        for chunk in iter_frames(path, [columns[authority_column]] + [columns[name] for name in value_columns], chunk_rows):
+            chunk.columns = chunk.columns.str.strip()
+            authorities = chunk[authority_column].astype(str)
+            ids = authorities.map(self._authority_ids)
+            missing = ids.isna()
+            for authority in authorities[missing].unique():
+                new_ids.setdefault(authority, len(self.authorities) + len(new_ids))
+            ids[missing] = authorities[missing].map(new_ids)
+
+            part = pd.DataFrame({"authority_id": ids.to_numpy(dtype=np.uint32)})
+            for name in value_columns:
+                part[name] = pd.to_numeric(chunk[name], errors="coerce").fillna(0).to_numpy(dtype=np.float64)
+            parts.append(part)
+
+        frame = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame({"authority_id": np.array([], np.uint32)})
+        # Sub-account level exports carry an authority more than once: sum its rows
+        frame = frame.groupby("authority_id", sort=True).sum()
+        array = np.zeros(len(frame), dtype=SNAPSHOT_DTYPE)
+        array["authority_id"] = frame.index.to_numpy(dtype=np.uint32)
+        if value_columns == ["totalFuel"]:
+            array["total"] = frame["totalFuel"].to_numpy() if len(frame) else []
+        else:
+            for name in FUEL_CATEGORIES:
+                array[name] = frame[name].to_numpy() if len(frame) else []
+            array["total"] = sum(array[name] for name in FUEL_CATEGORIES) if len(frame) else []
+
+        snapshot_id = max((snapshot.id for snapshot in self.snapshots), default=0) + 1
+        filename = f"snap-{snapshot_id:06d}.npy"
+        with atomic_open(self.directory / filename) as f:
+            np.save(f, array)
+
+        self._append_authorities(list(new_ids))
+        self._authority_ids.update(new_ids)
+
+        if timestamp is None:
+            timestamp = export_time_from_filename(path) or os.path.getmtime(path)
+        snapshot = FuelSnapshot(
+            id=snapshot_id, filename=filename, timestamp=float(timestamp), slot=slot,
+            source=os.path.basename(str(path)), checksum=checksum, rows=len(array),
+        )
+        self.snapshots.append(snapshot)
+        self.snapshots.sort(key=lambda s: (s.timestamp, s.id))
+        self._write_catalog()
+        return snapshot
+
+    def _append_authorities(self, new_authorities: Sequence[str]):
+        # Drop lines from an ingest that crashed before publishing its catalog
+        with open(self.authorities_path, "a+") as f:
+            f.seek(0)
+            valid_bytes = sum(len(authority) + 1 for authority in self.authorities)
+            f.truncate(valid_bytes)
+            f.seek(valid_bytes)
+            f.writelines(f"{authority}\n" for authority in new_authorities)
+            f.flush()
+            os.fsync(f.fileno())
+        self.authorities.extend(new_authorities)
+
+    def _write_catalog(self):
+        write_json_atomic(str(self.catalog_path), {
+            "version": CATALOG_VERSION,
+            "authorities": len(self.authorities),
+            "snapshots": [asdict(snapshot) for snapshot in sorted(self.snapshots, key=lambda s: s.id)],
+        })
+
+    # ---- Lookup ----
+
+    def find(self, at: Optional[float] = None, slot: Optional[int] = None) -> FuelSnapshot:
+        """
+        The newest snapshot taken at or before a time (unix seconds) or slot; the newest one if neither is given.
+
+        Raises:
+            LookupError: if no snapshot qualifies
+        """
+        candidates = self.snapshots
+        if at is not None:
+            candidates = [snapshot for snapshot in candidates if snapshot.timestamp <= at]
+        if slot is not None:
+            candidates = [snapshot for snapshot in candidates if snapshot.slot is not None and snapshot.slot <= slot]
+        if not candidates:
+            raise LookupError(f"No snapshot at or before {'slot ' + str(slot) if slot is not None else at}")
+        return candidates[-1]
+
+    def get(self, snapshot_id: int) -> FuelSnapshot:
+        for snapshot in self.snapshots:
+            if snapshot.id == snapshot_id:
+                return snapshot
+        raise LookupError(f"No snapshot with id {snapshot_id}")
+
+    def load(self, snapshot: FuelSnapshot) -> np.ndarray:
+        """Memory-mapped SNAPSHOT_DTYPE array of a snapshot, sorted by authority id"""
+        if snapshot.id not in self._arrays:
+            self._arrays[snapshot.id] = np.load(self.directory / snapshot.filename, mmap_mode="r")
+        return self._arrays[snapshot.id]
+
+    # ---- Queries ----
+
+    def accrual(self, older: FuelSnapshot, newer: FuelSnapshot, column: str = "total") -> pd.DataFrame:
+        """
+        Per-authority fuel change between two snapshots (outer join on authority id).
+
+        Authorities absent from a snapshot count as 0 there; in_older / in_newer say which were present.
+        per_day is the change divided by the time between the snapshots, in days.
+        """
+        a, b = self.load(older), self.load(newer)
+        ids = np.union1d(a["authority_id"], b["authority_id"])
+        fuel_a, in_a = self._align(a, ids, column)
+        fuel_b, in_b = self._align(b, ids, column)
+        delta = fuel_b - fuel_a
+        days = (newer.timestamp - older.timestamp) / 86400
+        authorities = np.asarray(self.authorities, dtype=object)
+        return pd.DataFrame({
+            "authority": authorities[ids],
+            "fuel_older": fuel_a,
+            "fuel_newer": fuel_b,
+            "delta": delta,
+            "per_day": delta / days if days > 0 else np.nan,
+            "in_older": in_a,
+            "in_newer": in_b,
+        })
+
+    def top_movers(self, older: FuelSnapshot, newer: FuelSnapshot, n: int = 20, column: str = "total",
+                   ascending: bool = False) -> pd.DataFrame:
+        """The n authorities with the largest (or, with ascending=True, most negative) change"""
+        changes = self.accrual(older, newer, column)
+        index = np.argsort(changes["delta"].to_numpy(), kind="stable")
+        index = index[:n] if ascending else index[::-1][:n]
+        return changes.iloc[index].reset_index(drop=True)
+
+    def history(self, authority: str) -> pd.DataFrame:
+        """Fuel of one authority in every snapshot it appears in, oldest first"""
+        authority_id = self._authority_ids.get(str(authority))
+        rows = []
+        if authority_id is not None:
+            for snapshot in self.snapshots:
+                array = self.load(snapshot)
+                position = np.searchsorted(array["authority_id"], authority_id)
+                if position < len(array) and array["authority_id"][position] == authority_id:
+                    record = array[position]
+                    rows.append({
+                        "snapshot": snapshot.id,
+                        "time": snapshot.time,
+                        "slot": snapshot.slot,
+                        **{name: float(record[name]) for name in FUEL_CATEGORIES + ["total"]},
+                    })
+        return pd.DataFrame(rows, columns=["snapshot", "time", "slot"] + FUEL_CATEGORIES + ["total"])
+
+    @staticmethod
+    def _align(array: np.ndarray, ids: np.ndarray, column: str):
+        keys = array["authority_id"]
+        positions = np.searchsorted(keys, ids)
+        clipped = np.minimum(positions, max(len(keys) - 1, 0))
+        present = (positions < len(keys)) & (keys[clipped] == ids) if len(keys) else np.zeros(len(ids), bool)
+        values = np.where(present, array[column][clipped] if len(keys) else 0.0, 0.0)
+        return values, present
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Per-run market metadata table for the position tools
+
+Formatting a position needs the market's name, decimals and precision. Looking
+these up through DriftClient.get_*_market_account() is a linear scan of the
+cached market list, and the name has to be decoded from its 32-byte array, for
+every single position. MarketMetadata builds a table of decoded names,
+decimals, precision divisors and quote-market flags once per market snapshot
+and serves lookups from plain dicts.
+
+The table is keyed on the slot of the market data the DriftClient is serving
+(the MarketMap slot after a pickle load, or the latest market update when
+subscribed). refresh() rebuilds it only when that slot, or the set of loaded
+markets, changes; call it once per pass rather than per position.
+
+Usage:
+    from market_metadata import MarketMetadata
+
+    metadata = MarketMetadata(drift_client)
+    metadata.refresh()
+    info = metadata.spot(position.market_index)
+    amount = token_amount / info.precision
+"""
+
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from driftpy.constants.numeric_constants import BASE_PRECISION, QUOTE_SPOT_MARKET_INDEX
+
+
+def decode_market_name(name) -> str:
+    """Decode an on-chain market name byte array"""
+    return bytes(name).decode('utf-8').strip('\x00')
+
+
+@dataclass(frozen=True)
+class MarketInfo:
+    """Static per-market values used when formatting positions"""
+    market_index: int
+    name: str
+    decimals: int
+    precision: int
+    is_quote: bool
+    account: Any
+
+
+class MarketMetadata:
+    """Market metadata table rebuilt only when the underlying market snapshot changes"""
+
+    def __init__(self, drift_client):
+        self.drift_client = drift_client
+        self.perp_markets: Dict[int, MarketInfo] = {}
+        self.spot_markets: Dict[int, MarketInfo] = {}
+        self._snapshot_key: Optional[Tuple[int, int, int, int]] = None
+
+    def snapshot_key(self) -> Tuple[int, int, int, int]:
+        """(perp slot, perp count, spot slot, spot count) of the markets the client is serving"""
+        subscriber = self.drift_client.account_subscriber
+        perp = [m for m in subscriber.get_market_accounts_and_slots() if m is not None]
+        spot = [m for m in subscriber.get_spot_market_accounts_and_slots() if m is not None]
+        return (
+            max((m.slot for m in perp), default=0), len(perp),
+            max((m.slot for m in spot), default=0), len(spot),
+        )
+
+    def refresh(self, force: bool = False) -> bool:
+        """Rebuild the table if the market snapshot changed; returns True if it was rebuilt"""
+        key = self.snapshot_key()
+        if not force and key == self._snapshot_key:
+            return False
+
+        self.perp_markets = {}
+        for market in self.drift_client.get_perp_market_accounts():
+            # Perp base amounts are always in BASE_PRECISION (1e9)
+            self.perp_markets[market.market_index] = MarketInfo(
+                market_index=market.market_index,
+                name=decode_market_name(market.name),
+                decimals=9,
+                precision=BASE_PRECISION,
+                is_quote=False,
+                account=market,
+            )
+
+        self.spot_markets = {}
+        for market in self.drift_client.get_spot_market_accounts():
+            self.spot_markets[market.market_index] = MarketInfo(
+                market_index=market.market_index,
+                name=decode_market_name(market.name),
+                decimals=market.decimals,
+                precision=10 ** market.decimals,
+                is_quote=market.market_index == QUOTE_SPOT_MARKET_INDEX,
+                account=market,
+            )
+
+        self._snapshot_key = key
+        return True
+
+    def perp(self, market_index: int) -> MarketInfo:
+        info = self.perp_markets.get(market_index)
+        if info is None:
+            # A market added since the last refresh (e.g. direct mode); pick it up
+            self.refresh(force=True)
+            info = self.perp_markets[market_index]
+        return info
+
+    def spot(self, market_index: int) -> MarketInfo:
+        info = self.spot_markets.get(market_index)
+        if info is None:
+            self.refresh(force=True)
+            info = self.spot_markets[market_index]
+        return info
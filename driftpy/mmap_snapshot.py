@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped User account snapshot
+
+An alternative to the usermap_*.pkl file written by Vat.pickle(). Unpickling
+the usermap rebuilds a DriftUser for every account on the protocol, even when
+the caller only wants one authority. This format stores the raw User account
+bytes in fixed-stride records inside a single file, with two sorted sidecar
+indexes (pubkey -> record, authority -> records) at the end. Opening it is an
+mmap; a lookup binary-searches the index and decodes only the accounts it
+returns.
+
+File layout (little endian):
+    header   magic, version, stride, count, slot, data/index offsets
+    data     count records of `stride` bytes: user account pubkey, u32 data
+             length, raw User account bytes (zero padded)
+    pubkeys  count entries of (32-byte user account pubkey, u32 record), sorted
+    authors  count entries of (32-byte authority pubkey, u32 record), sorted
+
+Usage:
+    from mmap_snapshot import MmapUserSnapshot, write_user_snapshot
+
+    write_user_snapshot("usermmap_123.bin", user_map.raw.items(), slot=123)
+    snapshot = MmapUserSnapshot("usermmap_123.bin")
+    for pubkey, user_account in snapshot.decode_by_authority(authority):
+        ...
+"""
+
+import mmap
+import struct
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from solders.pubkey import Pubkey # type: ignore
+
+from driftpy.decode.user import decode_user
+from driftpy.types import UserAccount
+
+from file_io import atomic_open
+
+MAGIC = b"DRIFTUSR"
+VERSION = 1
+
+# magic, version, stride, count, slot, data_offset, pubkey_index_offset, authority_index_offset
+HEADER = struct.Struct("<8sIIQQQQQ")
+INDEX_ENTRY = struct.Struct("<32sI")
+RECORD_PREFIX = struct.Struct("<32sI")
+
+# The authority pubkey sits right after the 8-byte account discriminator
+AUTHORITY_OFFSET = 8
+
+
+def _authority_bytes(raw: bytes) -> bytes:
+    return bytes(raw[AUTHORITY_OFFSET:AUTHORITY_OFFSET + 32])
+
+
+def write_user_snapshot(path: str, accounts: Iterable[Tuple[str, bytes]], slot: int) -> int:
+    """
+    Write raw User accounts to a memory-mappable snapshot file.
+
+    Args:
+        path: Output file (written to a temp file and renamed into place)
+        accounts: (user account pubkey, raw account bytes) pairs, e.g. UserMap.raw.items()
+        slot: Slot the account data was taken at
+
+    Returns:
+        Number of accounts written
+    """
+    records = [(bytes(Pubkey.from_string(str(pubkey))), raw) for pubkey, raw in accounts]
+    stride = RECORD_PREFIX.size + max((len(raw) for _, raw in records), default=0)
+    count = len(records)
+
+    data_offset = HEADER.size
+    pubkey_index_offset = data_offset + stride * count
+    authority_index_offset = pubkey_index_offset + INDEX_ENTRY.size * count
+
+    pubkey_index = sorted((pubkey, i) for i, (pubkey, _) in enumerate(records))
+    authority_index = sorted((_authority_bytes(raw), i) for i, (_, raw) in enumerate(records))
+
+    with atomic_open(path) as f:
+        f.write(HEADER.pack(
+            MAGIC, VERSION, stride, count, slot,
+            data_offset, pubkey_index_offset, authority_index_offset,
+        ))
+        for pubkey, raw in records:
+            f.write(RECORD_PREFIX.pack(pubkey, len(raw)))
+            f.write(raw)
+            f.write(b"\x00" * (stride - RECORD_PREFIX.size - len(raw)))
+        for key, record in pubkey_index:
+            f.write(INDEX_ENTRY.pack(key, record))
+        for key, record in authority_index:
+            f.write(INDEX_ENTRY.pack(key, record))
+    return count
+
+
+class MmapUserSnapshot:
+    """Read-only, memory-mapped view over a snapshot written by write_user_snapshot()"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.stride, self.count, self.slot,
+         self.data_offset, self.pubkey_index_offset, self.authority_index_offset) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a User snapshot file")
+        if version != VERSION:
+            raise ValueError(f"Unsupported User snapshot version {version} in {path}")
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    # ---- Raw access ----
+
+    def record_pubkey(self, record: int) -> Pubkey:
+        """User account pubkey stored with a record"""
+        return Pubkey(RECORD_PREFIX.unpack_from(self._mm, self.data_offset + record * self.stride)[0])
+
+    def raw_record(self, record: int) -> bytes:
+        """Raw account bytes of a record"""
+        start = self.data_offset + record * self.stride
+        length = RECORD_PREFIX.unpack_from(self._mm, start)[1]
+        start += RECORD_PREFIX.size
+        return self._mm[start:start + length]
+
+    def _index_key(self, index_offset: int, position: int) -> bytes:
+        start = index_offset + position * INDEX_ENTRY.size
+        return self._mm[start:start + 32]
+
+    def _index_record(self, index_offset: int, position: int) -> int:
+        return INDEX_ENTRY.unpack_from(self._mm, index_offset + position * INDEX_ENTRY.size)[1]
+
+    def _lower_bound(self, index_offset: int, key: bytes) -> int:
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._index_key(index_offset, mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _records_for(self, index_offset: int, key: bytes) -> List[int]:
+        records = []
+        position = self._lower_bound(index_offset, key)
+        while position < self.count and self._index_key(index_offset, position) == key:
+            records.append(self._index_record(index_offset, position))
+            position += 1
+        return records
+
+    # ---- Lookups ----
+
+    def get_raw(self, user_pubkey) -> Optional[bytes]:
+        """Raw bytes for a user account pubkey (str or Pubkey), or None"""
+        records = self._records_for(self.pubkey_index_offset, bytes(Pubkey.from_string(str(user_pubkey))))
+        return self.raw_record(records[0]) if records else None
+
+    def get(self, user_pubkey) -> Optional[UserAccount]:
+        """Decoded UserAccount for a user account pubkey, or None"""
+        raw = self.get_raw(user_pubkey)
+        return decode_user(raw) if raw is not None else None
+
+    def raw_by_authority(self, authority) -> List[Tuple[Pubkey, bytes]]:
+        """(user account pubkey, raw bytes) for every sub-account of an authority"""
+        authority_key = bytes(Pubkey.from_string(str(authority)))
+        results = []
+        for record in self._records_for(self.authority_index_offset, authority_key):
+            results.append((self.record_pubkey(record), self.raw_record(record)))
+        return results
+
+    def decode_by_authority(self, authority) -> List[Tuple[Pubkey, UserAccount]]:
+        """Decoded (user account pubkey, UserAccount) for every sub-account of an authority"""
+        return [(pubkey, decode_user(raw)) for pubkey, raw in self.raw_by_authority(authority)]
+
+    def iter_raw(self) -> Iterator[bytes]:
+        """Raw bytes of every record, in file order"""
+        for record in range(self.count):
+            yield self.raw_record(record)
+
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Per-pass oracle price snapshot
+
+DriftUser valuations resolve oracle prices through the DriftClient for every
+position: find the market, derive its oracle id, then look the price up in the
+subscriber cache. An aggregation pass repeats that for hundreds of thousands of
+positions. OracleSnapshot captures one OraclePriceData per market at the start
+of a pass, either from the client or from the VAT perporacles_/spotoracles_
+files. Pinning it onto a DriftClient makes every oracle lookup in the pass a
+dict lookup, and every user is priced from the same prices.
+
+fetch_oracle_prices() refreshes only the oracle prices of a cached DriftClient,
+reading every market's oracle in batched getMultipleAccounts requests, so a
+snapshot's oracles can be refreshed without refetching markets or users. It is
+also how freshly fetched markets get their oracles.
+
+Usage:
+    from oracle_snapshot import OracleSnapshot
+
+    oracles = OracleSnapshot.from_drift_client(drift_client)   # or from_vat(vat)
+    with oracles.pinned(drift_client):
+        for user in user_map.values():
+            ...
+
+    slot = await fetch_oracle_prices(drift_client)
+"""
+
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from driftpy.accounts.oracle import decode_oracle
+from driftpy.accounts.types import DataAndSlot
+from driftpy.constants.numeric_constants import PRICE_PRECISION
+from driftpy.oracles.oracle_id import get_oracle_id
+from driftpy.types import OraclePriceData, is_variant
+
+from account_fetch import AccountFetcher
+
+# DriftClient methods every DriftUser valuation goes through
+PERP_ORACLE_METHOD = "get_oracle_price_data_for_perp_market"
+SPOT_ORACLE_METHOD = "get_oracle_price_data_for_spot_market"
+
+
+class OracleSnapshot:
+    """Oracle prices for every market, indexed by market index"""
+
+    def __init__(self, perp_oracles: Dict[int, OraclePriceData], spot_oracles: Dict[int, OraclePriceData]):
+        self.perp_oracles = dict(perp_oracles)
+        self.spot_oracles = dict(spot_oracles)
+        # id(drift_client) -> stack of (lookups replaced, perp lookup, spot lookup) per pin()
+        self._pins: Dict[int, list] = {}
+
+    @classmethod
+    def from_drift_client(cls, drift_client) -> "OracleSnapshot":
+        """Resolve each market's oracle once through a loaded DriftClient"""
+        perp_oracles = {
+            market.market_index: drift_client.get_oracle_price_data_for_perp_market(market.market_index)
+            for market in drift_client.get_perp_market_accounts()
+        }
+        spot_oracles = {
+            market.market_index: drift_client.get_oracle_price_data_for_spot_market(market.market_index)
+            for market in drift_client.get_spot_market_accounts()
+        }
+        return cls(perp_oracles, spot_oracles)
+
+    @classmethod
+    def from_vat(cls, vat) -> "OracleSnapshot":
+        """Use the prices a Vat read with load_oracles() (the perporacles_/spotoracles_ files)"""
+        return cls(vat.perp_oracles, vat.spot_oracles)
+
+    @property
+    def slot(self) -> int:
+        """Newest oracle slot in the snapshot"""
+        prices = [p for p in list(self.perp_oracles.values()) + list(self.spot_oracles.values()) if p is not None]
+        return max((p.slot for p in prices), default=0)
+
+    def perp(self, market_index: int) -> Optional[OraclePriceData]:
+        return self.perp_oracles.get(market_index)
+
+    def spot(self, market_index: int) -> Optional[OraclePriceData]:
+        return self.spot_oracles.get(market_index)
+
+    def pin(self, drift_client):
+        """
+        Serve the client's oracle lookups from this snapshot until unpin(). Pins nest: markets
+        missing from this snapshot resolve through whatever served the lookups before, and
+        unpin() puts that back.
+        """
+        # Instance attributes shadow the DriftClient methods
+        previous = {name: drift_client.__dict__.get(name) for name in (PERP_ORACLE_METHOD, SPOT_ORACLE_METHOD)}
+        outer_perp = getattr(drift_client, PERP_ORACLE_METHOD)
+        outer_spot = getattr(drift_client, SPOT_ORACLE_METHOD)
+
+        def perp(market_index: int) -> Optional[OraclePriceData]:
+            price = self.perp_oracles.get(market_index)
+            return price if price is not None else outer_perp(market_index)
+
+        def spot(market_index: int) -> Optional[OraclePriceData]:
+            price = self.spot_oracles.get(market_index)
+            return price if price is not None else outer_spot(market_index)
+
+        setattr(drift_client, PERP_ORACLE_METHOD, perp)
+        setattr(drift_client, SPOT_ORACLE_METHOD, spot)
+        self._pins.setdefault(id(drift_client), []).append((previous, perp, spot))
+
+    def unpin(self, drift_client):
+        """
+        Restore the lookups this snapshot's latest pin() replaced
+
+        Raises:
+            RuntimeError: if this snapshot is not pinned on the client, or another pin made
+                          after it is still in place (pins must be undone innermost first)
+        """
+        pins = self._pins.get(id(drift_client))
+        if not pins:
+            raise RuntimeError("OracleSnapshot.unpin() without a matching pin() on this client")
+        previous, perp, spot = pins[-1]
+        if (drift_client.__dict__.get(PERP_ORACLE_METHOD) is not perp
+                or drift_client.__dict__.get(SPOT_ORACLE_METHOD) is not spot):
+            raise RuntimeError("OracleSnapshot.unpin() out of order: a later pin on this client is still in place")
+        pins.pop()
+        if not pins:
+            del self._pins[id(drift_client)]
+        for name, lookup in previous.items():
+            if lookup is None:
+                drift_client.__dict__.pop(name, None)
+            else:
+                setattr(drift_client, name, lookup)
+
+    @contextmanager
+    def pinned(self, drift_client):
+        """Pin for the duration of a with block"""
+        self.pin(drift_client)
+        try:
+            yield self
+        finally:
+            self.unpin(drift_client)
+
+
+async def fetch_oracle_prices(drift_client, perp_markets=None, spot_markets=None, refetch: bool = True) -> int:
+    """
+    Read the oracle of every given market (default: every market the cached DriftClient holds)
+    and store the prices in its subscriber cache, in batched getMultipleAccounts requests
+    instead of one request per oracle.
+
+    Args:
+        perp_markets: PerpMarketAccounts whose oracles to read
+        spot_markets: SpotMarketAccounts whose oracles to read
+        refetch: Also re-read oracles the cache already has a price for
+
+    Returns:
+        Slot the oracle accounts were read at, or 0 if there was nothing to read
+    """
+    if perp_markets is None:
+        perp_markets = drift_client.get_perp_market_accounts()
+    if spot_markets is None:
+        spot_markets = drift_client.get_spot_market_accounts()
+    cache = drift_client.account_subscriber.cache["oracle_price_data"]
+
+    oracles = {}
+    for market in perp_markets:
+        oracles[get_oracle_id(market.amm.oracle, market.amm.oracle_source)] = (market.amm.oracle, market.amm.oracle_source)
+    for market in spot_markets:
+        oracles[get_oracle_id(market.oracle, market.oracle_source)] = (market.oracle, market.oracle_source)
+    if not refetch:
+        oracles = {oracle_id: oracle for oracle_id, oracle in oracles.items() if oracle_id not in cache}
+    if not oracles:
+        return 0
+
+    oracle_ids = list(oracles)
+    slot, accounts = await AccountFetcher(drift_client.connection).fetch_all([oracles[i][0] for i in oracle_ids])
+    for oracle_id, account in zip(oracle_ids, accounts):
+        oracle_source = oracles[oracle_id][1]
+        if is_variant(oracle_source, "QuoteAsset"):
+            price_data = OraclePriceData(PRICE_PRECISION, 0, 1, 1, 0, True)
+        elif account is None:
+            print(f"Warning: Oracle account {oracles[oracle_id][0]} not found")
+            continue
+        else:
+            price_data = decode_oracle(account.data, oracle_source)
+        cache[oracle_id] = DataAndSlot(slot, price_data)
+    return slot
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Drift PDA derivation with a persistent on-disk cache
+
+Pubkey.find_program_address tries bump seeds from 255 downwards, hashing each
+candidate with SHA-256 until it lands off the ed25519 curve. That costs tens of
+microseconds per call, and the bulk exports derive a UserStats PDA for every
+authority on every run. A PDA never changes for a given program, authority (and
+sub-account id), so PdaCache keeps every derived address in a local SQLite file:
+
+    user_stats(program_id, authority)                 -> UserStats PDA
+    user(program_id, authority, sub_account_id)       -> User PDA
+
+Batch lookups read the known addresses from the cache. Only the misses are
+derived, split across a process pool when there are enough of them to be worth
+it, and written back. A repeated export therefore derives only the authorities
+that are new since the last run.
+
+get_user_stats_account_public_key() / get_user_account_public_key() are the
+plain single-address derivations (memoized in memory) for scripts that look up
+one account at a time.
+
+Usage:
+    from pda_cache import PdaCache, get_user_stats_account_public_key
+
+    with PdaCache() as cache:
+        user_stats_pks = cache.user_stats_pdas(authorities, drift_client.program_id)
+        user_pks = cache.user_pdas([(authority, 0), (authority, 1)], drift_client.program_id)
+
+    pk = get_user_stats_account_public_key(authority, drift_client.program_id)
+"""
+
+import os
+import sqlite3
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from solders.pubkey import Pubkey # type: ignore
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PDA_CACHE_PATH = Path(os.getenv("DRIFT_PDA_CACHE", Path.home() / ".cache" / "drift-playground" / "pda_cache.sqlite3"))
+
+# Fewer cold derivations than this are done inline; a process pool costs more to start
+PARALLEL_THRESHOLD = 20_000
+# Keys per lookup query (SQLite caps the number of bound parameters)
+LOOKUP_CHUNK_SIZE = 500
+
+
+@lru_cache(maxsize=65536)
+def get_user_stats_account_public_key(authority: Pubkey, program_id: Pubkey) -> Pubkey:
+    """
+    Derives the userStats account public key for a given authority.
+    """
+    user_stats_account_pk, _ = Pubkey.find_program_address(
+        [b'user_stats', bytes(authority)],
+        program_id
+    )
+    return user_stats_account_pk
+
+
+@lru_cache(maxsize=65536)
+def get_user_account_public_key(authority: Pubkey, program_id: Pubkey, sub_account_id: int = 0) -> Pubkey:
+    """
+    Derives the User (sub-account) public key for a given authority and sub-account id.
+    """
+    user_account_pk, _ = Pubkey.find_program_address(
+        [b'user', bytes(authority), sub_account_id.to_bytes(2, 'little')],
+        program_id
+    )
+    return user_account_pk
+
+
+# Process pool tasks work on raw bytes so the arguments and results pickle cheaply
+
+def _derive_user_stats_chunk(args: Tuple[bytes, List[bytes]]) -> List[bytes]:
+    program_id, authorities = args
+    program = Pubkey(program_id)
+    return [bytes(Pubkey.find_program_address([b'user_stats', a], program)[0]) for a in authorities]
+
+
+def _derive_user_chunk(args: Tuple[bytes, List[Tuple[bytes, int]]]) -> List[bytes]:
+    program_id, keys = args
+    program = Pubkey(program_id)
+    return [
+        bytes(Pubkey.find_program_address([b'user', a, sub_id.to_bytes(2, 'little')], program)[0])
+        for a, sub_id in keys
+    ]
+
+
+class PdaCache:
+    """Persistent authority -> UserStats / User PDA cache"""
+
+    def __init__(self, path: Optional[Path] = None, workers: Optional[int] = None,
+                 parallel_threshold: int = PARALLEL_THRESHOLD):
+        """
+        Args:
+            path: SQLite file (default: DEFAULT_PDA_CACHE_PATH, or $DRIFT_PDA_CACHE)
+            workers: Process pool size for cold derivations (default: CPU count; 1 disables the pool)
+            parallel_threshold: Minimum number of misses before the pool is used
+        """
+        self.path = Path(path) if path is not None else DEFAULT_PDA_CACHE_PATH
+        self.workers = workers or os.cpu_count() or 1
+        self.parallel_threshold = parallel_threshold
+        self.hits = 0
+        self.derived = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS user_stats ("
+            "program_id BLOB NOT NULL, authority BLOB NOT NULL, pda BLOB NOT NULL, "
+            "PRIMARY KEY (program_id, authority)) WITHOUT ROWID"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS user ("
+            "program_id BLOB NOT NULL, authority BLOB NOT NULL, sub_account_id INTEGER NOT NULL, pda BLOB NOT NULL, "
+            "PRIMARY KEY (program_id, authority, sub_account_id)) WITHOUT ROWID"
+        )
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def _derive(self, task, program_id: bytes, keys: list) -> List[bytes]:
+        if len(keys) < self.parallel_threshold or self.workers <= 1:
+            return task((program_id, keys))
+        chunk_size = -(-len(keys) // (self.workers * 4))
+        chunks = [(program_id, keys[i:i + chunk_size]) for i in range(0, len(keys), chunk_size)]
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            return [pda for chunk in executor.map(task, chunks) for pda in chunk]
+
+    def user_stats_pdas(self, authorities: Iterable[Pubkey], program_id: Pubkey) -> List[Pubkey]:
+        """UserStats PDAs for `authorities`, in the same order"""
+        authorities = [bytes(a) for a in authorities]
+        program = bytes(program_id)
+
+        known: Dict[bytes, bytes] = {}
+        unique = list(dict.fromkeys(authorities))
+        for i in range(0, len(unique), LOOKUP_CHUNK_SIZE):
+            chunk = unique[i:i + LOOKUP_CHUNK_SIZE]
+            rows = self.db.execute(
+                f"SELECT authority, pda FROM user_stats WHERE program_id = ? "
+                f"AND authority IN ({','.join('?' * len(chunk))})",
+                [program, *chunk],
+            )
+            known.update(rows)
+
+        missing = [a for a in unique if a not in known]
+        self.hits += len(unique) - len(missing)
+        if missing:
+            logger.info(f"Deriving {len(missing)} UserStats PDAs ({len(known)} cached)")
+            derived = self._derive(_derive_user_stats_chunk, program, missing)
+            self.db.executemany(
+                "INSERT OR IGNORE INTO user_stats (program_id, authority, pda) VALUES (?, ?, ?)",
+                [(program, a, pda) for a, pda in zip(missing, derived)],
+            )
+            self.db.commit()
+            known.update(zip(missing, derived))
+            self.derived += len(missing)
+
+        return [Pubkey(known[a]) for a in authorities]
+
+    def user_pdas(self, keys: Iterable[Tuple[Pubkey, int]], program_id: Pubkey) -> List[Pubkey]:
+        """User PDAs for (authority, sub_account_id) pairs, in the same order"""
+        keys = [(bytes(a), int(sub_id)) for a, sub_id in keys]
+        program = bytes(program_id)
+
+        known: Dict[Tuple[bytes, int], bytes] = {}
+        unique = list(dict.fromkeys(keys))
+        authorities = list(dict.fromkeys(a for a, _ in unique))
+        wanted = set(unique)
+        for i in range(0, len(authorities), LOOKUP_CHUNK_SIZE):
+            chunk = authorities[i:i + LOOKUP_CHUNK_SIZE]
+            rows = self.db.execute(
+                f"SELECT authority, sub_account_id, pda FROM user WHERE program_id = ? "
+                f"AND authority IN ({','.join('?' * len(chunk))})",
+                [program, *chunk],
+            )
+            known.update(((a, sub_id), pda) for a, sub_id, pda in rows if (a, sub_id) in wanted)
+
+        missing = [k for k in unique if k not in known]
+        self.hits += len(unique) - len(missing)
+        if missing:
+            logger.info(f"Deriving {len(missing)} User PDAs ({len(known)} cached)")
+            derived = self._derive(_derive_user_chunk, program, missing)
+            self.db.executemany(
+                "INSERT OR IGNORE INTO user (program_id, authority, sub_account_id, pda) VALUES (?, ?, ?, ?)",
+                [(program, a, sub_id, pda) for (a, sub_id), pda in zip(missing, derived)],
+            )
+            self.db.commit()
+            known.update(zip(missing, derived))
+            self.derived += len(missing)
+
+        return [Pubkey(known[k]) for k in keys]
+
+    def user_stats_pda(self, authority: Pubkey, program_id: Pubkey) -> Pubkey:
+        return self.user_stats_pdas([authority], program_id)[0]
+
+    def user_pda(self, authority: Pubkey, program_id: Pubkey, sub_account_id: int = 0) -> Pubkey:
+        return self.user_pdas([(authority, sub_account_id)], program_id)[0]
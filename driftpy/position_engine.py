@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Vectorized position aggregation engine
+
+drift-positions-aggregate.py walks every DriftUser in Python and values each
+position through the SDK. This module does the same aggregation over raw User
+account bytes with NumPy instead:
+
+    1. Raw accounts are viewed through a structured dtype matching the on-chain
+       User layout (no DriftUser objects, no per-account decoding).
+    2. Active perp and spot positions are flattened into 1-D arrays
+       (user, authority id, market index, amounts).
+    3. Long/short notional, deposits/borrows, net value and unique-user counts
+       are computed with grouped vector ops against per-market price arrays.
+
+Values follow the SDK formulas (worst-case base including open orders for perp
+notional, cumulative interest for spot token amounts, unrealized PnL with
+funding for net value) but are computed in float64, so totals agree with the
+per-user SDK path to floating point rounding. Not modelled: LP share settlement
+(positions with LP shares are valued at their recorded base) and open-order
+worst-case amounts for spot positions.
+
+Usage:
+    from position_engine import PositionArrays, MarketArrays, aggregate_positions
+
+    positions = PositionArrays.from_raw(user_map.raw.values())
+    markets = MarketArrays.from_drift_client(drift_client)
+    result = aggregate_positions(positions, markets)
+"""
+
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable
+
+import numpy as np
+
+from driftpy.constants.numeric_constants import (
+    QUOTE_SPOT_MARKET_INDEX,
+    BASE_PRECISION,
+    PRICE_PRECISION,
+    QUOTE_PRECISION,
+    AMM_RESERVE_PRECISION,
+    FUNDING_RATE_BUFFER,
+)
+from driftpy.types import is_variant
+
+# On-chain account layouts (see the User, SpotPosition and PerpPosition types in the Drift IDL)
+USER_ACCOUNT_SIZE = 4376
+NUM_SPOT_POSITIONS = 8
+NUM_PERP_POSITIONS = 8
+
+SPOT_POSITION_DTYPE = np.dtype({
+    "names": ["scaled_balance", "open_bids", "open_asks", "cumulative_deposits",
+              "market_index", "balance_type", "open_orders"],
+    "formats": ["<u8", "<i8", "<i8", "<i8", "<u2", "u1", "u1"],
+    "offsets": [0, 8, 16, 24, 32, 34, 35],
+    "itemsize": 40,
+})
+
+PERP_POSITION_DTYPE = np.dtype({
+    "names": ["last_cumulative_funding_rate", "base_asset_amount", "quote_asset_amount",
+              "quote_break_even_amount", "quote_entry_amount", "open_bids", "open_asks",
+              "settled_pnl", "lp_shares", "market_index", "open_orders"],
+    "formats": ["<i8", "<i8", "<i8", "<i8", "<i8", "<i8", "<i8", "<i8", "<u8", "<u2", "u1"],
+    "offsets": [0, 8, 16, 24, 32, 40, 48, 56, 64, 92, 94],
+    "itemsize": 96,
+})
+
+USER_DTYPE = np.dtype({
+    "names": ["authority", "spot_positions", "perp_positions", "sub_account_id", "idle",
+              "last_fuel_bonus_update_ts"],
+    "formats": ["V32", (SPOT_POSITION_DTYPE, NUM_SPOT_POSITIONS), (PERP_POSITION_DTYPE, NUM_PERP_POSITIONS),
+                "<u2", "u1", "<u4"],
+    "offsets": [8, 104, 424, 4346, 4350, 4360],
+    "itemsize": USER_ACCOUNT_SIZE,
+})
+
+SPOT_BALANCE_TYPE_BORROW = 1
+
+
+def user_records_from_raw(raw_accounts: Iterable[bytes]) -> np.ndarray:
+    """View an iterable of raw User account bytes as a USER_DTYPE record array"""
+    chunks = [bytes(raw[:USER_ACCOUNT_SIZE]).ljust(USER_ACCOUNT_SIZE, b"\x00") for raw in raw_accounts]
+    if not chunks:
+        return np.zeros(0, dtype=USER_DTYPE)
+    return np.frombuffer(b"".join(chunks), dtype=USER_DTYPE)
+
+
+def user_records_from_accounts(user_accounts: Iterable[Any]) -> np.ndarray:
+    """Pack decoded UserAccount objects (e.g. DriftUser.get_user_account()) into a USER_DTYPE record array"""
+    def spot_row(position):
+        return tuple(
+            (SPOT_BALANCE_TYPE_BORROW if is_variant(position.balance_type, "Borrow") else 0)
+            if name == "balance_type" else getattr(position, name)
+            for name in SPOT_POSITION_DTYPE.names
+        )
+
+    def perp_row(position):
+        return tuple(getattr(position, name) for name in PERP_POSITION_DTYPE.names)
+
+    # driftpy.decode.user.decode_user drops empty positions; pad back to the fixed slot count
+    empty_spot = (0,) * len(SPOT_POSITION_DTYPE.names)
+    empty_perp = (0,) * len(PERP_POSITION_DTYPE.names)
+
+    def padded(rows, empty, size):
+        return rows[:size] + [empty] * (size - len(rows))
+
+    rows = [
+        (
+            bytes(account.authority),
+            padded([spot_row(p) for p in account.spot_positions], empty_spot, NUM_SPOT_POSITIONS),
+            padded([perp_row(p) for p in account.perp_positions], empty_perp, NUM_PERP_POSITIONS),
+            account.sub_account_id,
+            int(account.idle),
+            account.last_fuel_bonus_update_ts,
+        )
+        for account in user_accounts
+    ]
+    return np.array(rows, dtype=USER_DTYPE)
+
+
+@dataclass
+class PositionArrays:
+    """Active perp and spot positions of a set of users, flattened to 1-D arrays"""
+    num_users: int
+    user_authority: np.ndarray        # per user: authority id
+    num_authorities: int
+
+    perp_user: np.ndarray             # per perp position: user row
+    perp_market_index: np.ndarray
+    perp_base: np.ndarray             # base_asset_amount (BASE_PRECISION)
+    perp_quote: np.ndarray            # quote_asset_amount (QUOTE_PRECISION)
+    perp_quote_entry: np.ndarray
+    perp_open_bids: np.ndarray
+    perp_open_asks: np.ndarray
+    perp_lp_shares: np.ndarray
+    perp_last_funding: np.ndarray
+
+    spot_user: np.ndarray             # per spot position: user row
+    spot_market_index: np.ndarray
+    spot_scaled_balance: np.ndarray
+    spot_is_borrow: np.ndarray
+
+    @classmethod
+    def from_records(cls, users: np.ndarray) -> "PositionArrays":
+        """Flatten a USER_DTYPE record array"""
+        num_users = len(users)
+        _, user_authority = np.unique(users["authority"], return_inverse=True)
+        user_authority = user_authority.reshape(-1)
+        num_authorities = int(user_authority.max()) + 1 if num_users else 0
+
+        # Same "active" rules as DriftUser.get_active_perp_positions / get_active_spot_positions
+        perp = users["perp_positions"]
+        perp_active = (
+            (perp["base_asset_amount"] != 0) | (perp["quote_asset_amount"] != 0)
+            | (perp["open_orders"] != 0) | (perp["lp_shares"] != 0)
+        )
+        perp_rows, perp_slots = np.nonzero(perp_active)
+        perp = perp[perp_rows, perp_slots]
+
+        spot = users["spot_positions"]
+        spot_active = (spot["scaled_balance"] != 0) | (spot["open_orders"] != 0)
+        spot_rows, spot_slots = np.nonzero(spot_active)
+        spot = spot[spot_rows, spot_slots]
+
+        return cls(
+            num_users=num_users,
+            user_authority=user_authority,
+            num_authorities=num_authorities,
+            perp_user=perp_rows,
+            perp_market_index=perp["market_index"].astype(np.int64),
+            perp_base=perp["base_asset_amount"].astype(np.float64),
+            perp_quote=perp["quote_asset_amount"].astype(np.float64),
+            perp_quote_entry=perp["quote_entry_amount"].astype(np.float64),
+            perp_open_bids=perp["open_bids"].astype(np.float64),
+            perp_open_asks=perp["open_asks"].astype(np.float64),
+            perp_lp_shares=perp["lp_shares"].astype(np.float64),
+            perp_last_funding=perp["last_cumulative_funding_rate"].astype(np.float64),
+            spot_user=spot_rows,
+            spot_market_index=spot["market_index"].astype(np.int64),
+            spot_scaled_balance=spot["scaled_balance"].astype(np.float64),
+            spot_is_borrow=spot["balance_type"] == SPOT_BALANCE_TYPE_BORROW,
+        )
+
+    @classmethod
+    def from_raw(cls, raw_accounts: Iterable[bytes]) -> "PositionArrays":
+        """Flatten raw User account bytes (e.g. UserMap.raw.values())"""
+        return cls.from_records(user_records_from_raw(raw_accounts))
+
+
+@dataclass
+class MarketArrays:
+    """Per-market parameters and prices, indexed by market index"""
+    perp_names: Dict[int, str]
+    perp_price: np.ndarray            # oracle price (or expiry price for settled markets), PRICE_PRECISION
+    perp_funding_long: np.ndarray     # amm.cumulative_funding_rate_long
+    perp_funding_short: np.ndarray
+    spot_names: Dict[int, str]
+    spot_decimals: np.ndarray
+    spot_price: np.ndarray            # oracle price, PRICE_PRECISION
+    spot_deposit_interest: np.ndarray
+    spot_borrow_interest: np.ndarray
+
+    @classmethod
+    def from_drift_client(cls, drift_client, metadata=None) -> "MarketArrays":
+        """
+        Build from a DriftClient whose markets and oracles are loaded (subscribed or resurrected).
+        Market names come from a refreshed market_metadata.MarketMetadata when one is given.
+        """
+        perp_markets = drift_client.get_perp_market_accounts()
+        spot_markets = drift_client.get_spot_market_accounts()
+        num_perp = max((m.market_index for m in perp_markets), default=-1) + 1
+        num_spot = max((m.market_index for m in spot_markets), default=-1) + 1
+
+        arrays = cls(
+            perp_names={},
+            perp_price=np.zeros(num_perp),
+            perp_funding_long=np.zeros(num_perp),
+            perp_funding_short=np.zeros(num_perp),
+            spot_names={},
+            spot_decimals=np.zeros(num_spot, dtype=np.int64),
+            spot_price=np.zeros(num_spot),
+            spot_deposit_interest=np.zeros(num_spot),
+            spot_borrow_interest=np.zeros(num_spot),
+        )
+
+        for market in perp_markets:
+            i = market.market_index
+            arrays.perp_names[i] = (metadata.perp(i).name if metadata
+                                    else bytes(market.name).decode('utf-8').strip('\x00'))
+            if is_variant(market.status, "Settlement"):
+                arrays.perp_price[i] = market.expiry_price
+            else:
+                oracle_price_data = drift_client.get_oracle_price_data_for_perp_market(i)
+                arrays.perp_price[i] = oracle_price_data.price if oracle_price_data else 0
+            arrays.perp_funding_long[i] = market.amm.cumulative_funding_rate_long
+            arrays.perp_funding_short[i] = market.amm.cumulative_funding_rate_short
+
+        for market in spot_markets:
+            i = market.market_index
+            arrays.spot_names[i] = (metadata.spot(i).name if metadata
+                                    else bytes(market.name).decode('utf-8').strip('\x00'))
+            arrays.spot_decimals[i] = market.decimals
+            oracle_price_data = drift_client.get_oracle_price_data_for_spot_market(i)
+            arrays.spot_price[i] = oracle_price_data.price if oracle_price_data else 0
+            arrays.spot_deposit_interest[i] = market.cumulative_deposit_interest
+            arrays.spot_borrow_interest[i] = market.cumulative_borrow_interest
+
+        return arrays
+
+
+def _grouped_sum(index: np.ndarray, values: np.ndarray, size: int) -> np.ndarray:
+    return np.bincount(index, weights=values, minlength=size)[:size] if size else np.zeros(0)
+
+
+def _grouped_unique_count(group: np.ndarray, member: np.ndarray, num_members: int, size: int) -> np.ndarray:
+    """Number of distinct members per group"""
+    if len(group) == 0:
+        return np.zeros(size, dtype=np.int64)
+    pairs = np.unique(group * max(num_members, 1) + member)
+    return np.bincount(pairs // max(num_members, 1), minlength=size)[:size]
+
+
+def aggregate_positions(positions: PositionArrays, markets: MarketArrays) -> Dict[str, Any]:
+    """
+    Aggregate positions per market.
+
+    Returns the same structure as DriftPositionAggregator.get_all_user_positions()
+    (without the cache metadata keys).
+    """
+    num_perp = len(markets.perp_price)
+    num_spot = len(markets.spot_price)
+    quote_price = markets.spot_price[QUOTE_SPOT_MARKET_INDEX] if num_spot else PRICE_PRECISION
+
+    # ---- Perp ----
+    p_market = positions.perp_market_index
+    p_price = markets.perp_price[p_market]
+
+    # Worst case base: whichever of "all bids fill" / "all asks fill" has the larger liability
+    all_bids = positions.perp_base + positions.perp_open_bids
+    all_asks = positions.perp_base + positions.perp_open_asks
+    worst_case_base = np.where(np.abs(all_asks) >= np.abs(all_bids), all_asks, all_bids)
+    notional = np.abs(worst_case_base) * p_price / AMM_RESERVE_PRECISION / QUOTE_PRECISION
+
+    is_long = positions.perp_base > 0
+    total_long = _grouped_sum(p_market[is_long], notional[is_long], num_perp)
+    total_short = _grouped_sum(p_market[~is_long], notional[~is_long], num_perp)
+    total_lp = _grouped_sum(p_market, positions.perp_lp_shares / BASE_PRECISION, num_perp)
+    perp_position_count = np.bincount(p_market, minlength=num_perp)[:num_perp]
+    perp_users = _grouped_unique_count(
+        p_market, positions.user_authority[positions.perp_user], positions.num_authorities, num_perp
+    )
+
+    # Unrealized PnL with funding, in quote, for net value
+    base_value = np.abs(positions.perp_base) * p_price / AMM_RESERVE_PRECISION
+    upnl = np.where(positions.perp_base == 0, 0.0, np.sign(positions.perp_base) * base_value) + positions.perp_quote
+    cumulative_funding = np.where(
+        positions.perp_base > 0, markets.perp_funding_long[p_market], markets.perp_funding_short[p_market]
+    )
+    funding_pnl = -(cumulative_funding - positions.perp_last_funding) * positions.perp_base \
+        / AMM_RESERVE_PRECISION / FUNDING_RATE_BUFFER
+    upnl = (upnl + funding_pnl) * quote_price / PRICE_PRECISION
+
+    # ---- Spot ----
+    s_market = positions.spot_market_index
+    s_decimals = markets.spot_decimals[s_market]
+    precision_decrease = 10.0 ** (19 - s_decimals)
+    interest = np.where(
+        positions.spot_is_borrow, markets.spot_borrow_interest[s_market], markets.spot_deposit_interest[s_market]
+    )
+    token_amount = positions.spot_scaled_balance * interest / precision_decrease
+    token_amount = np.where(positions.spot_is_borrow, -np.ceil(token_amount), np.floor(token_amount))
+    formatted_amount = token_amount / 10.0 ** s_decimals
+
+    is_quote = s_market == QUOTE_SPOT_MARKET_INDEX
+    s_price = np.where(is_quote, PRICE_PRECISION, markets.spot_price[s_market])
+    token_value = np.abs(formatted_amount) * s_price / PRICE_PRECISION
+
+    is_deposit = token_amount > 0
+    deposits_native = _grouped_sum(s_market[is_deposit], formatted_amount[is_deposit], num_spot)
+    deposits_usd = _grouped_sum(s_market[is_deposit], token_value[is_deposit], num_spot)
+    borrows_native = _grouped_sum(s_market[~is_deposit], np.abs(formatted_amount[~is_deposit]), num_spot)
+    borrows_usd = _grouped_sum(s_market[~is_deposit], token_value[~is_deposit], num_spot)
+    spot_position_count = np.bincount(s_market, minlength=num_spot)[:num_spot]
+    spot_users = _grouped_unique_count(
+        s_market, positions.user_authority[positions.spot_user], positions.num_authorities, num_spot
+    )
+
+    # Net value: unweighted spot assets minus liabilities plus perp PnL
+    signed_value = np.where(is_deposit, token_value, -token_value) * QUOTE_PRECISION
+    total_net_value = (signed_value.sum() + upnl.sum()) / QUOTE_PRECISION
+
+    perp_aggregates = {}
+    for i in np.nonzero(perp_position_count)[0]:
+        i = int(i)
+        perp_aggregates[i] = {
+            "market_name": markets.perp_names.get(i, ""),
+            "total_long_usd": float(total_long[i]),
+            "total_short_usd": float(total_short[i]),
+            "total_lp_shares": float(total_lp[i]),
+            "current_price": float(markets.perp_price[i]) / PRICE_PRECISION,
+            "unique_users": int(perp_users[i]),
+        }
+
+    spot_aggregates = {}
+    for i in np.nonzero(spot_position_count)[0]:
+        i = int(i)
+        spot_aggregates[i] = {
+            "market_name": markets.spot_names.get(i, ""),
+            "total_deposits_native": float(deposits_native[i]),
+            "total_borrows_native": float(borrows_native[i]),
+            "total_deposits_usd": float(deposits_usd[i]),
+            "total_borrows_usd": float(borrows_usd[i]),
+            "token_price": 1.0 if i == QUOTE_SPOT_MARKET_INDEX else float(markets.spot_price[i]) / PRICE_PRECISION,
+            "decimals": int(markets.spot_decimals[i]),
+            "unique_users": int(spot_users[i]),
+        }
+
+    return {
+        "total_unique_authorities": positions.num_authorities,
+        "total_sub_accounts": positions.num_users,
+        "total_net_value": float(total_net_value),
+        "perp_markets": perp_aggregates,
+        "spot_markets": spot_aggregates,
+    }
@@ -0,0 +1,76 @@
+"""
+Empty batches and unfinished-run lookup in checkpointed exports
+
+Run with: python -m pytest driftpy/test_export_checkpoint.py
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from solders.pubkey import Pubkey # type: ignore
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from export_checkpoint import ExportCheckpoint, find_unfinished
+
+HEADERS = ["authority", "fuel_taker"]
+COLUMNS = [("authority", "pubkey"), ("fuel_taker", "u64")]
+
+
+def checkpoint_with_empty_batch(output, batches):
+    checkpoint = ExportCheckpoint(str(output), batch_size=1)
+    pubkeys = checkpoint.start([Pubkey.new_unique() for _ in range(len(batches))])
+    for index, rows in enumerate(batches):
+        checkpoint.commit_batch(index, rows)
+    return checkpoint, pubkeys
+
+
+def test_empty_batch_is_completed_without_segment(tmp_path):
+    output = tmp_path / "export.csv"
+    checkpoint, _ = checkpoint_with_empty_batch(output, [[["a", 1]], []])
+    assert not checkpoint.segment_path(1).exists()
+
+    resumed = ExportCheckpoint(str(output), batch_size=1)
+    assert resumed.resume_pubkeys() is not None
+    assert resumed.pending(2) == []
+
+    resumed.finalize(HEADERS)
+    assert output.read_text().splitlines() == ["authority,fuel_taker", "a,1"]
+
+
+def test_parquet_finalize_with_empty_batch(tmp_path):
+    pytest.importorskip("pyarrow", exc_type=ImportError)
+    from columnar_export import read_frame
+
+    output = tmp_path / "export.parquet"
+    authority = str(Pubkey.new_unique())
+    checkpoint, _ = checkpoint_with_empty_batch(output, [[], [[authority, 5]], []])
+    checkpoint.finalize(HEADERS, COLUMNS)
+    frame = read_frame(output)
+    assert frame.to_dict("records") == [{"authority": authority, "fuel_taker": 5}]
+
+
+def test_parquet_finalize_all_empty_writes_schema(tmp_path):
+    pytest.importorskip("pyarrow", exc_type=ImportError)
+    from columnar_export import column_names, read_frame
+
+    output = tmp_path / "export.parquet"
+    checkpoint, _ = checkpoint_with_empty_batch(output, [[], []])
+    checkpoint.finalize(HEADERS, COLUMNS)
+    assert column_names(output) == HEADERS
+    assert len(read_frame(output)) == 0
+
+
+def test_find_unfinished_picks_newest_matching_export(tmp_path):
+    older, _ = checkpoint_with_empty_batch(tmp_path / "01012025000000_user_stats_fuel_export.csv", [[["a", 1]]])
+    newer, _ = checkpoint_with_empty_batch(tmp_path / "01022025000000_user_stats_fuel_export.csv", [[["b", 2]]])
+    checkpoint_with_empty_batch(tmp_path / "01032025000000_user_stats_full_export.csv", [[["c", 3]]])
+    os.utime(older.state_path, (1000, 1000))
+    os.utime(newer.state_path, (2000, 2000))
+
+    assert find_unfinished("_user_stats_fuel_export.csv", str(tmp_path)) == str(newer.output)
+    assert find_unfinished("_user_stats_fuel_export.parquet", str(tmp_path)) is None
+
+    newer.finalize(HEADERS)
+    assert find_unfinished("_user_stats_fuel_export.csv", str(tmp_path)) == str(older.output)
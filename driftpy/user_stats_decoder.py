@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Fast UserStats account decoding for bulk exports
+
+UserStats is a fixed-layout (zero-copy) account, so every field sits at a known
+offset. Decoding it through anchorpy's generic coder builds a container object
+field by field for every account. This module reads the same fields with one
+precompiled struct.Struct.unpack_from over a memoryview. decode_user_stats_batch()
+decodes a whole batch into a NumPy structured array with one frombuffer call.
+
+Both decoders check the 8-byte account discriminator. Field names follow
+driftpy.types.UserStatsAccount (maker_volume30d, ..., is_referrer), so the result
+drops into code written against decode_user_stat().
+
+Usage:
+    from user_stats_decoder import decode_user_stats, decode_user_stats_batch
+
+    stats = decode_user_stats(account.data)
+    print(stats.authority, stats.fuel_taker, stats.fees.total_fee_paid)
+
+    records = decode_user_stats_batch(raw_accounts)   # numpy structured array
+    total_taker_fuel = records["fuel_taker"].sum()
+
+user_stats_records_from_accounts() packs already-decoded UserStats objects into
+the same array layout.
+"""
+
+import struct
+from typing import Iterable, List, NamedTuple
+
+import numpy as np
+from anchorpy.coder.accounts import _account_discriminator
+from solders.pubkey import Pubkey # type: ignore
+
+USER_STATS_DISCRIMINATOR = _account_discriminator("UserStats")
+
+# 8-byte discriminator + 232-byte struct (see the UserStats type in the Drift IDL)
+USER_STATS_ACCOUNT_SIZE = 240
+
+USER_STATS_LAYOUT = struct.Struct(
+    "<8s"      # discriminator
+    "32s32s"   # authority, referrer
+    "6Q"       # fees: total_fee_paid .. current_epoch_referrer_reward
+    "q3Q3qQ"   # next_epoch_ts, maker/taker/filler volume, their last_*_ts, if_staked_quote_asset_amount
+    "2H"       # number_of_sub_accounts, number_of_sub_accounts_created
+    "4B"       # referrer_status, disable_update_perp_bid_ask_twap, padding1, fuel_overflow_status
+    "6I"       # fuel_insurance, fuel_deposits, fuel_borrows, fuel_positions, fuel_taker, fuel_maker
+    "Q"        # if_staked_gov_token_amount
+    "I"        # last_fuel_if_bonus_update_ts
+    "12s"      # padding
+)
+assert USER_STATS_LAYOUT.size == USER_STATS_ACCOUNT_SIZE
+
+# Offsets for server-side data slices
+AUTHORITY_OFFSET = 8
+FUEL_OFFSET = 192
+# fuel_insurance .. fuel_maker, if_staked_gov_token_amount (skipped), last_fuel_if_bonus_update_ts
+FUEL_LAYOUT = struct.Struct("<6I8xI")
+
+USER_STATS_DTYPE = np.dtype({
+    "names": [
+        "discriminator", "authority", "referrer",
+        "total_fee_paid", "total_fee_rebate", "total_token_discount", "total_referee_discount",
+        "total_referrer_reward", "current_epoch_referrer_reward",
+        "next_epoch_ts", "maker_volume30d", "taker_volume30d", "filler_volume30d",
+        "last_maker_volume30d_ts", "last_taker_volume30d_ts", "last_filler_volume30d_ts",
+        "if_staked_quote_asset_amount", "number_of_sub_accounts", "number_of_sub_accounts_created",
+        "referrer_status", "disable_update_perp_bid_ask_twap", "fuel_overflow_status",
+        "fuel_insurance", "fuel_deposits", "fuel_borrows", "fuel_positions", "fuel_taker", "fuel_maker",
+        "if_staked_gov_token_amount", "last_fuel_if_bonus_update_ts",
+    ],
+    "formats": [
+        "V8", "V32", "V32",
+        "<u8", "<u8", "<u8", "<u8", "<u8", "<u8",
+        "<i8", "<u8", "<u8", "<u8", "<i8", "<i8", "<i8",
+        "<u8", "<u2", "<u2",
+        "u1", "u1", "u1",
+        "<u4", "<u4", "<u4", "<u4", "<u4", "<u4",
+        "<u8", "<u4",
+    ],
+    "offsets": [
+        0, 8, 40,
+        72, 80, 88, 96, 104, 112,
+        120, 128, 136, 144, 152, 160, 168,
+        176, 184, 186,
+        188, 189, 191,
+        192, 196, 200, 204, 208, 212,
+        216, 224,
+    ],
+    "itemsize": USER_STATS_ACCOUNT_SIZE,
+})
+
+FUEL_FIELDS = ("fuel_insurance", "fuel_deposits", "fuel_borrows", "fuel_positions", "fuel_taker", "fuel_maker")
+
+
+class UserFeesRecord(NamedTuple):
+    total_fee_paid: int
+    total_fee_rebate: int
+    total_token_discount: int
+    total_referee_discount: int
+    total_referrer_reward: int
+    current_epoch_referrer_reward: int
+
+
+class UserStatsRecord(NamedTuple):
+    """Decoded UserStats account; field names match driftpy.types.UserStatsAccount"""
+    authority: Pubkey
+    referrer: Pubkey
+    fees: UserFeesRecord
+    next_epoch_ts: int
+    maker_volume30d: int
+    taker_volume30d: int
+    filler_volume30d: int
+    last_maker_volume30d_ts: int
+    last_taker_volume30d_ts: int
+    last_filler_volume30d_ts: int
+    if_staked_quote_asset_amount: int
+    number_of_sub_accounts: int
+    number_of_sub_accounts_created: int
+    referrer_status: int
+    disable_update_perp_bid_ask_twap: bool
+    padding1: List[int]  # [u8; 1] in the IDL, a one-element list like the anchor-decoded account
+    fuel_overflow_status: int
+    fuel_insurance: int
+    fuel_deposits: int
+    fuel_borrows: int
+    fuel_positions: int
+    fuel_taker: int
+    fuel_maker: int
+    if_staked_gov_token_amount: int
+    last_fuel_if_bonus_update_ts: int
+    padding: bytes
+
+    @property
+    def is_referrer(self) -> bool:
+        return (self.referrer_status & 0x1) == 1
+
+
+def decode_user_stats(data) -> UserStatsRecord:
+    """
+    Decode one UserStats account from bytes (or any buffer).
+
+    Raises:
+        ValueError: if the data is too short or is not a UserStats account
+    """
+    view = memoryview(data)
+    if len(view) < USER_STATS_ACCOUNT_SIZE:
+        raise ValueError(f"UserStats account data is {len(view)} bytes, expected {USER_STATS_ACCOUNT_SIZE}")
+    fields = USER_STATS_LAYOUT.unpack_from(view)
+    if fields[0] != USER_STATS_DISCRIMINATOR:
+        raise ValueError("Account data is not a UserStats account (discriminator mismatch)")
+    return UserStatsRecord(
+        Pubkey(fields[1]),
+        Pubkey(fields[2]),
+        UserFeesRecord(*fields[3:9]),
+        *fields[9:20],
+        fields[20] == 1,
+        [fields[21]],
+        *fields[22:],
+    )
+
+
+def decode_user_stats_batch(accounts: Iterable[bytes], strict: bool = True) -> np.ndarray:
+    """
+    Decode many raw UserStats accounts into a structured array of USER_STATS_DTYPE.
+
+    Args:
+        accounts: Raw account data, each exactly USER_STATS_ACCOUNT_SIZE bytes
+        strict: Raise on a discriminator mismatch; otherwise drop those records
+
+    Raises:
+        ValueError: on a wrong-sized account, or a discriminator mismatch when strict
+    """
+    accounts = list(accounts)
+    for data in accounts:
+        if len(data) != USER_STATS_ACCOUNT_SIZE:
+            raise ValueError(f"UserStats account data is {len(data)} bytes, expected {USER_STATS_ACCOUNT_SIZE}")
+    records = np.frombuffer(b"".join(accounts), dtype=USER_STATS_DTYPE)
+    valid = records["discriminator"] == np.void(USER_STATS_DISCRIMINATOR)
+    if not valid.all():
+        if strict:
+            raise ValueError(f"{int((~valid).sum())} accounts are not UserStats accounts (discriminator mismatch)")
+        records = records[valid]
+    return records
+
+
+def user_stats_records_from_accounts(accounts: Iterable) -> np.ndarray:
+    """Pack decoded UserStats objects (UserStatsAccount or UserStatsRecord) into a USER_STATS_DTYPE array"""
+    def field(account, name):
+        if name == "discriminator":
+            return USER_STATS_DISCRIMINATOR
+        if name in UserFeesRecord._fields:
+            return getattr(account.fees, name)
+        if name == "referrer_status" and not hasattr(account, name):
+            # driftpy's UserStatsAccount only keeps the decoded is_referrer bit
+            return int(account.is_referrer)
+        value = getattr(account, name)
+        return bytes(value) if isinstance(value, Pubkey) else int(value)
+
+    rows = [tuple(field(account, name) for name in USER_STATS_DTYPE.names) for account in accounts]
+    return np.array(rows, dtype=USER_STATS_DTYPE)
@@ -0,0 +1,859 @@
+#!/usr/bin/env python3
+"""
+Shared VAT (vat of pickles) snapshot cache
+
+Used by drift-positions.py, drift-positions-aggregate.py and
+authority/get_fuel_from_authority.py to find, publish and expire VAT snapshots.
+
+Every snapshot lives in its own vat-%Y-%m-%d-%H-%M-%S directory and carries a
+manifest.json describing it (wall time, per-component slot, file list and
+checksums). The pickle directory itself holds a small vat-index.json that
+points at the newest complete snapshot, so finding it is one small read
+instead of a directory scan plus filename parsing on every start.
+
+With full_every=N (N > 1) only every Nth snapshot is a full one; the ones in
+between store users and user stats as deltas against the previous snapshot
+(see vat_delta.py) and record it as their parent. Such snapshots must be
+loaded through load() / iter_raw(), which replay base + deltas, rather than by
+handing file_map() to Vat.unpickle(). Retention never deletes a snapshot that
+a kept one still depends on.
+
+Every component also records its slot and the wall time it was fetched, and
+can be refreshed on its own schedule: save(vat, components=[...]) fetches and
+writes only those components into the new snapshot and reuses the others from
+the previous one in place (the manifest's `sources` says which snapshot
+directory holds each reused file; nothing is copied). expired() decides what
+to refresh from per-component TTLs (DEFAULT_COMPONENT_TTLS: oracles every few
+seconds, markets every minute, users hourly), measuring age in slots when the
+current slot is known and in wall time otherwise.
+
+Stale snapshots can be refreshed without blocking a query: spawn_refresh()
+starts a detached worker process, and the worker holds vat-refresh.lock in the
+pickle directory while it fetches and publishes a new snapshot. Publishing only
+flips vat-index.json once the snapshot is complete, so readers see either the
+old snapshot or the new one. The lock records the worker's pid and start time;
+a lock whose process is gone, or older than REFRESH_LOCK_TIMEOUT, is taken over.
+Retention keeps a replaced snapshot for SUPERSEDED_GRACE_SECONDS, so a reader
+still loading it when the worker publishes is not cut off.
+
+Usage:
+    from vat_cache import VatCache
+
+    cache = VatCache("../pickles", keep_last=1)
+    manifest = cache.newest()
+    if manifest and manifest.is_fresh(3600):
+        await cache.load(vat, manifest)
+    ...
+    manifest = await cache.save(vat)
+
+    expired = manifest.expired(DEFAULT_COMPONENT_TTLS, current_slot=slot)
+    manifest = await cache.save(vat, components=expired)
+"""
+
+import os
+import json
+import pickle
+import asyncio
+import time
+import socket
+import shutil
+import datetime
+import subprocess
+from dataclasses import dataclass, field, asdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from file_io import file_checksum, write_json_atomic
+
+# Snapshot components, keyed the same way load_from_pickle() looks them up.
+# A snapshot may additionally carry "usermmap" (see mmap_snapshot.py).
+COMPONENTS = ["perp", "spot", "usermap", "userstats", "perporacles", "spotoracles"]
+
+# Vat.pickle() returns its filenames under these keys
+VAT_FILENAME_KEYS = {
+    "perp_markets": "perp",
+    "spot_markets": "spot",
+    "users": "usermap",
+    "userstats": "userstats",
+    "perp_oracles": "perporacles",
+    "spot_oracles": "spotoracles",
+}
+
+VAT_DIR_PREFIX = "vat-"
+VAT_DIR_FORMAT = "vat-%Y-%m-%d-%H-%M-%S"
+MANIFEST_FILENAME = "manifest.json"
+INDEX_FILENAME = "vat-index.json"
+REFRESH_LOCK_FILENAME = "vat-refresh.lock"
+REFRESH_LOG_FILENAME = "vat-refresh.log"
+# A refresh lock older than this belongs to a worker that hung or died on another host
+REFRESH_LOCK_TIMEOUT = 3 * 3600
+# How often wait_for_refresh_lock() retries while another worker holds the lock
+REFRESH_LOCK_POLL_SECONDS = 2
+# Retention keeps a replaced snapshot this long: a reader that picked it as the newest
+# (e.g. a stale snapshot served while its refresh runs) may still be loading it
+SUPERSEDED_GRACE_SECONDS = 15 * 60
+MANIFEST_VERSION = 1
+
+# Seconds each component stays fresh when refreshing per component
+DEFAULT_COMPONENT_TTLS = {
+    "perporacles": 10,
+    "spotoracles": 10,
+    "perp": 60,
+    "spot": 60,
+    "usermap": 3600,
+    "userstats": 3600,
+}
+# Names accepted by parse_component_ttls() for several components at once
+COMPONENT_GROUPS = {
+    "oracles": ["perporacles", "spotoracles"],
+    "markets": ["perp", "spot"],
+    "users": ["usermap", "userstats"],
+}
+# Approximate Solana slot time, for turning slot distances into ages
+SLOT_SECONDS = 0.4
+
+
+def parse_slot(filename: str) -> int:
+    """Parse the slot out of a Vat filename such as usermap_123456.pkl (0 if absent)"""
+    try:
+        name_without_ext = os.path.basename(filename).rsplit(".", 1)[0]
+        parts = name_without_ext.split("_")
+        if len(parts) > 1:
+            return int(parts[-1])
+    except (ValueError, IndexError):
+        pass
+    return 0
+
+
+def is_pickle_fresh(timestamp: float, max_age_seconds: int = 3600) -> bool:
+    """Check if a pickle is fresh enough (less than max_age_seconds old)"""
+    return (time.time() - timestamp) < max_age_seconds
+
+
+def parse_component_ttls(spec: str) -> Dict[str, float]:
+    """
+    DEFAULT_COMPONENT_TTLS overridden by a spec such as "oracles=5,markets=60,usermap=1800"
+    (component or COMPONENT_GROUPS names, seconds)
+
+    Raises:
+        ValueError: on an unknown name or a malformed entry
+    """
+    ttls = dict(DEFAULT_COMPONENT_TTLS)
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, sep, seconds = item.partition("=")
+        name = name.strip()
+        if not sep or (name not in COMPONENTS and name not in COMPONENT_GROUPS):
+            raise ValueError(f"expected <component>=<seconds> with component one of "
+                             f"{', '.join(COMPONENTS + list(COMPONENT_GROUPS))}, got '{item}'")
+        for component in COMPONENT_GROUPS.get(name, [name]):
+            ttls[component] = float(seconds)
+    return ttls
+
+
+@dataclass
+class SnapshotManifest:
+    """Description of one complete VAT snapshot directory"""
+    name: str
+    created_at: float
+    files: Dict[str, str] = field(default_factory=dict)      # component -> filename in the snapshot dir
+    slots: Dict[str, int] = field(default_factory=dict)      # component -> slot the data was taken at
+    checksums: Dict[str, str] = field(default_factory=dict)  # component -> sha256 of the file
+    parent: Optional[str] = None                              # previous snapshot the deltas apply to
+    deltas: List[str] = field(default_factory=list)           # components stored as deltas against parent
+    fetched_at: Dict[str, float] = field(default_factory=dict)  # component -> wall time it was fetched
+    sources: Dict[str, str] = field(default_factory=dict)     # component -> snapshot dir holding a reused file
+    version: int = MANIFEST_VERSION
+
+    def fetched(self, component: str) -> float:
+        return self.fetched_at.get(component, self.created_at)
+
+    @property
+    def data_time(self) -> float:
+        """Fetch time of the oldest component"""
+        return min((self.fetched(component) for component in COMPONENTS), default=self.created_at)
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.data_time
+
+    def is_fresh(self, max_age_seconds: int = 3600) -> bool:
+        return is_pickle_fresh(self.data_time, max_age_seconds)
+
+    def component_age(self, component: str, current_slot: Optional[int] = None) -> float:
+        """Seconds since a component was fetched: from its slot if current_slot is given, else wall time"""
+        slot = self.slots.get(component)
+        if current_slot and slot:
+            return max(0, current_slot - slot) * SLOT_SECONDS
+        return time.time() - self.fetched(component)
+
+    def expired(self, ttls: Dict[str, float], current_slot: Optional[int] = None) -> List[str]:
+        """Components older than their TTL (components without a TTL never expire)"""
+        return [
+            component for component in COMPONENTS
+            if component in ttls and self.component_age(component, current_slot) > ttls[component]
+        ]
+
+    def is_complete(self) -> bool:
+        return all(component in self.files for component in COMPONENTS)
+
+    @property
+    def is_delta(self) -> bool:
+        return bool(self.deltas)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SnapshotManifest":
+        return cls(
+            name=data["name"],
+            created_at=float(data["created_at"]),
+            files=dict(data.get("files", {})),
+            slots={k: int(v) for k, v in data.get("slots", {}).items()},
+            checksums=dict(data.get("checksums", {})),
+            parent=data.get("parent"),
+            deltas=list(data.get("deltas", [])),
+            fetched_at={k: float(v) for k, v in data.get("fetched_at", {}).items()},
+            sources=dict(data.get("sources", {})),
+            version=int(data.get("version", MANIFEST_VERSION)),
+        )
+
+
+class VatCache:
+    """Finds, publishes and expires VAT snapshots in a pickle directory"""
+
+    def __init__(self, directory: str, keep_last: int = 1, max_age_seconds: Optional[int] = None,
+                 full_every: int = 1):
+        """
+        Args:
+            directory: Pickle directory holding the vat-* snapshot directories
+            keep_last: Number of complete snapshots to keep (the newest is always kept)
+            max_age_seconds: Also delete snapshots older than this, if set
+            full_every: Write a full snapshot every this many snapshots and deltas in between
+                        (1, the default, writes every snapshot in full)
+        """
+        self.directory = directory
+        self.keep_last = max(1, keep_last)
+        self.max_age_seconds = max_age_seconds
+        self.full_every = max(1, full_every)
+        self.index_path = os.path.join(directory, INDEX_FILENAME)
+        self.refresh_lock_path = os.path.join(directory, REFRESH_LOCK_FILENAME)
+        # component -> (snapshot holding it, account key -> digest) for the last users/userstats this process saved
+        self._digests: Dict[str, Tuple[str, Dict[str, bytes]]] = {}
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    # ---- Lookup ----
+
+    def newest(self) -> Optional[SnapshotManifest]:
+        """
+        Return the manifest of the newest complete snapshot, or None.
+
+        This reads only vat-index.json. If the index is missing or points at a
+        snapshot that no longer exists (e.g. a pickle directory written by an
+        older version of these tools), the directory is scanned once and the
+        index is rebuilt so the next lookup is cheap again.
+        """
+        index = self._read_index()
+        if index and index.get("newest"):
+            manifest = self._read_manifest(index["newest"])
+            if manifest and manifest.is_complete():
+                return manifest
+
+        return self._rebuild_index()
+
+    def snapshot_path(self, manifest: SnapshotManifest) -> str:
+        return os.path.join(self.directory, manifest.name)
+
+    def file_map(self, manifest: SnapshotManifest) -> Dict[str, str]:
+        """
+        Map of component name to full file path, as expected by Vat.unpickle() callers.
+        Reused components point into the snapshot directory that holds them. Delta
+        usermap/userstats entries are delta files; use load() or iter_raw() for those.
+        """
+        return {
+            component: os.path.join(self.directory, manifest.sources.get(component, manifest.name), filename)
+            for component, filename in manifest.files.items()
+        }
+
+    def owner(self, manifest: SnapshotManifest, component: str) -> SnapshotManifest:
+        """The snapshot whose directory holds a component's file (manifest itself unless reused)"""
+        source = manifest.sources.get(component)
+        if not source:
+            return manifest
+        owner = self._read_manifest(source)
+        if owner is None:
+            raise FileNotFoundError(f"Snapshot {source} holding {component} of {manifest.name} is missing")
+        return owner
+
+    def is_replayed(self, manifest: SnapshotManifest, component: str) -> bool:
+        """Whether a component has to be rebuilt from base + deltas"""
+        return component in self.owner(manifest, component).deltas
+
+    def chain(self, manifest: SnapshotManifest, component: str = "usermap") -> List[SnapshotManifest]:
+        """
+        The snapshots needed to rebuild one component of `manifest`: the one holding its full
+        file first, then each one holding a delta, up to the one `manifest` takes it from.
+
+        Raises:
+            FileNotFoundError: if a snapshot in the chain has been deleted
+        """
+        chain: List[SnapshotManifest] = []
+        seen = set()
+        current = self.owner(manifest, component)
+        while True:
+            if current.name in seen:
+                raise ValueError(f"Snapshot chain of {manifest.name} loops at {current.name}")
+            seen.add(current.name)
+            chain.append(current)
+            if component not in current.deltas:
+                break
+            parent = self._read_manifest(current.parent) if current.parent else None
+            if parent is None:
+                raise FileNotFoundError(f"Snapshot {current.parent} needed by {manifest.name} is missing")
+            current = self.owner(parent, component)
+        chain.reverse()
+        return chain
+
+    def dependencies(self, manifest: SnapshotManifest) -> set:
+        """Names of every snapshot directory `manifest` reads files from, itself included"""
+        names = {manifest.name}
+        for component in manifest.files:
+            names.update(snapshot.name for snapshot in self.chain(manifest, component))
+        return names
+
+    def iter_entries(self, manifest: SnapshotManifest, component: str) -> Iterator[Tuple[str, bytes]]:
+        """(key, compressed account bytes) of a usermap/userstats component, replaying deltas if needed"""
+        chain = self.chain(manifest, component)
+        if len(chain) == 1:
+            with open(self.file_map(chain[0])[component], "rb") as f:
+                for entry in pickle.load(f):
+                    yield str(entry.pubkey), entry.data
+            return
+
+        from vat_delta import apply_delta, read_full
+        state = read_full(self.file_map(chain[0])[component])
+        for snapshot in chain[1:]:
+            apply_delta(state, self.file_map(snapshot)[component])
+        yield from state.items()
+
+    def iter_raw(self, manifest: SnapshotManifest, component: str = "usermap") -> Iterator[Tuple[str, bytes]]:
+        """(key, raw account bytes) of a usermap/userstats component, e.g. for the mmap and NumPy engines"""
+        from driftpy.types import decompress
+        for key, data in self.iter_entries(manifest, component):
+            yield key, decompress(data)
+
+    async def load_users(self, user_map, manifest: SnapshotManifest):
+        """UserMap.load() for a snapshot, full or delta"""
+        if not self.is_replayed(manifest, "usermap"):
+            await user_map.load(self.file_map(manifest)["usermap"])
+            return
+        from vat_delta import load_users
+        await load_users(user_map, self.iter_entries(manifest, "usermap"), manifest.slots.get("usermap", 0))
+
+    async def load_user_stats(self, stats_map, manifest: SnapshotManifest):
+        """UserStatsMap.load() for a snapshot, full or delta"""
+        if not self.is_replayed(manifest, "userstats"):
+            await stats_map.load(self.file_map(manifest)["userstats"])
+            return
+        from vat_delta import load_user_stats
+        await load_user_stats(stats_map, self.iter_entries(manifest, "userstats"), manifest.slots.get("userstats", 0))
+
+    async def load(self, vat, manifest: SnapshotManifest, users: bool = True, user_stats: bool = True):
+        """
+        Vat.unpickle() for a snapshot, full or delta
+
+        Args:
+            vat: Vat whose maps are cleared and filled from the snapshot
+            manifest: Snapshot to load
+            users: Also load the usermap (callers reading raw users via iter_raw() can skip it)
+            user_stats: Also load the user stats
+        """
+        files = self.file_map(manifest)
+        replayed = any(self.is_replayed(manifest, component) for component in ("usermap", "userstats"))
+        if users and user_stats and not replayed:
+            await vat.unpickle(
+                users_filename=files.get("usermap"),
+                user_stats_filename=files.get("userstats"),
+                spot_markets_filename=files.get("spot"),
+                perp_markets_filename=files.get("perp"),
+                spot_oracles_filename=files.get("spotoracles"),
+                perp_oracles_filename=files.get("perporacles"),
+            )
+            return
+
+        if users:
+            vat.users.clear()
+            await self.load_users(vat.users, manifest)
+        if user_stats:
+            vat.user_stats.clear()
+            await self.load_user_stats(vat.user_stats, manifest)
+        vat.spot_markets.clear()
+        vat.perp_markets.clear()
+        await vat.spot_markets.load(files.get("spot"))
+        await vat.perp_markets.load(files.get("perp"))
+        vat.load_oracles(files.get("spotoracles"), files.get("perporacles"))
+        vat.drift_client.resurrect(vat.spot_markets, vat.perp_markets, vat.spot_oracles, vat.perp_oracles)
+
+    def verify(self, manifest: SnapshotManifest) -> bool:
+        """Re-hash every file in the snapshot and compare against the manifest checksums"""
+        for component, path in self.file_map(manifest).items():
+            expected = manifest.checksums.get(component)
+            if not os.path.exists(path):
+                return False
+            if expected and file_checksum(path) != expected:
+                print(f"Checksum mismatch for {component} in {manifest.name}")
+                return False
+        return True
+
+    # ---- Publishing ----
+
+    def new_snapshot_dir(self, now: Optional[datetime.datetime] = None) -> str:
+        """
+        Create and return the name of a new timestamped snapshot directory. Names have
+        one-second resolution; a second save in the same second gets a -2, -3, ... suffix.
+        """
+        now = now or datetime.datetime.now()
+        base = now.strftime(VAT_DIR_FORMAT)
+        sequence = 1
+        while True:
+            name = base if sequence == 1 else f"{base}-{sequence}"
+            try:
+                os.makedirs(os.path.join(self.directory, name))
+                return name
+            except FileExistsError:
+                sequence += 1
+
+    def publish(self, name: str, files: Dict[str, str], created_at: Optional[float] = None,
+                parent: Optional[str] = None, deltas: Optional[List[str]] = None,
+                reuse: Optional[SnapshotManifest] = None) -> SnapshotManifest:
+        """
+        Record a finished snapshot: write its manifest, point the index at it and
+        apply retention.
+
+        Args:
+            name: Snapshot directory name (as returned by new_snapshot_dir)
+            files: Either Vat.pickle()'s return value or a component -> path map
+            created_at: Wall time the data was taken (defaults to the directory timestamp)
+            parent: For a delta snapshot, the snapshot its deltas apply to
+            deltas: For a delta snapshot, the components stored as deltas
+            reuse: Snapshot to take every component missing from `files` from, in place
+        """
+        path = os.path.join(self.directory, name)
+        if created_at is None:
+            created_at = self._timestamp_from_name(name) or time.time()
+
+        manifest = SnapshotManifest(name=name, created_at=created_at, parent=parent, deltas=list(deltas or []))
+        for key, file_path in files.items():
+            component = VAT_FILENAME_KEYS.get(key, key)
+            filename = os.path.basename(file_path)
+            full_path = os.path.join(path, filename)
+            manifest.files[component] = filename
+            manifest.slots[component] = parse_slot(filename)
+            manifest.checksums[component] = file_checksum(full_path)
+            manifest.fetched_at[component] = created_at
+
+        if reuse is not None:
+            for component, filename in reuse.files.items():
+                if component in manifest.files or (component == "usermmap" and "usermap" in manifest.files):
+                    continue
+                manifest.files[component] = filename
+                manifest.sources[component] = reuse.sources.get(component, reuse.name)
+                manifest.slots[component] = reuse.slots.get(component, parse_slot(filename))
+                manifest.checksums[component] = reuse.checksums.get(component, "")
+                manifest.fetched_at[component] = reuse.fetched(component)
+
+        write_json_atomic(os.path.join(path, MANIFEST_FILENAME), manifest.to_dict())
+        if manifest.is_complete():
+            self._write_index(manifest)
+            self.apply_retention()
+        return manifest
+
+    def add_component(self, manifest: SnapshotManifest, component: str, file_path: str) -> SnapshotManifest:
+        """Attach an extra file (already inside the snapshot directory) to a published snapshot"""
+        filename = os.path.basename(file_path)
+        manifest.files[component] = filename
+        manifest.sources.pop(component, None)
+        manifest.slots[component] = parse_slot(filename)
+        manifest.checksums[component] = file_checksum(os.path.join(self.snapshot_path(manifest), filename))
+        write_json_atomic(os.path.join(self.snapshot_path(manifest), MANIFEST_FILENAME), manifest.to_dict())
+        return manifest
+
+    async def save(self, vat, user_mmap: bool = False, components: Optional[List[str]] = None) -> SnapshotManifest:
+        """
+        Pickle a Vat into a new snapshot directory and publish it
+
+        With full_every > 1 this writes a delta snapshot unless the newest snapshot's chain
+        already holds full_every snapshots (or there is none).
+
+        Args:
+            vat: Subscribed Vat to pickle
+            user_mmap: Also write the memory-mapped User snapshot (usermmap_<slot>.bin). Delta
+                       snapshots skip it; ensure_user_mmap() builds it from the replay when needed.
+            components: Fetch and write only these components and reuse the rest from the newest
+                        snapshot (all of them are fetched when there is none). The Vat must hold
+                        that snapshot, e.g. after load().
+        """
+        parent = self.newest() if self.full_every > 1 or components is not None else None
+        if parent is not None and (components is not None or self._can_extend(parent)):
+            return await self._save_components(vat, parent, list(components or COMPONENTS), user_mmap)
+
+        now = datetime.datetime.now()
+        name = self.new_snapshot_dir(now)
+        path = os.path.join(self.directory, name, "")
+        filenames = await vat.pickle(path)
+        if user_mmap:
+            # Vat.pickle() just synced the UserMap, so its raw account bytes are current
+            from mmap_snapshot import write_user_snapshot
+            slot = vat.users.get_slot()
+            filenames["usermmap"] = os.path.join(path, f"usermmap_{slot}.bin")
+            write_user_snapshot(filenames["usermmap"], vat.users.raw.items(), slot)
+        manifest = self.publish(name, filenames, created_at=now.timestamp())
+        if self.full_every > 1:
+            from vat_delta import current_accounts, digests
+            self._digests = {
+                component: (name, digests(accounts.items())) for component, accounts in current_accounts(vat).items()
+            }
+        print(f"Saved fresh data to {path}")
+        return manifest
+
+    def _can_extend(self, parent: SnapshotManifest) -> bool:
+        """Whether the next users/userstats files can be deltas on top of `parent`'s"""
+        from vat_delta import DELTA_COMPONENTS
+        try:
+            return all(len(self.chain(parent, component)) < self.full_every for component in DELTA_COMPONENTS)
+        except (OSError, ValueError) as e:
+            print(f"Writing users in full, cannot extend {parent.name}: {e}")
+            return False
+
+    async def _save_components(self, vat, parent: SnapshotManifest, components: List[str],
+                               user_mmap: bool) -> SnapshotManifest:
+        """
+        Same steps as Vat.pickle(), restricted to `components`; the rest is reused from `parent`.
+        Users and user stats are written as deltas against `parent` while its chain is shorter
+        than full_every.
+        """
+        from vat_delta import DELTA_COMPONENTS, current_accounts, digests, write_delta
+        from oracle_snapshot import fetch_oracle_prices
+
+        wanted = set(components)
+        if wanted & set(COMPONENT_GROUPS["oracles"]):
+            # Both oracle files come from one read of every market's oracle
+            wanted.update(COMPONENT_GROUPS["oracles"])
+        users = [component for component in DELTA_COMPONENTS if component in wanted]
+
+        async def nothing():
+            return None
+
+        now = datetime.datetime.now()
+        name = self.new_snapshot_dir(now)
+        path = os.path.join(self.directory, name, "")
+        _, _, spot_raw, perp_raw = await asyncio.gather(
+            vat.users.sync() if "usermap" in wanted else nothing(),
+            vat.user_stats.sync() if "userstats" in wanted else nothing(),
+            vat.spot_markets.pre_dump() if "spot" in wanted else nothing(),
+            vat.perp_markets.pre_dump() if "perp" in wanted else nothing(),
+        )
+        if "perporacles" in wanted:
+            if hasattr(vat.drift_client.account_subscriber, "cache"):
+                # Read the oracles the markets just fetched point at, not the ones they replaced
+                vat.last_oracle_slot = await fetch_oracle_prices(
+                    vat.drift_client,
+                    [m.data for m in vat.perp_markets.values()] if "perp" in wanted else None,
+                    [m.data for m in vat.spot_markets.values()] if "spot" in wanted else None,
+                )
+            else:
+                # A live subscriber keeps its own oracles current
+                await vat.register_oracle_slot()
+        names = vat.get_filenames(path)
+        filenames = {}
+        if "spot" in wanted:
+            filenames["spot_markets"] = names["spot_markets"]
+            vat.spot_markets.dump(spot_raw, names["spot_markets"])
+        if "perp" in wanted:
+            filenames["perp_markets"] = names["perp_markets"]
+            vat.perp_markets.dump(perp_raw, names["perp_markets"])
+        if "perporacles" in wanted:
+            filenames["spot_oracles"] = names["spot_oracles"]
+            filenames["perp_oracles"] = names["perp_oracles"]
+            vat.dump_oracles(names["spot_oracles"], names["perp_oracles"])
+
+        deltas = []
+        changes = []
+        if users:
+            accounts = current_accounts(vat)
+            as_deltas = self.full_every > 1 and self._can_extend(parent)
+            for component in users:
+                key = "users" if component == "usermap" else "userstats"
+                if not as_deltas:
+                    if component == "usermap":
+                        vat.users.dump(names[key])
+                    else:
+                        vat.user_stats.dump(names[key])
+                    filenames[key] = names[key]
+                    continue
+                base = self.owner(parent, component).name
+                if self._digests.get(component, (None,))[0] != base:
+                    # New process: rebuild the parent's digests from its replay (a read, not a write)
+                    self._digests[component] = (base, digests(self.iter_raw(parent, component)))
+                delta_path = os.path.join(path, f"{DELTA_COMPONENTS[component]}_{parse_slot(names[key])}.pkl")
+                upserts, deletes = write_delta(delta_path, parent.name, self._digests[component][1], accounts[component])
+                filenames[key] = delta_path
+                deltas.append(component)
+                changes.append(f"{component} {upserts} changed/{deletes} removed of {len(accounts[component])}")
+            if user_mmap and "usermap" in users and "usermap" not in deltas:
+                from mmap_snapshot import write_user_snapshot
+                slot = vat.users.get_slot()
+                filenames["usermmap"] = os.path.join(path, f"usermmap_{slot}.bin")
+                write_user_snapshot(filenames["usermmap"], vat.users.raw.items(), slot)
+
+        manifest = self.publish(name, filenames, created_at=now.timestamp(),
+                                parent=parent.name if deltas else None, deltas=deltas, reuse=parent)
+        if users and self.full_every > 1:
+            for component in users:
+                self._digests[component] = (name, digests(accounts[component].items()))
+
+        if wanted & {"perp", "spot", "perporacles", "spotoracles"}:
+            # Point the client at the refreshed markets and oracles, as Vat.unpickle() does
+            files = self.file_map(manifest)
+            vat.load_oracles(files["spotoracles"], files["perporacles"])
+            vat.drift_client.resurrect(vat.spot_markets, vat.perp_markets, vat.spot_oracles, vat.perp_oracles)
+
+        refreshed = [component for component in COMPONENTS if component in wanted]
+        reused = [component for component in COMPONENTS if component not in wanted]
+        notes = ([f"{', '.join(reused)} from {parent.name}"] if reused else []) + changes
+        print(f"Saved {', '.join(refreshed)} to {path}" + (f" ({'; '.join(notes)})" if notes else ""))
+        return manifest
+
+    def ensure_user_mmap(self, manifest: SnapshotManifest) -> str:
+        """
+        Return the path of the snapshot's memory-mapped User file, converting it
+        from the usermap pickle first if the snapshot was saved without one
+        """
+        if "usermmap" not in manifest.files:
+            from mmap_snapshot import write_user_snapshot
+            usermap_path = self.file_map(manifest)["usermap"]
+            slot = manifest.slots.get("usermap", parse_slot(usermap_path))
+            file_path = os.path.join(self.snapshot_path(manifest), f"usermmap_{slot}.bin")
+            print(f"Converting {os.path.basename(usermap_path)} to a memory-mapped snapshot...")
+            write_user_snapshot(file_path, self.iter_raw(manifest, "usermap"), slot)
+            self.add_component(manifest, "usermmap", file_path)
+        return self.file_map(manifest)["usermmap"]
+
+    # ---- Background refresh ----
+
+    def refresh_in_progress(self) -> Optional[dict]:
+        """The refresh lock's contents (pid, host, started_at) if a live worker holds it, else None"""
+        try:
+            with open(self.refresh_lock_path, "r") as f:
+                lock = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - float(lock.get("started_at", 0)) > REFRESH_LOCK_TIMEOUT:
+            return None
+        if lock.get("host") == socket.gethostname():
+            try:
+                os.kill(int(lock["pid"]), 0)
+            except ProcessLookupError:
+                return None
+            except (PermissionError, KeyError, ValueError):
+                pass
+        return lock
+
+    def acquire_refresh_lock(self) -> bool:
+        """Take the refresh lock for this process; False if another live worker holds it"""
+        lock = json.dumps({"pid": os.getpid(), "host": socket.gethostname(), "started_at": time.time()})
+        for _ in range(2):
+            try:
+                fd = os.open(self.refresh_lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if self.refresh_in_progress():
+                    return False
+                # Left behind by a worker that died; take it over
+                try:
+                    os.unlink(self.refresh_lock_path)
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(lock)
+            return True
+        return False
+
+    async def wait_for_refresh_lock(self, poll_seconds: float = REFRESH_LOCK_POLL_SECONDS):
+        """Take the refresh lock, waiting for a running worker to finish first"""
+        waiting = False
+        while not self.acquire_refresh_lock():
+            if not waiting:
+                lock = self.refresh_in_progress() or {}
+                print(f"Waiting for the running snapshot refresh (pid {lock.get('pid')}) to finish...")
+                waiting = True
+            await asyncio.sleep(poll_seconds)
+
+    def release_refresh_lock(self):
+        lock = self.refresh_in_progress()
+        if lock and lock.get("pid") == os.getpid() and lock.get("host") == socket.gethostname():
+            os.unlink(self.refresh_lock_path)
+
+    def spawn_refresh(self, argv: List[str], env: Optional[Dict[str, str]] = None) -> Tuple[Optional[int], bool]:
+        """
+        Start `argv` as a detached background worker that refreshes the snapshot, unless one
+        is already running. The worker must take the refresh lock itself (acquire_refresh_lock),
+        so two callers racing here still end up with a single refresh.
+
+        Returns:
+            (pid of the new or already running worker, whether a worker was started)
+        """
+        lock = self.refresh_in_progress()
+        if lock:
+            return lock.get("pid"), False
+        log_path = os.path.join(self.directory, REFRESH_LOG_FILENAME)
+        with open(log_path, "a") as log:
+            process = subprocess.Popen(
+                argv,
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                env=env,
+                start_new_session=True,
+                close_fds=True,
+            )
+        return process.pid, True
+
+    # ---- Retention ----
+
+    def apply_retention(self):
+        """
+        Delete snapshots beyond keep_last / max_age_seconds and any incomplete leftovers.
+        A snapshot replaced less than SUPERSEDED_GRACE_SECONDS ago is kept regardless.
+        """
+        index = self._read_index() or {}
+        snapshots: List[dict] = sorted(index.get("snapshots", []), key=lambda s: s["created_at"], reverse=True)
+        newest = index.get("newest")
+
+        keep = []
+        for i, snapshot in enumerate(snapshots):
+            too_many = i >= self.keep_last
+            too_old = self.max_age_seconds is not None and (time.time() - snapshot["created_at"]) > self.max_age_seconds
+            successor = snapshots[i - 1] if i > 0 else None
+            superseded_at = successor.get("published_at", successor["created_at"]) if successor else None
+            in_grace = superseded_at is not None and time.time() - superseded_at < SUPERSEDED_GRACE_SECONDS
+            if snapshot["name"] == newest or in_grace or not (too_many or too_old):
+                keep.append(snapshot)
+        kept_names = {s["name"] for s in keep}
+        # Delta snapshots need their base and every delta before them, and reused
+        # components live in the snapshot directory they were written to
+        for snapshot in keep:
+            manifest = self._read_manifest(snapshot["name"])
+            if manifest and (manifest.parent or manifest.sources):
+                try:
+                    kept_names.update(self.dependencies(manifest))
+                except (OSError, ValueError) as e:
+                    print(f"Warning: {e}")
+
+        if len(keep) != len(snapshots):
+            index["snapshots"] = keep
+            write_json_atomic(self.index_path, index)
+
+        # Anything vat-* that isn't a kept snapshot is either expired or a
+        # half-written directory from a run that died mid-pickle
+        for item in os.listdir(self.directory):
+            item_path = os.path.join(self.directory, item)
+            if os.path.isdir(item_path) and item.startswith(VAT_DIR_PREFIX) and item not in kept_names:
+                if self._is_in_progress(item):
+                    continue
+                try:
+                    shutil.rmtree(item_path)
+                    print(f"Deleted old VAT directory: {item}")
+                except Exception as e:
+                    print(f"Warning: Failed to delete old VAT directory {item}: {e}")
+
+    # ---- Internals ----
+
+    def _is_in_progress(self, name: str) -> bool:
+        """A directory without a manifest that was touched recently may still be being written"""
+        path = os.path.join(self.directory, name)
+        if os.path.exists(os.path.join(path, MANIFEST_FILENAME)):
+            return False
+        try:
+            return (time.time() - os.path.getmtime(path)) < 600
+        except OSError:
+            return False
+
+    def _read_index(self) -> Optional[dict]:
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_index(self, manifest: SnapshotManifest):
+        index = self._read_index() or {}
+        snapshots = [s for s in index.get("snapshots", []) if s["name"] != manifest.name]
+        snapshots.append({"name": manifest.name, "created_at": manifest.created_at, "published_at": time.time()})
+        snapshots.sort(key=lambda s: s["created_at"], reverse=True)
+        index["snapshots"] = snapshots
+        index["newest"] = snapshots[0]["name"]
+        index["version"] = MANIFEST_VERSION
+        write_json_atomic(self.index_path, index)
+
+    def _read_manifest(self, name: str) -> Optional[SnapshotManifest]:
+        try:
+            with open(os.path.join(self.directory, name, MANIFEST_FILENAME), "r") as f:
+                return SnapshotManifest.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def _timestamp_from_name(name: str) -> Optional[float]:
+        return VatCache._name_order(name)[0]
+
+    @staticmethod
+    def _name_order(name: str) -> Tuple[Optional[float], int]:
+        """(timestamp, same-second sequence) of a snapshot directory name"""
+        base, sequence = name, 1
+        stem, sep, suffix = name.rpartition("-")
+        if sep and suffix.isdigit() and stem.count("-") == VAT_DIR_FORMAT.count("-"):
+            base, sequence = stem, int(suffix)
+        try:
+            return datetime.datetime.strptime(base, VAT_DIR_FORMAT).timestamp(), sequence
+        except ValueError:
+            return None, sequence
+
+    def _rebuild_index(self) -> Optional[SnapshotManifest]:
+        """Slow path: scan vat-* directories, adopting legacy ones that have no manifest"""
+        subdirs = [
+            d for d in os.listdir(self.directory)
+            if d.startswith(VAT_DIR_PREFIX) and os.path.isdir(os.path.join(self.directory, d))
+        ]
+        subdirs.sort(key=lambda d: (self._name_order(d)[0] or 0, self._name_order(d)[1]), reverse=True)
+
+        for name in subdirs:
+            manifest = self._read_manifest(name)
+            if manifest is None:
+                manifest = self._adopt_legacy_dir(name)
+            if manifest and manifest.is_complete():
+                self._write_index(manifest)
+                return manifest
+        return None
+
+    def _adopt_legacy_dir(self, name: str) -> Optional[SnapshotManifest]:
+        """Write a manifest for a complete snapshot directory created before manifests existed"""
+        created_at = self._timestamp_from_name(name)
+        if created_at is None:
+            return None
+
+        path = os.path.join(self.directory, name)
+        files = {}
+        for component in COMPONENTS:
+            matching = [
+                f for f in os.listdir(path)
+                if f.endswith(".pkl") and f.startswith(f"{component}_")
+            ]
+            if not matching:
+                return None
+            matching.sort(key=parse_slot, reverse=True)
+            files[component] = os.path.join(path, matching[0])
+
+        print(f"Indexing existing VAT directory {name}")
+        return self.publish(name, files, created_at=created_at)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Delta VAT snapshots
+
+Vat.pickle() rewrites every User and UserStats account on each snapshot, even
+though only a small share of them changes between two snapshots a minute
+apart. With VatCache(full_every=N) only every Nth snapshot is a full one;
+the snapshots in between store these two components as a delta file against
+the previous snapshot:
+
+    usermapdelta_<slot>.pkl     {"parent": <previous snapshot>, "upserts": [PickledData], "deletes": [key]}
+    userstatsdelta_<slot>.pkl   same, keyed by authority like the userstats pickle
+
+An account is an upsert when the blake2b digest of its raw bytes differs from
+the one it had in the parent snapshot (or it is new), and a delete when it is
+gone. Markets and oracles are small and are still written in full every time.
+
+Loading replays the chain in memory: the base snapshot's pickle is read into a
+key -> compressed bytes dict, each delta is applied in order, and the result
+is fed to the maps the same way UserMap.load() / UserStatsMap.load() would.
+Nothing is rewritten on load.
+
+Usage (through VatCache):
+    cache = VatCache("../pickles", full_every=60)
+    manifest = await cache.save(vat)            # full every 60th snapshot, delta otherwise
+    await cache.load(vat, cache.newest())       # base + deltas
+"""
+
+import pickle
+import hashlib
+from typing import Dict, Iterable, Tuple
+
+from solders.pubkey import Pubkey # type: ignore
+
+from driftpy.accounts.types import DataAndSlot
+from driftpy.decode.user import decode_user
+from driftpy.decode.user_stat import decode_user_stat
+from driftpy.types import PickledData, compress, decompress
+
+from file_io import atomic_open
+
+# Components stored as deltas, and the filename prefix of their delta files
+DELTA_COMPONENTS = {"usermap": "usermapdelta", "userstats": "userstatsdelta"}
+
+# UserStats accounts start with the 8-byte discriminator followed by the authority
+AUTHORITY_OFFSET = 8
+
+
+def account_digest(raw: bytes) -> bytes:
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
+
+def current_accounts(vat) -> Dict[str, Dict[str, bytes]]:
+    """Raw account bytes of a synced Vat, per component, keyed the way Vat.pickle() dumps them"""
+    return {
+        "usermap": dict(vat.users.raw),
+        "userstats": {
+            str(Pubkey(raw[AUTHORITY_OFFSET:AUTHORITY_OFFSET + 32])): raw
+            for raw in vat.user_stats.raw.values()
+        },
+    }
+
+
+def digests(accounts: Iterable[Tuple[str, bytes]]) -> Dict[str, bytes]:
+    return {key: account_digest(raw) for key, raw in accounts}
+
+
+def write_delta(path: str, parent: str, previous: Dict[str, bytes], accounts: Dict[str, bytes]) -> Tuple[int, int]:
+    """
+    Write the accounts that changed since `previous` (key -> digest) as a delta file.
+
+    Returns:
+        (number of upserted accounts, number of deleted accounts)
+    """
+    upserts = [
+        PickledData(pubkey=key, data=compress(raw))
+        for key, raw in accounts.items()
+        if previous.get(key) != account_digest(raw)
+    ]
+    deletes = [key for key in previous if key not in accounts]
+
+    with atomic_open(path) as f:
+        pickle.dump({"parent": parent, "upserts": upserts, "deletes": deletes}, f, pickle.HIGHEST_PROTOCOL)
+    return len(upserts), len(deletes)
+
+
+def read_full(path: str) -> Dict[str, bytes]:
+    """key -> compressed account bytes from a full usermap/userstats pickle"""
+    with open(path, "rb") as f:
+        entries = pickle.load(f)
+    return {str(entry.pubkey): entry.data for entry in entries}
+
+
+def apply_delta(state: Dict[str, bytes], path: str):
+    """Apply a delta file to a key -> compressed account bytes dict, in place"""
+    with open(path, "rb") as f:
+        delta = pickle.load(f)
+    for key in delta["deletes"]:
+        state.pop(key, None)
+    for entry in delta["upserts"]:
+        state[str(entry.pubkey)] = entry.data
+
+
+async def load_users(user_map, entries: Iterable[Tuple[str, bytes]], slot: int):
+    """Same as UserMap.load(), from (pubkey, compressed bytes) pairs"""
+    for pubkey, data in entries:
+        await user_map.add_pubkey(pubkey, DataAndSlot(slot, decode_user(decompress(data))))
+
+
+async def load_user_stats(stats_map, entries: Iterable[Tuple[str, bytes]], slot: int):
+    """Same as UserStatsMap.load(), from (authority, compressed bytes) pairs"""
+    for authority, data in entries:
+        await stats_map.add_user_stat(Pubkey.from_string(authority), DataAndSlot(slot, decode_user_stat(decompress(data))))
@@ -1,136 +1,284 @@
+"""
+Compare total fuel per authority between a reference snapshot and a fuel export
+
+Both inputs (CSV or Parquet) are streamed in chunks of --chunk-rows rows and
+hash-partitioned on the authority into spill files in a temporary directory,
+so an authority's rows from both files land in the same partition. Each
+partition is then joined on its own: the authorities of both sides are
+dictionary-encoded to integer ids (pd.factorize), and balances, presence and
+exclusion flags are accumulated per id with np.bincount. Memory is bounded by
+the chunk size and the size of one partition, not by the size of the inputs;
+raise --partitions for larger inputs.
+
+An authority missing from one file is reported as missing, never as a zero
+balance. The results go to three files:
+
+    <prefix>_only_in_snapshot.csv   authority, balance_from_complete_snapshot
+    <prefix>_only_in_export.csv     authority, balance_from_fuel_export
+    <prefix>_mismatched.csv         authority, both balances, difference
+
+Duplicate rows of an authority within one file are summed.
+
+Usage:
+    python compare-snapshots.py --snapshot complete_snapshot.csv --export 06122025140049_user_stats_fuel_export.csv
+    python compare-snapshots.py --snapshot snap.parquet --export export.parquet --partitions 64 --chunk-rows 2000000
+"""
+
+import argparse
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
 import pandas as pd
 import numpy as np
 from datetime import datetime
 
-def compare_snapshots():
+# Shared helpers live in driftpy/ at the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parents[4] / "driftpy"))
+from columnar_export import column_names, iter_frames
+
+FUEL_COLUMNS = ['fuel_insurance', 'fuel_deposits', 'fuel_borrows', 'fuel_positions', 'fuel_taker', 'fuel_maker']
+BOOL_COLUMNS = ['isDriftUser', 'isVaultDepositor', 'isVaultManager']
+
+DEFAULT_CHUNK_ROWS = 1_000_000
+# Input bytes per partition when --partitions is not given
+PARTITION_TARGET_BYTES = 256 * 1024 * 1024
+
+
+def stripped_columns(path):
+    """Map of sanitized (whitespace-stripped) column names to the names in the file"""
+    return {name.strip(): name for name in column_names(path)}
+
+
+def iter_snapshot_chunks(path, chunk_rows):
     """
-    Compares total fuel for each authority from two different snapshots and generates a report.
+    Stream the reference snapshot as (authority, balance, not_drift_user, vault_depositor, vault_manager)
+    chunks. The flags are parsed as in the original report: a lowercase, stripped 'true'.
     """
-    # Define file paths relative to the script location
-    file1_path = 'complete_snapshot.csv'
-    # The excel file is in the root of the project
-    file2_path = '06122025140049_user_stats_fuel_export.csv'
-    
-    # Generate timestamp for the output file
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    output_path = f'comparison_report_{timestamp}.csv'
+    columns = stripped_columns(path)
+    wanted = ['authority', 'totalFuel'] + BOOL_COLUMNS
+    missing = [col for col in wanted if col not in columns]
+    if missing:
+        raise ValueError(f"'{path}' is missing columns: {', '.join(missing)}")
 
-    # --- Load Data ---
-    try:
-        df1 = pd.read_csv(file1_path)
-        df2 = pd.read_csv(file2_path)
-    except FileNotFoundError as e:
-        print(f"Error loading files: {e}")
-        print("Please ensure 'complete_snapshot.csv' is in the same directory as the script,")
-        print("and '06122025140049_user_stats_fuel_export.xlsx' is in the project root.")
-        return
+    for chunk in iter_frames(path, [columns[col] for col in wanted], chunk_rows):
+        chunk.columns = chunk.columns.str.strip()
+        flags = {col: chunk[col].astype(str).str.strip().str.lower() == 'true' for col in BOOL_COLUMNS}
+        yield pd.DataFrame({
+            'authority': chunk['authority'].astype(str),
+            'balance': pd.to_numeric(chunk['totalFuel'], errors='coerce').fillna(0).astype(np.float64),
+            'not_drift_user': ~flags['isDriftUser'],
+            'vault_depositor': flags['isVaultDepositor'],
+            'vault_manager': flags['isVaultManager'],
+        })
 
-    # --- Data Preparation ---
-
-    # Prepare DataFrame 1
-    # Sanitize column headers to remove any leading/trailing whitespace
-    df1.columns = df1.columns.str.strip()
-
-    # Create new, clean boolean columns for filtering, leaving original data intact.
-    bool_cols = ['isDriftUser', 'isVaultDepositor', 'isVaultManager']
-    for col in bool_cols:
-        new_col_name = f"{col}_bool"
-        # Convert to a lowercase string, strip whitespace, and check for exact equality with 'true'.
-        df1[new_col_name] = df1[col].astype(str).str.strip().str.lower() == 'true'
-
-    # --- Identify Authorities to Exclude from Both Files ---
-    # An authority should be excluded if it fails any of the required conditions.
-    exclusion_mask = (df1['isDriftUser_bool'] == False) | (df1['isVaultDepositor_bool'] == True) | (df1['isVaultManager_bool'] == True)
-    authorities_to_exclude = set(df1[exclusion_mask]['authority'])
-
-    # --- Generate Exclusion Report (based on initial state of complete_snapshot.csv) ---
-    total_records_initial = len(df1)
-    excluded_not_drift_user = (df1['isDriftUser_bool'] == False).sum()
-    excluded_is_vault_depositor = (df1['isVaultDepositor_bool'] == True).sum()
-    excluded_is_vault_manager = (df1['isVaultManager_bool'] == True).sum()
-    total_unique_authorities_excluded = len(authorities_to_exclude)
-
-    print("--- Exclusion Report from 'complete_snapshot.csv' ---")
-    print(f"Initial total authorities in complete_snapshot: {total_records_initial}")
-    print(f"Authorities flagged for exclusion because isDriftUser is FALSE: {excluded_not_drift_user}")
-    print(f"Authorities flagged for exclusion because isVaultDepositor is TRUE: {excluded_is_vault_depositor}")
-    print(f"Authorities flagged for exclusion because isVaultManager is TRUE: {excluded_is_vault_manager}")
-    print(f"Total unique authorities to be excluded from both files: {total_unique_authorities_excluded}")
-    print("-" * 35)
 
-    # --- Apply Exclusion to BOTH DataFrames ---
-    initial_df1_count = len(df1)
-    initial_df2_count = len(df2)
+def iter_export_chunks(path, chunk_rows):
+    """
+    Stream a fuel export as (authority, balance) chunks. Exports that name the authority column
+    'authority_address' and carry the fuel categories separately are mapped to authority / totalFuel.
+    """
+    columns = stripped_columns(path)
+    authority = 'authority' if 'authority' in columns else 'authority_address'
+    if authority not in columns:
+        raise ValueError(f"'{path}' has no 'authority' or 'authority_address' column")
+    if 'totalFuel' in columns:
+        balance_columns = ['totalFuel']
+    elif all(col in columns for col in FUEL_COLUMNS):
+        balance_columns = FUEL_COLUMNS
+    else:
+        raise ValueError(f"'{path}' has neither a 'totalFuel' column nor all of {', '.join(FUEL_COLUMNS)}")
 
-    df1 = df1[~df1['authority'].isin(authorities_to_exclude)]
-    df2 = df2[~df2['authority'].isin(authorities_to_exclude)]
+    wanted = [authority] + balance_columns
+    for chunk in iter_frames(path, [columns[col] for col in wanted], chunk_rows):
+        chunk.columns = chunk.columns.str.strip()
+        balance = sum(pd.to_numeric(chunk[col], errors='coerce').fillna(0).astype(np.float64) for col in balance_columns)
+        yield pd.DataFrame({'authority': chunk[authority].astype(str), 'balance': balance})
 
-    print("--- Data Filtering Summary ---")
-    print(f"Excluded {initial_df1_count - len(df1)} records from '{file1_path}'")
-    print(f"Excluded {initial_df2_count - len(df2)} records from '{file2_path}'")
-    print(f"Authorities remaining in '{file1_path}' for comparison: {len(df1)}")
-    print(f"Authorities remaining in '{file2_path}' for comparison: {len(df2)}")
-    print("-" * 35)
 
+class PartitionSpill:
+    """Hash-partitioned spill files: every chunk is split by hash(authority) and appended as pickles"""
+
+    def __init__(self, directory, partitions):
+        self.directory = Path(directory)
+        self.partitions = partitions
+
+    def path(self, side, partition):
+        return self.directory / f"{side}-{partition:04d}.pkl"
 
-    # --- Data Preparation (on already filtered data) ---
-    # Prepare DataFrame 1
-    df1_snap = df1[['authority', 'totalFuel']].copy()
-    df1_snap.rename(columns={'totalFuel': 'balance_snapshot'}, inplace=True)
-    df1_snap.set_index('authority', inplace=True)
+    def add(self, side, chunk):
+        partition_ids = pd.util.hash_pandas_object(chunk['authority'], index=False).to_numpy() % self.partitions
+        for partition, part in chunk.groupby(partition_ids, sort=False):
+            with open(self.path(side, partition), 'ab') as f:
+                pickle.dump(part, f, protocol=pickle.HIGHEST_PROTOCOL)
 
+    def read(self, side, partition, columns):
+        path = self.path(side, partition)
+        if not path.exists():
+            return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in columns.items()})
+        parts = []
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    parts.append(pickle.load(f))
+                except EOFError:
+                    break
+        return pd.concat(parts, ignore_index=True)
 
-    # Prepare DataFrame 2
-    # The new CSV has 'authority' and 'totalFuel' columns directly.
-    df2.columns = df2.columns.str.strip() # Sanitize headers
-    df2_export = df2[['authority', 'totalFuel']].copy()
-    df2_export.rename(columns={'totalFuel': 'balance_export'}, inplace=True)
-    df2_export.set_index('authority', inplace=True)
 
+def join_partition(snap, export):
+    """
+    Join one partition on integer authority ids.
+
+    Returns:
+        (counts, only_in_snapshot, only_in_export, mismatched) for the authorities not excluded
+    """
+    codes, authorities = pd.factorize(pd.concat([snap['authority'], export['authority']], ignore_index=True))
+    n = len(authorities)
+    snap_ids, export_ids = codes[:len(snap)], codes[len(snap):]
 
-    # --- Merge DataFrames ---
-    comparison_df = pd.merge(df1_snap, df2_export, on='authority', how='outer')
-    comparison_df.fillna(0, inplace=True) # Fill missing values with 0
+    excluded_rows = (snap['not_drift_user'] | snap['vault_depositor'] | snap['vault_manager']).to_numpy()
+    excluded = np.bincount(snap_ids, weights=excluded_rows, minlength=n) > 0
+    in_snap = np.bincount(snap_ids, minlength=n) > 0
+    in_export = np.bincount(export_ids, minlength=n) > 0
+    snap_balance = np.bincount(snap_ids, weights=snap['balance'].to_numpy(), minlength=n)
+    export_balance = np.bincount(export_ids, weights=export['balance'].to_numpy(), minlength=n)
 
-    # --- Calculate Difference ---
-    comparison_df['difference'] = comparison_df['balance_snapshot'] - comparison_df['balance_export']
+    kept = ~excluded
+    only_snap = kept & in_snap & ~in_export
+    only_export = kept & in_export & ~in_snap
+    both = kept & in_snap & in_export
+    mismatched = both & (snap_balance != export_balance)
 
-    # --- Generate Report ---
-    total_auth_snap = len(df1_snap)
-    total_auth_export = len(df2_export)
+    counts = {
+        'excluded_authorities': int(excluded.sum()),
+        'excluded_snapshot_rows': int(excluded[snap_ids].sum()),
+        'excluded_export_rows': int(excluded[export_ids].sum()),
+        'snapshot_authorities': int((kept & in_snap).sum()),
+        'export_authorities': int((kept & in_export).sum()),
+        'snapshot_rows': len(snap_ids) - int(excluded[snap_ids].sum()),
+        'export_rows': len(export_ids) - int(excluded[export_ids].sum()),
+        'in_both': int(both.sum()),
+        'mismatched': int(mismatched.sum()),
+        'only_in_snapshot': int(only_snap.sum()),
+        'only_in_export': int(only_export.sum()),
+    }
+    authorities = np.asarray(authorities, dtype=object)
+    return (
+        counts,
+        pd.DataFrame({'authority': authorities[only_snap], 'balance_from_complete_snapshot': snap_balance[only_snap]}),
+        pd.DataFrame({'authority': authorities[only_export], 'balance_from_fuel_export': export_balance[only_export]}),
+        pd.DataFrame({
+            'authority': authorities[mismatched],
+            'balance_from_complete_snapshot': snap_balance[mismatched],
+            'balance_from_fuel_export': export_balance[mismatched],
+            'difference': snap_balance[mismatched] - export_balance[mismatched],
+        }),
+    )
 
-    in_snap_only = comparison_df['balance_export'] == 0
-    in_export_only = comparison_df['balance_snapshot'] == 0
-    
-    in_both = (~in_snap_only) & (~in_export_only)
 
-    num_in_snap_only = in_snap_only.sum()
-    num_in_export_only = in_export_only.sum()
-    num_in_both = in_both.sum()
+def compare_snapshots(file1_path='complete_snapshot.csv', file2_path='06122025140049_user_stats_fuel_export.csv',
+                      output_prefix=None, chunk_rows=DEFAULT_CHUNK_ROWS, partitions=None, tmp_dir=None):
+    """
+    Compares total fuel for each authority from two different snapshots and generates a report.
+    """
+    # Generate timestamp for the output files
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    output_prefix = output_prefix or f'comparison_report_{timestamp}'
+    outputs = {
+        'only_in_snapshot': f'{output_prefix}_only_in_snapshot.csv',
+        'only_in_export': f'{output_prefix}_only_in_export.csv',
+        'mismatched': f'{output_prefix}_mismatched.csv',
+    }
 
-    # Mismatched balances for authorities present in both files
-    mismatched = comparison_df[in_both & (comparison_df['difference'] != 0)]
-    num_mismatched = len(mismatched)
+    try:
+        input_bytes = os.path.getsize(file1_path) + os.path.getsize(file2_path)
+    except FileNotFoundError as e:
+        print(f"Error loading files: {e}")
+        print(f"Please ensure '{file1_path}' and '{file2_path}' exist (paths are relative to the working directory).")
+        return
+    partitions = partitions or max(1, -(-input_bytes // PARTITION_TARGET_BYTES))
+
+    spill_dir = tempfile.mkdtemp(prefix='compare-snapshots-', dir=tmp_dir)
+    try:
+        spill = PartitionSpill(spill_dir, partitions)
+
+        # --- Pass 1: stream both inputs into hash partitions ---
+        flagged = {'rows': 0, 'not_drift_user': 0, 'vault_depositor': 0, 'vault_manager': 0}
+        export_rows = 0
+        try:
+            for chunk in iter_snapshot_chunks(file1_path, chunk_rows):
+                flagged['rows'] += len(chunk)
+                for flag in ('not_drift_user', 'vault_depositor', 'vault_manager'):
+                    flagged[flag] += int(chunk[flag].sum())
+                spill.add('snapshot', chunk)
+            for chunk in iter_export_chunks(file2_path, chunk_rows):
+                export_rows += len(chunk)
+                spill.add('export', chunk)
+        except ValueError as e:
+            print(f"Error loading files: {e}")
+            return
+
+        # --- Pass 2: join each partition on integer authority ids ---
+        snapshot_columns = {'authority': object, 'balance': np.float64, 'not_drift_user': bool,
+                            'vault_depositor': bool, 'vault_manager': bool}
+        export_columns = {'authority': object, 'balance': np.float64}
+        totals = {}
+        written = set()
+        for partition in range(partitions):
+            counts, *results = join_partition(
+                spill.read('snapshot', partition, snapshot_columns),
+                spill.read('export', partition, export_columns),
+            )
+            for key, value in counts.items():
+                totals[key] = totals.get(key, 0) + value
+            for (name, path), frame in zip(outputs.items(), results):
+                frame.to_csv(path, mode='a' if name in written else 'w', header=name not in written, index=False)
+                written.add(name)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    # --- Exclusion Report (based on the rows of the snapshot) ---
+    print(f"--- Exclusion Report from '{file1_path}' ---")
+    print(f"Initial total authorities in complete_snapshot: {flagged['rows']}")
+    print(f"Authorities flagged for exclusion because isDriftUser is FALSE: {flagged['not_drift_user']}")
+    print(f"Authorities flagged for exclusion because isVaultDepositor is TRUE: {flagged['vault_depositor']}")
+    print(f"Authorities flagged for exclusion because isVaultManager is TRUE: {flagged['vault_manager']}")
+    print(f"Total unique authorities to be excluded from both files: {totals['excluded_authorities']}")
+    print("-" * 35)
+
+    print("--- Data Filtering Summary ---")
+    print(f"Excluded {totals['excluded_snapshot_rows']} records from '{file1_path}'")
+    print(f"Excluded {totals['excluded_export_rows']} records from '{file2_path}'")
+    print(f"Records remaining in '{file1_path}' for comparison: {totals['snapshot_rows']}")
+    print(f"Records remaining in '{file2_path}' for comparison: {totals['export_rows']} (of {export_rows})")
+    print("-" * 35)
 
     print("--- Fuel Snapshot Comparison Report ---")
-    print(f"Total authorities in final comparison from '{file1_path}': {total_auth_snap}")
-    print(f"Total authorities in final comparison from '{file2_path}': {total_auth_export}")
+    print(f"Total authorities in final comparison from '{file1_path}': {totals['snapshot_authorities']}")
+    print(f"Total authorities in final comparison from '{file2_path}': {totals['export_authorities']}")
     print("-" * 35)
-    print(f"Authorities present in both files (post-filtering): {num_in_both}")
-    print(f"Authorities with mismatched balances: {num_mismatched}")
-    print(f"Authorities only in '{file1_path}' (post-filtering): {num_in_snap_only}")
-    print(f"Authorities only in '{file2_path}' (post-filtering): {num_in_export_only}")
+    print(f"Authorities present in both files (post-filtering): {totals['in_both']}")
+    print(f"Authorities with mismatched balances: {totals['mismatched']}")
+    print(f"Authorities only in '{file1_path}' (post-filtering): {totals['only_in_snapshot']}")
+    print(f"Authorities only in '{file2_path}' (post-filtering): {totals['only_in_export']}")
     print("-" * 35)
+    print(f"Joined in {partitions} partition(s) of up to {chunk_rows} rows per input chunk")
+    for name, path in outputs.items():
+        print(f"{name.replace('_', ' ').capitalize()} saved to '{path}'")
 
-    # --- Output CSV ---
-    comparison_df.reset_index(inplace=True)
-    comparison_df.rename(columns={
-        'balance_snapshot': 'balance_from_complete_snapshot',
-        'balance_export': 'balance_from_fuel_export'
-    }, inplace=True)
-    
-    comparison_df.to_csv(output_path, index=False)
-    print(f"Comparison details saved to '{output_path}'")
 
 if __name__ == '__main__':
-    compare_snapshots()
+    parser = argparse.ArgumentParser(description="Compare total fuel per authority between a snapshot and a fuel export (CSV or Parquet).")
+    parser.add_argument("--snapshot", default='complete_snapshot.csv', help="Reference snapshot (default: complete_snapshot.csv)")
+    parser.add_argument("--export", default='06122025140049_user_stats_fuel_export.csv', help="Fuel export to compare against it")
+    parser.add_argument("--output-prefix", default=None, help="Prefix of the three result files (default: comparison_report_<timestamp>)")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS, help=f"Rows read per input chunk (default: {DEFAULT_CHUNK_ROWS})")
+    parser.add_argument("--partitions", type=int, default=None,
+                        help="Hash partitions to join separately (default: one per 256 MiB of input)")
+    parser.add_argument("--tmp-dir", default=None, help="Directory for the partition spill files (default: system temp dir)")
+    args = parser.parse_args()
+    compare_snapshots(args.snapshot, args.export, args.output_prefix, args.chunk_rows, args.partitions, args.tmp_dir)
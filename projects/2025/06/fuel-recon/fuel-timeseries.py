@@ -0,0 +1,164 @@
+"""
+Fuel time series: ingest every fuel export once, then query accrual between any two snapshots
+
+Exports (CSV or Parquet, from any of the fuel exporters or a complete snapshot)
+are ingested into an append-only store directory (see driftpy/fuel_timeseries.py):
+an authority dictionary plus one authority-sorted NumPy array per snapshot.
+Queries memory-map the two snapshots they need and merge them on integer
+authority ids, so no raw CSV is parsed again after ingest.
+
+Snapshots are addressed by id (see `list`), by time (`--older-time` /
+`--newer-time`, the newest snapshot at or before it) or by slot. By default a
+query compares the two newest snapshots.
+
+Usage:
+    python fuel-timeseries.py ingest exports/*_user_stats_fuel_export.csv
+    python fuel-timeseries.py ingest export.parquet --slot 345678901 --time 2025-06-12T14:00:49
+    python fuel-timeseries.py list
+    python fuel-timeseries.py accrual --older 3 --newer 7 --output accrual.csv
+    python fuel-timeseries.py top --older-time 2025-06-01 --newer-time 2025-06-12 -n 50 --column fuel_taker
+    python fuel-timeseries.py history 9xQeWvG816bUx9EPjHmaT23yvVM2ZWbrrpZb9PusVFin
+"""
+
+import argparse
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+# Shared helpers live in driftpy/ at the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parents[4] / "driftpy"))
+from fuel_timeseries import DEFAULT_CHUNK_ROWS, FUEL_CATEGORIES, FuelTimeSeriesStore
+
+DEFAULT_STORE = "fuel-timeseries"
+
+
+def parse_time(value):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected an ISO time like 2025-06-12T14:00:49, got '{value}'")
+
+
+def pick_snapshot(store, snapshot_id, at, slot, default):
+    if snapshot_id is not None:
+        return store.get(snapshot_id)
+    if at is not None or slot is not None:
+        return store.find(at=at, slot=slot)
+    return default
+
+
+def pick_pair(store, args):
+    if len(store.snapshots) < 2:
+        raise LookupError(f"Need at least two snapshots in {store.directory}, found {len(store.snapshots)}")
+    newer = pick_snapshot(store, args.newer, args.newer_time, args.newer_slot, store.snapshots[-1])
+    older = pick_snapshot(store, args.older, args.older_time, args.older_slot, store.snapshots[-2])
+    if older.timestamp > newer.timestamp:
+        older, newer = newer, older
+    print(f"Comparing snapshot {older.id} ({older.time}, {older.source}) -> {newer.id} ({newer.time}, {newer.source})")
+    return older, newer
+
+
+def cmd_ingest(store, args):
+    for path in args.files:
+        known = len(store.snapshots)
+        snapshot = store.ingest(path, timestamp=args.time, slot=args.slot, chunk_rows=args.chunk_rows)
+        if len(store.snapshots) == known:
+            print(f"{path}: already ingested as snapshot {snapshot.id}")
+        else:
+            print(f"{path}: snapshot {snapshot.id} at {snapshot.time}, {snapshot.rows} authorities")
+    print(f"Store {store.directory}: {len(store.snapshots)} snapshots, {len(store.authorities)} authorities")
+
+
+def cmd_list(store, args):
+    if not store.snapshots:
+        print(f"No snapshots in {store.directory}")
+        return
+    print(f"{'id':>5}  {'time':<19}  {'slot':>11}  {'authorities':>11}  source")
+    for snapshot in store.snapshots:
+        slot = snapshot.slot if snapshot.slot is not None else "-"
+        print(f"{snapshot.id:>5}  {snapshot.time:%Y-%m-%d %H:%M:%S}  {slot:>11}  {snapshot.rows:>11}  {snapshot.source}")
+
+
+def report(frame, output):
+    if output:
+        frame.to_csv(output, index=False)
+        print(f"Wrote {len(frame)} rows to {output}")
+    else:
+        with pd.option_context("display.max_rows", None, "display.width", 200):
+            print(frame.to_string(index=False))
+
+
+def cmd_accrual(store, args):
+    older, newer = pick_pair(store, args)
+    accrual = store.accrual(older, newer, column=args.column)
+    print(f"{len(accrual)} authorities, net {args.column} change {accrual['delta'].sum():,.2f}, "
+          f"{(~accrual['in_older']).sum()} new, {(~accrual['in_newer']).sum()} dropped")
+    report(accrual, args.output)
+
+
+def cmd_top(store, args):
+    older, newer = pick_pair(store, args)
+    report(store.top_movers(older, newer, n=args.n, column=args.column, ascending=args.losers), args.output)
+
+
+def cmd_history(store, args):
+    history = store.history(args.authority)
+    if history.empty:
+        print(f"{args.authority} is not in any snapshot of {store.directory}")
+        return
+    history["delta"] = history["total"].diff()
+    report(history, args.output)
+
+
+def add_pair_arguments(parser):
+    for side in ("older", "newer"):
+        parser.add_argument(f"--{side}", type=int, default=None, help=f"Id of the {side} snapshot")
+        parser.add_argument(f"--{side}-time", type=parse_time, default=None,
+                            help=f"Use the newest snapshot at or before this ISO time as the {side} one")
+        parser.add_argument(f"--{side}-slot", type=int, default=None,
+                            help=f"Use the newest snapshot at or before this slot as the {side} one")
+    parser.add_argument("--column", choices=FUEL_CATEGORIES + ["total"], default="total",
+                        help="Fuel column to compare (default: total)")
+    parser.add_argument("--output", default=None, help="Write the result to this CSV instead of printing it")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Append-only fuel snapshot store with per-authority accrual queries.")
+    parser.add_argument("--store", default=DEFAULT_STORE, help=f"Store directory (default: {DEFAULT_STORE})")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest = commands.add_parser("ingest", help="Add fuel exports (CSV or Parquet) to the store")
+    ingest.add_argument("files", nargs="+", help="Exports to ingest; files already in the store are skipped")
+    ingest.add_argument("--time", type=parse_time, default=None,
+                        help="Export time (default: from the exporter's filename prefix, else the file mtime)")
+    ingest.add_argument("--slot", type=int, default=None, help="Slot the export was taken at")
+    ingest.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS,
+                        help=f"Rows read per input chunk (default: {DEFAULT_CHUNK_ROWS})")
+    ingest.set_defaults(handler=cmd_ingest)
+
+    commands.add_parser("list", help="List the snapshots in the store").set_defaults(handler=cmd_list)
+
+    accrual = commands.add_parser("accrual", help="Per-authority fuel change and FUEL/day between two snapshots")
+    add_pair_arguments(accrual)
+    accrual.set_defaults(handler=cmd_accrual)
+
+    top = commands.add_parser("top", help="Authorities with the largest fuel change between two snapshots")
+    add_pair_arguments(top)
+    top.add_argument("-n", type=int, default=20, help="Number of authorities (default: 20)")
+    top.add_argument("--losers", action="store_true", help="Largest decreases instead of increases")
+    top.set_defaults(handler=cmd_top)
+
+    history = commands.add_parser("history", help="One authority's fuel in every snapshot")
+    history.add_argument("authority")
+    history.add_argument("--output", default=None, help="Write the result to this CSV instead of printing it")
+    history.set_defaults(handler=cmd_history)
+
+    args = parser.parse_args()
+    store = FuelTimeSeriesStore(args.store)
+    try:
+        args.handler(store, args)
+    except (LookupError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
@@ -3,38 +3,38 @@
 import argparse
 import asyncio
 import os
-import csv
+import sys
 import logging
 import time
 from datetime import datetime
+from pathlib import Path
 
 from solders.keypair import Keypair # type: ignore
 from solders.pubkey import Pubkey # type: ignore
 from anchorpy import Wallet
 from driftpy.drift_client import DriftClient
 from driftpy.account_subscription_config import AccountSubscriptionConfig
-from driftpy.drift_user import DriftUser
 from driftpy.constants.numeric_constants import QUOTE_PRECISION
-# from driftpy.addresses import get_user_stats_account_public_key # We will define this locally
 from solana.rpc.async_api import AsyncClient
+from solana.rpc.types import MemcmpOpts
+from anchorpy.coder.accounts import _account_discriminator
 from dotenv import load_dotenv
+import base58
 
-# Added helper function from get_UserStats.py
-def get_user_stats_account_public_key(authority: Pubkey, program_id: Pubkey) -> Pubkey:
-    """
-    Derives the userStats account public key for a given authority.
-    """
-    user_stats_account_pk, _ = Pubkey.find_program_address(
-        [b'user_stats', bytes(authority)],
-        program_id
-    )
-    return user_stats_account_pk
+# Shared helpers live in driftpy/ at the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parents[4] / "driftpy"))
+from pda_cache import PdaCache, DEFAULT_PDA_CACHE_PATH
+from account_fetch import AccountFetcher
+from position_engine import USER_ACCOUNT_SIZE, user_records_from_raw
+from user_stats_decoder import decode_user_stats_batch
+from fuel_engine import FuelMarketArrays, compute_fuel
+from columnar_export import open_row_writer, output_suffix, OUTPUT_FORMATS
 
 
 def flatten_fuel_bonus_to_row(authority_pk_str, user_stats_pk_str, fuel_bonus_data, last_update_ts) -> list:
     """
     Extract fuel bonus data into a list for CSV row.
-    The fuel_bonus_data is a dictionary returned by get_fuel_bonus() method.
+    The fuel_bonus_data is a get_fuel_bonus()-style dictionary (FuelTotals.bonus()).
     """
     if not fuel_bonus_data:
         return None
@@ -84,21 +84,34 @@ def get_csv_headers():
     return headers
 
 
+def get_parquet_columns():
+    """
+    Typed columns for --format parquet (same names and order as get_csv_headers()).
+    """
+    return list(zip(get_csv_headers(), ["pubkey", "str", "f64", "f64", "f64", "f64", "f64", "f64", "i64"]))
+
+
 async def main():
-    parser = argparse.ArgumentParser(description="Export fuel data (including overflow) to CSV using get_fuel_bonus().")
+    parser = argparse.ArgumentParser(description="Export fuel data (settled + unsettled) to CSV using the vectorized fuel engine.")
     
     # Generate timestamp for the default filename
     timestamp = datetime.now().strftime("%m%d%Y%H%M%S")
-    default_filename = f"{timestamp}_user_stats_fuel_v2_export.csv"
+    default_filename = f"{timestamp}_user_stats_fuel_v2_export"
 
     DEFAULT_RPC_URL = "https://api.mainnet-beta.solana.com"
     load_dotenv()
     rpc_url = os.getenv("RPC_URL", DEFAULT_RPC_URL)
     parser.add_argument("--rpc-url", type=str, default=rpc_url, help=f"The Solana RPC URL (default: {rpc_url} or RPC_URL from .env).")
-    parser.add_argument("--output", type=str, default=default_filename, help=f"Output CSV filename (default: {default_filename})")
+    parser.add_argument("--output", type=str, default=None, help=f"Output filename (default: {default_filename}.csv, or .parquet with --format parquet)")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="csv",
+                        help="csv, or parquet: typed columns, dictionary-encoded authorities, zstd (needs pyarrow) (default: csv)")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose output")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum getMultipleAccounts requests in flight (default: 8)")
+    parser.add_argument("--pda-cache", type=str, default=str(DEFAULT_PDA_CACHE_PATH), help=f"SQLite cache of derived PDAs (default: {DEFAULT_PDA_CACHE_PATH})")
 
     args = parser.parse_args()
+    if args.output is None:
+        args.output = default_filename + output_suffix(args.format)
 
     # Configure logging
     log_level = logging.DEBUG if args.verbose else logging.INFO
@@ -127,118 +140,67 @@ async def main():
         await drift_client.subscribe()
         logging.info("✅ Successfully subscribed to Drift client.")
         
-        logging.info("⏳ Fetching all User accounts to extract fuel statistics... This may take a while.")
-        
-        all_user_account_wrappers = await drift_client.program.account["User"].all()
-        
-        logging.info(f"👥 Found {len(all_user_account_wrappers)} User accounts. Now processing fuel data with overflow support.")
-        
-        with open(args.output, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
+        logging.info("⏳ Fetching all raw User accounts... This may take a while.")
+        resp = await connection.get_program_accounts(
+            drift_client.program_id,
+            encoding="base64",
+            filters=[
+                USER_ACCOUNT_SIZE,
+                MemcmpOpts(offset=0, bytes=base58.b58encode(_account_discriminator("User")).decode("utf-8")),
+            ],
+        )
+        users = user_records_from_raw(account.account.data for account in resp.value)
+        logging.info(f"👥 Found {len(users)} User accounts.")
+
+        # Derive (or read back from the PDA cache) every UserStats address, then fetch them in batches
+        authorities = list(dict.fromkeys(Pubkey(a.tobytes()) for a in users["authority"]))
+        with PdaCache(args.pda_cache) as pda_cache:
+            user_stats_pks = pda_cache.user_stats_pdas(authorities, drift_client.program_id)
+        logging.info(f"🔑 UserStats PDAs: {pda_cache.hits} from cache, {pda_cache.derived} derived")
+
+        fetcher = AccountFetcher(connection, max_concurrency=args.concurrency)
+        _, accounts = await fetcher.fetch_all(user_stats_pks)
+        user_stats = decode_user_stats_batch((account.data for account in accounts if account is not None), strict=False)
+        user_stats_pk_by_authority = dict(zip(authorities, user_stats_pks))
+        logging.info(f"📥 Fetched {len(user_stats)} UserStats accounts ({fetcher.stats.missing} authorities have none).")
+
+        # Settled + unsettled fuel for every authority in one vectorized pass
+        current_timestamp = int(time.time())
+        markets = FuelMarketArrays.from_drift_client(drift_client)
+        fuel = compute_fuel(users, user_stats, markets, current_timestamp)
+        logging.info(f"⚙️ Computed fuel for {len(fuel)} authorities.")
+
+        with open_row_writer(args.output, get_parquet_columns(), args.format) as writer:
             logging.info(f"📄 Opened output file for writing: {args.output}")
             
-            headers = get_csv_headers()
-            writer.writerow(headers)
-            logging.debug(f"Wrote CSV headers: {headers}")
-            
             # Counters for progress
             count = 0
             skipped_count = 0
-            error_count = 0
-            processed_authorities = set() # To avoid processing duplicate authorities if User accounts share one
-            
-            # Get current timestamp for fuel bonus calculation
-            current_timestamp = int(time.time())
-            
-            total_wrappers = len(all_user_account_wrappers)
-            logging.info(f"⚙️ Starting processing of {total_wrappers} user account wrappers...")
             
-            for i, user_account_wrapper in enumerate(all_user_account_wrappers):
-                user_data = user_account_wrapper.account
-                authority_pk = user_data.authority
-
-                logging.debug(f"Processing wrapper {i+1}/{total_wrappers}: authority={authority_pk}")
-
-                if str(authority_pk) in processed_authorities:
-                    logging.debug(f"Authority {authority_pk} already processed. Skipping.")
-                    continue
+            for i in range(len(fuel)):
+                authority_pk = fuel.authority(i)
+                user_stats_account_pk = user_stats_pk_by_authority.get(authority_pk, "")
+
+                row = flatten_fuel_bonus_to_row(
+                    str(authority_pk),
+                    str(user_stats_account_pk),
+                    fuel.bonus(i),
+                    int(fuel.last_fuel_bonus_update_ts[i]),
+                )
                 
-                processed_authorities.add(str(authority_pk))
-
-                try:
-                    # Derive UserStats account public key
-                    user_stats_account_pk = get_user_stats_account_public_key(authority_pk, drift_client.program_id)
-                    logging.debug(f"Derived UserStats PK for authority {authority_pk}: {user_stats_account_pk}")
-                    
-                    # Create a DriftUser instance for this user
-                    # We pass the sub_account_id from the user data
-                    drift_user = DriftUser(
-                        drift_client,
-                        user_public_key=authority_pk,
-                        sub_account_id=user_data.sub_account_id,
-                        use_cache=False  # Don't cache since we're processing many users
-                    )
-                    
-                    # The DriftUser might need to load the user account data
-                    # Call get_fuel_bonus which handles both settled and overflow fuel
-                    try:
-                        fuel_bonus_data = await drift_user.get_fuel_bonus(
-                            now=current_timestamp,
-                            include_settled=True,    # Include fuel from user_stats
-                            include_unsettled=True   # Include calculated overflow fuel
-                        )
-                    except Exception as fuel_error:
-                        logging.debug(f"Could not get fuel bonus for authority {authority_pk}: {fuel_error}")
-                        error_count += 1
-                        continue
-                    
-                    if not fuel_bonus_data:
-                        logging.debug(f"No fuel bonus data returned for authority {authority_pk}. Skipping.")
-                        continue
-                    
-                    logging.debug(f"Successfully fetched fuel bonus data for {authority_pk}: {fuel_bonus_data}")
-                    
-                    # Get the last fuel update timestamp from user account
-                    last_fuel_update_ts = getattr(user_data, 'last_fuel_bonus_update_ts', 0)
-
-                    # Create row data with all fuel types
-                    row = flatten_fuel_bonus_to_row(
-                        str(authority_pk), 
-                        str(user_stats_account_pk),
-                        fuel_bonus_data,
-                        last_fuel_update_ts
-                    )
-                    
-                    if not row:
-                        logging.debug(f"Flattening row returned None for {user_stats_account_pk}, skipping.")
-                        continue
-                    
-                    # Check if this record has any non-zero fuel values
-                    if not should_include_record(row):
-                        skipped_count += 1
-                        logging.debug(f"Record for {authority_pk} has zero fuel values. Skipping. Total skipped: {skipped_count}")
-                        continue
-                    
-                    # Write to CSV
-                    writer.writerow(row)
-                    logging.debug(f"Wrote record for authority {authority_pk} to CSV.")
-                    
-                    count += 1
-                    if count > 0 and count % 100 == 0:
-                        logging.info(f"  ...exported {count} accounts with fuel data so far...")
-                        
-                except Exception as e:
-                    # Log the error but continue processing
-                    logging.debug(f"Could not process authority {authority_pk}: {e}")
-                    error_count += 1
+                # Check if this record has any non-zero fuel values
+                if not should_include_record(row):
+                    skipped_count += 1
                     continue
+                
+                writer.writerow(row)
+                count += 1
         
         logging.info("\n✅ Fuel data export complete!")
         logging.info(f"📊 Total accounts with fuel data exported: {count}")
         logging.info(f"⏭️  Total accounts skipped (zero fuel values): {skipped_count}")
-        logging.info(f"❌ Total accounts with errors: {error_count}")
         logging.info(f"💾 Output saved to: {args.output}")
-        logging.info("📝 Note: This version includes both settled fuel and overflow fuel automatically.")
+        logging.info("📝 Note: This version includes both settled fuel and unsettled fuel accrued up to now.")
 
     except Exception as e:
         logging.exception(f"An unhandled error occurred: {e}")
@@ -3,25 +3,39 @@
 import argparse
 import asyncio
 import os
-import csv
+import sys
 import logging
 from datetime import datetime
+from pathlib import Path
 import base58
 import hashlib
 
 from solders.keypair import Keypair # type: ignore
 from solders.pubkey import Pubkey # type: ignore
 from anchorpy import Wallet
-from anchorpy.coder.accounts import _account_discriminator
 from driftpy.drift_client import DriftClient
 from driftpy.account_subscription_config import AccountSubscriptionConfig
 # Removed: from driftpy.user_map.userstats_map import UserStatsMap
 # Removed: from driftpy.user_map.user_map_config import UserStatsMapConfig
 # from driftpy.addresses import get_user_stats_account_public_key # We will define this locally
 from solana.rpc.async_api import AsyncClient
-from solana.rpc.types import DataSliceOpts, MemcmpOpts, DataSizeOpts
+from solana.rpc.types import DataSliceOpts, MemcmpOpts
 from dotenv import load_dotenv
 
+# Shared helpers live in driftpy/ at the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parents[4] / "driftpy"))
+from account_fetch import AccountFetcher
+from export_checkpoint import ExportCheckpoint, find_unfinished
+from columnar_export import open_row_writer, output_suffix, OUTPUT_FORMATS
+from user_stats_decoder import (
+    decode_user_stats,
+    USER_STATS_ACCOUNT_SIZE,
+    USER_STATS_DISCRIMINATOR,
+    AUTHORITY_OFFSET,
+    FUEL_OFFSET,
+    FUEL_LAYOUT,
+)
+
 # Removed local get_user_stats_account_public_key as we are not deriving it anymore
 
 def flatten_user_stats_to_row(authority_pk_str, user_stats_pk_str, user_stats_data) -> list:
@@ -77,21 +91,105 @@ def get_csv_headers():
     return headers
 
 
+def get_parquet_columns():
+    """
+    Typed columns for --format parquet (same names and order as get_csv_headers()).
+    """
+    return list(zip(get_csv_headers(), ["pubkey", "str", "u64", "u64", "u64", "u64", "u64", "u64", "i64"]))
+
+
+def user_stats_filters() -> list:
+    """getProgramAccounts filters matching every UserStats account"""
+    return [
+        USER_STATS_ACCOUNT_SIZE,
+        MemcmpOpts(offset=0, bytes=base58.b58encode(USER_STATS_DISCRIMINATOR).decode('utf-8')),
+    ]
+
+
+async def export_sliced(connection, program_id, output: str, fmt: str = "csv"):
+    """
+    Export with two server-side sliced getProgramAccounts calls instead of a pubkey scan plus
+    getMultipleAccounts: one returns the 32-byte authority, the other the 36 bytes of fuel fields.
+    A data slice is a single contiguous range, and the authority and fuel fields are 152 bytes
+    apart, so two narrow slices move less data than one wide slice. The results are joined on the
+    UserStats pubkey. An account's authority never changes, so the join is consistent even though
+    the two calls see slightly different slots.
+    """
+    logging.info("Fetching authority and fuel slices of every UserStats account...")
+    filters = user_stats_filters()
+    authority_resp, fuel_resp = await asyncio.gather(
+        connection.get_program_accounts(
+            program_id, encoding="base64", filters=filters,
+            data_slice=DataSliceOpts(offset=AUTHORITY_OFFSET, length=32),
+        ),
+        connection.get_program_accounts(
+            program_id, encoding="base64", filters=filters,
+            data_slice=DataSliceOpts(offset=FUEL_OFFSET, length=FUEL_LAYOUT.size),
+        ),
+    )
+    authorities = {acc.pubkey: acc.account.data for acc in authority_resp.value}
+    logging.info(f"👥 Found {len(fuel_resp.value)} UserStats accounts.")
+
+    count = 0
+    skipped_count = 0
+    unmatched = 0
+    with open_row_writer(output, get_parquet_columns(), fmt) as writer:
+        logging.info(f"📄 Opened output file for writing: {output}")
+
+        for acc in fuel_resp.value:
+            authority = authorities.get(acc.pubkey)
+            if authority is None:
+                # Created between the two calls
+                unmatched += 1
+                continue
+            fuel = FUEL_LAYOUT.unpack_from(acc.account.data)
+            row = [str(Pubkey(authority)), str(acc.pubkey), *fuel]
+            if not should_include_record(row):
+                skipped_count += 1
+                continue
+            writer.writerow(row)
+            count += 1
+
+    logging.info("\n✅ Fuel data export complete!")
+    logging.info(f"Total UserStats accounts with fuel data exported: {count}")
+    logging.info(f"Total accounts skipped (zero fuel values): {skipped_count}")
+    if unmatched:
+        logging.info(f"Accounts created during the export (not included): {unmatched}")
+    logging.info(f"Output saved to: {output}")
+
+
 async def main():
     parser = argparse.ArgumentParser(description="Export fuel-related UserStats data to CSV.")
     
     # Generate timestamp for the default filename
     timestamp = datetime.now().strftime("%m%d%Y%H%M%S")
-    default_filename = f"{timestamp}_user_stats_fuel_export.csv"
+    default_filename = f"{timestamp}_user_stats_fuel_export"
 
     DEFAULT_RPC_URL = "https://api.mainnet-beta.solana.com"
     load_dotenv()
     rpc_url = os.getenv("RPC_URL", DEFAULT_RPC_URL)
     parser.add_argument("--rpc-url", type=str, default=rpc_url, help=f"The Solana RPC URL (default: {rpc_url} or RPC_URL from .env).")
-    parser.add_argument("--output", type=str, default=default_filename, help=f"Output CSV filename (default: {default_filename})")
+    parser.add_argument("--output", type=str, default=None,
+                        help=f"Output filename (default: {default_filename}.csv, or .parquet with --format parquet; "
+                             "in fetch mode, an unfinished export with a default name is resumed instead)")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="csv",
+                        help="csv, or parquet: typed columns, dictionary-encoded authorities, zstd (needs pyarrow) (default: csv)")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose output")
+    parser.add_argument("--mode", choices=["fetch", "slice"], default="fetch",
+                        help="fetch: pubkey scan + concurrent getMultipleAccounts of full accounts; "
+                             "slice: two getProgramAccounts calls returning only the authority and fuel bytes (default: fetch)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum getMultipleAccounts requests in flight (default: 8)")
+    parser.add_argument("--max-retries", type=int, default=5, help="Retries per failed batch before giving up on it (default: 5)")
+    parser.add_argument("--restart", action="store_true",
+                        help="fetch mode: discard the checkpoint of an interrupted export to --output and start over")
 
     args = parser.parse_args()
+    unfinished = None
+    if args.output is None:
+        if args.mode == "fetch":
+            # The default name changes every run; pick up an interrupted default-named export instead
+            unfinished = find_unfinished("_user_stats_fuel_export" + output_suffix(args.format))
+        args.output = unfinished or default_filename + output_suffix(args.format)
 
     # Configure logging
     log_level = logging.DEBUG if args.verbose else logging.INFO
@@ -102,6 +200,9 @@ async def main():
     )
 
     logging.info("🚀 Starting fuel stats export script...")
+    if unfinished:
+        logging.info(f"Found unfinished export {unfinished} ({'restarting' if args.restart else 'resuming'} it); "
+                     "pass --output to start a new file instead")
     logging.debug(f"Script arguments: {args}")
 
     connection = AsyncClient(args.rpc_url)
@@ -114,14 +215,16 @@ async def main():
         "mainnet", # Ensure this is the desired environment or make it configurable
         account_subscription=AccountSubscriptionConfig("cached")
     )
-    
-    # The size of the UserStats account struct on-chain
-    USER_STATS_ACCOUNT_SIZE = 488
+
 
     try:
         logging.debug("Subscribing to Drift client...")
         await drift_client.subscribe()
         logging.info("Successfully subscribed to Drift client.")
+
+        if args.mode == "slice":
+            await export_sliced(connection, drift_client.program_id, args.output, args.format)
+            return
         
         logging.info("Fetching all UserStats accounts... This may take a while.")
 
@@ -129,99 +232,116 @@ async def main():
         # 1. Get all UserStats account pubkeys using getProgramAccounts with a dataSlice to be lightweight.
         # 2. Paginate through the pubkeys and fetch account data in batches using getMultipleAccounts.
 
-        # Step 1: Get all UserStats account pubkeys
-        logging.info("Fetching all UserStats account public keys...")
-        
-        # The correct, driftpy-idiomatic way to get the discriminator
-        user_stats_discriminator = _account_discriminator("UserStats")
-        
-        # Fetch accounts with matching discriminator and size, but only get their pubkeys.
-        gpa_resp = await connection.get_program_accounts(
-            drift_client.program_id,
-            encoding="base64",
-            filters=[
-                DataSizeOpts(USER_STATS_ACCOUNT_SIZE),
-                MemcmpOpts(offset=0, bytes=base58.b58encode(user_stats_discriminator).decode('utf-8'))
-            ],
-            data_slice=DataSliceOpts(offset=0, length=0)
-        )
-        
-        user_stats_pubkeys = [Pubkey.from_string(acc["pubkey"]) for acc in gpa_resp]
+        fetcher = AccountFetcher(connection, max_concurrency=args.concurrency, max_retries=args.max_retries)
+        # Completed batches are committed as segment files next to the output, so an
+        # interrupted export resumes where it stopped when rerun with the same --output
+        checkpoint = ExportCheckpoint(args.output, fetcher.batch_size, restart=args.restart)
+        user_stats_pubkeys = checkpoint.resume_pubkeys()
+
+        if user_stats_pubkeys is None:
+            # Step 1: Get all UserStats account pubkeys
+            logging.info("Fetching all UserStats account public keys...")
+
+            # Fetch accounts with matching discriminator and size, but only get their pubkeys.
+            gpa_resp = await connection.get_program_accounts(
+                drift_client.program_id,
+                encoding="base64",
+                filters=user_stats_filters(),
+                data_slice=DataSliceOpts(offset=0, length=0)
+            )
+            user_stats_pubkeys = checkpoint.start(acc.pubkey for acc in gpa_resp.value)
+
         logging.info(f"👥 Found {len(user_stats_pubkeys)} UserStats accounts. Now processing in batches.")
-        
-        with open(args.output, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            logging.info(f"📄 Opened output file for writing: {args.output}")
-            
-            headers = get_csv_headers()
-            writer.writerow(headers)
-            logging.debug(f"Wrote CSV headers: {headers}")
-            
-            count = 0
-            skipped_count = 0
-            
-            # Step 2: Process pubkeys in batches
-            batch_size = 100
-            total_batches = (len(user_stats_pubkeys) + batch_size - 1) // batch_size
-            logging.info(f"⚙️ Starting processing of {len(user_stats_pubkeys)} accounts in {total_batches} batches of size {batch_size}...")
-
-            for i in range(0, len(user_stats_pubkeys), batch_size):
-                batch_pubkeys = user_stats_pubkeys[i:i+batch_size]
-                logging.debug(f"Processing batch {i//batch_size + 1}/{total_batches}")
-                
-                try:
-                    # Get account data for the current batch
-                    accounts_data = await connection.get_multiple_accounts(batch_pubkeys)
-                    
-                    for j, acc_data in enumerate(accounts_data):
-                        if acc_data is None:
-                            logging.debug(f"Could not fetch account data for {batch_pubkeys[j]}. Skipping.")
+
+        total_batches = len(fetcher.batches(user_stats_pubkeys))
+        pending_batches = checkpoint.pending(total_batches)
+        logging.info(f"⚙️ Starting processing of {len(user_stats_pubkeys)} accounts in {total_batches} batches "
+                     f"of size {fetcher.batch_size} ({len(pending_batches)} still to fetch), "
+                     f"up to {args.concurrency} in flight...")
+
+        # fetch (N batches in flight) -> decode -> CSV writer, connected by bounded queues
+        fetched = asyncio.Queue(maxsize=args.concurrency * 4)
+        decoded = asyncio.Queue(maxsize=args.concurrency * 4)
+        counts = {"exported": 0, "skipped": 0, "missing": 0, "batches": 0}
+
+        async def decode_stage():
+            while True:
+                item = await fetched.get()
+                if item is None:
+                    await decoded.put(None)
+                    return
+                batch_index, batch_pubkeys, _, accounts_data = item
+                rows = []
+                for user_stats_pk, acc_data in zip(batch_pubkeys, accounts_data):
+                    if acc_data is None:
+                        counts["missing"] += 1
+                        logging.debug(f"Could not fetch account data for {user_stats_pk}. Skipping.")
+                        continue
+                    try:
+                        # Fixed-offset struct decode (checks the discriminator)
+                        user_stats_data = decode_user_stats(acc_data.data)
+                        authority_pk = user_stats_data.authority
+
+                        logging.debug(f"Processing UserStats account {user_stats_pk} for authority {authority_pk}")
+
+                        # Create row data with fuel fields only
+                        row = flatten_user_stats_to_row(
+                            str(authority_pk),
+                            str(user_stats_pk),
+                            user_stats_data
+                        )
+
+                        if not row:
+                            logging.debug(f"Flattening row returned None for {user_stats_pk}, skipping.")
                             continue
 
-                        user_stats_pk = batch_pubkeys[j]
-                        
-                        try:
-                            # Decode the account data to get UserStats object
-                            user_stats_data = drift_client.program.coder.accounts.decode(acc_data.data)
-                            authority_pk = user_stats_data.authority
-
-                            logging.debug(f"Processing UserStats account {user_stats_pk} for authority {authority_pk}")
-
-                            # Create row data with fuel fields only
-                            row = flatten_user_stats_to_row(
-                                str(authority_pk), 
-                                str(user_stats_pk),
-                                user_stats_data
-                            )
-                            
-                            if not row:
-                                logging.debug(f"Flattening row returned None for {user_stats_pk}, skipping.")
-                                continue
-                            
-                            # Check if this record has any non-zero fuel values
-                            if not should_include_record(row):
-                                skipped_count += 1
-                                logging.debug(f"Record for {authority_pk} has zero fuel values. Skipping. Total skipped: {skipped_count}")
-                                continue
-                            
-                            # Write to CSV
-                            writer.writerow(row)
-                            
-                            count += 1
-                        except Exception as e:
-                            logging.warning(f"Failed to decode or process UserStats account {user_stats_pk}: {e}")
+                        # Check if this record has any non-zero fuel values
+                        if not should_include_record(row):
+                            counts["skipped"] += 1
+                            logging.debug(f"Record for {authority_pk} has zero fuel values. Skipping. Total skipped: {counts['skipped']}")
                             continue
 
-                    if (i//batch_size + 1) % 10 == 0:
-                        logging.info(f"  ...processed batch {i//batch_size + 1}/{total_batches}, exported {count} accounts so far...")
+                        rows.append(row)
+                    except Exception as e:
+                        logging.warning(f"Failed to decode or process UserStats account {user_stats_pk}: {e}")
+                        continue
+                await decoded.put((batch_index, rows))
+
+                counts["batches"] += 1
+                if counts["batches"] % 10 == 0:
+                    logging.info(f"  ...processed {counts['batches']}/{len(pending_batches)} batches, "
+                                 f"concurrency limit {fetcher.limit}, {counts['exported']} accounts exported so far...")
+
+        async def write_stage():
+            while True:
+                item = await decoded.get()
+                if item is None:
+                    return
+                batch_index, rows = item
+                checkpoint.commit_batch(batch_index, rows)
+                counts["exported"] += len(rows)
+
+        await asyncio.gather(
+            fetcher.stream(user_stats_pubkeys, fetched, batch_indexes=pending_batches),
+            decode_stage(),
+            write_stage(),
+        )
+
+        if not checkpoint.is_complete(total_batches):
+            failed_accounts = sum(len(fetcher.batches(user_stats_pubkeys)[i]) for i in fetcher.stats.failed_batches)
+            logging.error(f"❌ {len(fetcher.stats.failed_batches)} batches ({failed_accounts} accounts) failed after "
+                          f"{args.max_retries} retries; {len(checkpoint.completed)}/{total_batches} batches are "
+                          f"committed in {checkpoint.parts_dir}")
+            logging.error(f"Rerun with --output {args.output} to fetch only the remaining batches")
+            return
+
+        checkpoint.finalize(get_csv_headers(), get_parquet_columns() if args.format == "parquet" else None)
 
-                except Exception as e:
-                    logging.error(f"Error processing batch {i//batch_size + 1}: {e}")
-                    continue
-        
         logging.info("\n✅ Fuel data export complete!")
-        logging.info(f"Total UserStats accounts with fuel data exported: {count}")
-        logging.info(f"Total accounts skipped (zero fuel values): {skipped_count}")
+        logging.info(f"UserStats accounts with fuel data exported in this run: {counts['exported']}")
+        logging.info(f"Total accounts skipped (zero fuel values): {counts['skipped']}")
+        logging.info(f"Accounts not found: {counts['missing']}; retried requests: {fetcher.stats.retries} "
+                     f"({fetcher.stats.rate_limited} rate limited)")
         logging.info(f"Output saved to: {args.output}")
 
     except Exception as e:
@@ -1,14 +1,26 @@
 #!/usr/bin/env python3
 """
 Production script to export all Drift Protocol UserStats accounts to CSV.
+
+--source usermap (default) loads accounts through driftpy's UserStatsMap. --source rpc fetches
+the raw accounts itself (pubkey scan plus concurrent getMultipleAccounts) and decodes them in
+bulk with the struct/NumPy decoder in driftpy/user_stats_decoder.py, without building a
+DriftUserStats object per account. It commits each fetched batch to a checkpoint next to the
+output (see driftpy/export_checkpoint.py), so rerunning an interrupted rpc export with the same
+--output fetches only the batches that are still missing. Without --output, the newest unfinished
+export with a default (timestamped) name is resumed.
+
+--format parquet writes typed columns (dictionary-encoded authority/referrer, zstd) instead of CSV;
+it needs pyarrow.
 """
 
 import argparse
 import asyncio
-import csv
 import logging
 import os
+import sys
 from datetime import datetime
+from pathlib import Path
 
 from anchorpy import Wallet
 from driftpy.account_subscription_config import AccountSubscriptionConfig
@@ -17,19 +29,37 @@ from driftpy.user_map.user_map_config import UserStatsMapConfig, SyncConfig
 from driftpy.user_map.userstats_map import UserStatsMap
 from dotenv import load_dotenv
 from solana.rpc.async_api import AsyncClient
+from solana.rpc.types import DataSliceOpts, MemcmpOpts
 from solders.keypair import Keypair
+from solders.pubkey import Pubkey
+import base58
+
+# Shared helpers live in driftpy/ at the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parents[4] / "driftpy"))
+from account_fetch import AccountFetcher
+from export_checkpoint import ExportCheckpoint, find_unfinished
+from columnar_export import open_row_writer, output_suffix, OUTPUT_FORMATS
+from user_stats_decoder import decode_user_stats_batch, USER_STATS_ACCOUNT_SIZE, USER_STATS_DISCRIMINATOR
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
 
 class UserStatsExporter:
-    def __init__(self, rpc_url: str, output_file: str):
+    def __init__(self, rpc_url: str, output_file: str, source: str = "usermap", concurrency: int = 8,
+                 restart: bool = False, output_format: str = "csv"):
         self.rpc_url = rpc_url
         self.output_file = output_file
         self.connection = AsyncClient(rpc_url)
         self.drift_client = None
         self.user_stats_map = None
+        self.source = source
+        self.concurrency = concurrency
+        self.restart = restart
+        self.output_format = output_format
+        # --source rpc: per-batch CSV segments, and the records decoded in this run
+        self.checkpoint = None
+        self.decoded_count = 0
 
     async def initialize_drift_client(self):
         """Initialize DriftClient with minimal configuration for read-only operations."""
@@ -65,9 +95,73 @@ class UserStatsExporter:
             f"UserStatsMap initialized with {'paginated' if use_paginated else 'default'} sync"
         )
 
+    async def fetch_raw_user_stats(self):
+        """Fetch raw UserStats accounts over RPC, decoding and checkpointing them batch by batch."""
+        fetcher = AccountFetcher(self.connection, max_concurrency=self.concurrency)
+        self.checkpoint = ExportCheckpoint(self.output_file, fetcher.batch_size, restart=self.restart)
+        keys = self.checkpoint.resume_pubkeys()
+        if keys is None:
+            resp = await self.connection.get_program_accounts(
+                self.drift_client.program_id,
+                encoding="base64",
+                filters=[
+                    USER_STATS_ACCOUNT_SIZE,
+                    MemcmpOpts(offset=0, bytes=base58.b58encode(USER_STATS_DISCRIMINATOR).decode("utf-8")),
+                ],
+                data_slice=DataSliceOpts(offset=0, length=0),
+            )
+            keys = self.checkpoint.start(acc.pubkey for acc in resp.value)
+
+        total_batches = len(fetcher.batches(keys))
+        pending = self.checkpoint.pending(total_batches)
+        logger.info(f"Found {len(keys)} UserStats accounts, fetching {len(pending)} of {total_batches} batches...")
+
+        queue = asyncio.Queue(maxsize=self.concurrency * 4)
+        stream = asyncio.create_task(fetcher.stream(keys, queue, batch_indexes=pending))
+        closed = 0
+        while (item := await queue.get()) is not None:
+            batch_index, batch_keys, _, accounts = item
+            found = [(key, account.data) for key, account in zip(batch_keys, accounts) if account is not None]
+            records = decode_user_stats_batch((data for _, data in found), strict=False)
+            self.checkpoint.commit_batch(batch_index, self.rows_from_records(records, [key for key, _ in found]))
+            self.decoded_count += len(records)
+            closed += len(batch_keys) - len(found)
+        await stream
+
+        logger.info(f"Decoded {self.decoded_count} UserStats accounts in this run "
+                    f"({closed} closed during the fetch)")
+        if not self.checkpoint.is_complete(total_batches):
+            logger.error(f"{len(fetcher.stats.failed_batches)} batches failed after retries; "
+                         f"rerun with --output {self.output_file} to fetch only the remaining batches")
+            raise RuntimeError(f"{len(fetcher.stats.failed_batches)} of {total_batches} getMultipleAccounts batches failed")
+        return len(keys)
+
+    def rows_from_records(self, records, keys):
+        """CSV rows (same columns as extract_user_stats_data) from a decoded record array and its account keys."""
+        columns = [
+            [str(Pubkey(value.tobytes())) for value in records["authority"]],
+            [str(key) for key in keys],
+            [str(Pubkey(value.tobytes())) for value in records["referrer"]],
+        ]
+        for name in ("total_fee_paid", "total_fee_rebate", "total_token_discount", "total_referee_discount",
+                     "total_referrer_reward", "current_epoch_referrer_reward", "next_epoch_ts",
+                     "maker_volume30d", "taker_volume30d", "filler_volume30d",
+                     "last_maker_volume30d_ts", "last_taker_volume30d_ts", "last_filler_volume30d_ts",
+                     "if_staked_quote_asset_amount", "number_of_sub_accounts", "number_of_sub_accounts_created"):
+            columns.append(records[name].tolist())
+        columns.append([(status & 0x1) == 1 for status in records["referrer_status"].tolist()])
+        columns.append([value == 1 for value in records["disable_update_perp_bid_ask_twap"].tolist()])
+        for name in ("fuel_overflow_status", "fuel_insurance", "fuel_deposits", "fuel_borrows",
+                     "fuel_positions", "fuel_taker", "fuel_maker",
+                     "if_staked_gov_token_amount", "last_fuel_if_bonus_update_ts"):
+            columns.append(records[name].tolist())
+        return zip(*columns)
+
     async def fetch_all_user_stats(self):
         """Fetch all UserStats accounts from the protocol."""
         logger.info("Starting to fetch all UserStats accounts...")
+        if self.source == "rpc":
+            return await self.fetch_raw_user_stats()
 
         try:
             await self.user_stats_map.subscribe()
@@ -113,6 +207,17 @@ class UserStatsExporter:
             "last_fuel_if_bonus_update_ts",
         ]
 
+    def get_parquet_columns(self):
+        """Typed columns for --format parquet (same names and order as get_csv_headers())."""
+        types = ["pubkey", "str", "pubkey"]
+        types += ["u64"] * 6                      # fees
+        types += ["i64", "u64", "u64", "u64"]     # next_epoch_ts, 30d volumes
+        types += ["i64", "i64", "i64", "u64"]     # last volume timestamps, if_staked_quote_asset_amount
+        types += ["u16", "u16", "bool", "bool", "u8"]
+        types += ["u64"] * 7                      # fuel fields, if_staked_gov_token_amount
+        types += ["i64"]                          # last_fuel_if_bonus_update_ts
+        return list(zip(self.get_csv_headers(), types))
+
     def extract_user_stats_data(self, user_stats_account, user_stats_pk):
         """Extract data from UserStatsAccount for CSV export."""
         fees = getattr(user_stats_account, "fees", None)
@@ -128,12 +233,12 @@ class UserStatsExporter:
             getattr(fees, "total_referrer_reward", 0) if fees else 0,
             getattr(fees, "current_epoch_referrer_reward", 0) if fees else 0,
             getattr(user_stats_account, "next_epoch_ts", 0),
-            getattr(user_stats_account, "maker_volume_30d", 0),
-            getattr(user_stats_account, "taker_volume_30d", 0),
-            getattr(user_stats_account, "filler_volume_30d", 0),
-            getattr(user_stats_account, "last_maker_volume_30d_ts", 0),
-            getattr(user_stats_account, "last_taker_volume_30d_ts", 0),
-            getattr(user_stats_account, "last_filler_volume_30d_ts", 0),
+            getattr(user_stats_account, "maker_volume30d", 0),
+            getattr(user_stats_account, "taker_volume30d", 0),
+            getattr(user_stats_account, "filler_volume30d", 0),
+            getattr(user_stats_account, "last_maker_volume30d_ts", 0),
+            getattr(user_stats_account, "last_taker_volume30d_ts", 0),
+            getattr(user_stats_account, "last_filler_volume30d_ts", 0),
             getattr(user_stats_account, "if_staked_quote_asset_amount", 0),
             getattr(user_stats_account, "number_of_sub_accounts", 0),
             getattr(user_stats_account, "number_of_sub_accounts_created", 0),
@@ -151,16 +256,23 @@ class UserStatsExporter:
         ]
 
     async def export_to_csv(self):
-        """Export all UserStats data to CSV file."""
+        """Export all UserStats data to the output file (CSV, or Parquet with --format parquet)."""
         logger.info(f"Exporting data to {self.output_file}")
 
         try:
-            with open(self.output_file, "w", newline="", encoding="utf-8") as csvfile:
-                writer = csv.writer(csvfile)
-
-                headers = self.get_csv_headers()
-                writer.writerow(headers)
+            if self.checkpoint is not None:
+                # Append the committed batch segments, in order, to the output file
+                self.checkpoint.finalize(
+                    self.get_csv_headers(),
+                    self.get_parquet_columns() if self.output_format == "parquet" else None,
+                )
+                logger.info(
+                    f"Successfully exported UserStats accounts to {self.output_file} "
+                    f"({self.decoded_count} fetched in this run)"
+                )
+                return self.decoded_count
 
+            with open_row_writer(self.output_file, self.get_parquet_columns(), self.output_format) as writer:
                 exported_count = 0
                 for drift_user_stats in self.user_stats_map.values():
                     try:
@@ -205,7 +317,8 @@ class UserStatsExporter:
             logger.info("🚀 Starting Drift UserStats export process...")
 
             await self.initialize_drift_client()
-            await self.initialize_user_stats_map(use_paginated=True)
+            if self.source == "usermap":
+                await self.initialize_user_stats_map(use_paginated=True)
 
             total_accounts = await self.fetch_all_user_stats()
 
@@ -230,7 +343,7 @@ async def main():
     )
 
     timestamp = datetime.now().strftime("%m%d%Y%H%M%S")
-    default_filename = f"{timestamp}_user_stats_full_export.csv"
+    default_filename = f"{timestamp}_user_stats_full_export"
 
     DEFAULT_RPC_URL = "https://api.mainnet-beta.solana.com"
     load_dotenv()
@@ -245,14 +358,44 @@ async def main():
     parser.add_argument(
         "--output",
         type=str,
-        default=default_filename,
-        help=f"Output CSV filename (default: {default_filename})",
+        default=None,
+        help=f"Output filename (default: {default_filename}.csv, or .parquet with --format parquet; "
+        "with --source rpc, an unfinished export with a default name is resumed instead)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="csv",
+        help="csv, or parquet: typed columns, dictionary-encoded pubkeys, zstd (needs pyarrow) (default: csv)",
     )
     parser.add_argument(
         "--verbose", action="store_true", help="Enable verbose (DEBUG level) logging."
     )
+    parser.add_argument(
+        "--source",
+        choices=["usermap", "rpc"],
+        default="usermap",
+        help="usermap: load through UserStatsMap; rpc: fetch raw accounts and bulk-decode them (default: usermap)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Maximum getMultipleAccounts requests in flight with --source rpc (default: 8)",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="With --source rpc, discard the checkpoint of an interrupted export to --output and start over",
+    )
 
     args = parser.parse_args()
+    unfinished = None
+    if args.output is None:
+        if args.source == "rpc":
+            # The default name changes every run; pick up an interrupted default-named export instead
+            unfinished = find_unfinished("_user_stats_full_export" + output_suffix(args.format))
+        args.output = unfinished or default_filename + output_suffix(args.format)
 
     log_level = logging.DEBUG if args.verbose else logging.INFO
     logging.basicConfig(
@@ -262,9 +405,19 @@ async def main():
     )
 
     logger.info(f"Using RPC URL: {args.rpc_url}")
+    if unfinished:
+        logger.info(f"Found unfinished export {unfinished} ({'restarting' if args.restart else 'resuming'} it); "
+                    "pass --output to start a new file instead")
     logger.info(f"Output file: {args.output}")
 
-    exporter = UserStatsExporter(rpc_url=args.rpc_url, output_file=args.output)
+    exporter = UserStatsExporter(
+        rpc_url=args.rpc_url,
+        output_file=args.output,
+        source=args.source,
+        concurrency=args.concurrency,
+        restart=args.restart,
+        output_format=args.format,
+    )
     await exporter.run()
 
 